@@ -1,71 +1,351 @@
 #!/usr/bin/env python3
 import argparse
 import os
-import pickle
 import re
 from timeit import default_timer as timer
-from typing import Dict
+from typing import Callable, Dict, TYPE_CHECKING
 
-import tweepy
 from dotenv import load_dotenv
 
-from utils.Model import train_model_from_file
-from utils.TweetBuilder import create_tweet
-from utils.TweetDownloader import add_new_tweets_to_dump
-from utils.TweetPoster import get_tweet_ids_to_reply_to, post_reply_tweet, should_tweet_now, post_tweet, \
-    get_random_follower
+from utils.Profiler import enable_profiling, is_profiling, save_profile, set_profile_value
+from utils.TweetScheduler import should_tweet_now
+
+if TYPE_CHECKING:
+    from threading import Event
+    from tweepy import API
+    from utils.Model import Model
+    from utils.TweetQueue import TweetQueue
+    from utils.TwitterState import TwitterState
+
+# Everything heavier than the above (tweepy, nltk, numpy, the model itself) is imported inside the command that needs
+# it, since most runs of the tweet command exit without using any of it
 
 # TODO logging
 load_dotenv()
 
+_TWEET_LENGTHS = {'tweet': 240, 'reply': 200}  # Max length of each kind of tweet in the queue. TODO 240 for replies?
+_MODEL_READING_COMMANDS = ('tweet', 'serve', 'pregenerate', 'queue_stats', 'prune')  # And train --incremental
+_TWEET_READING_COMMANDS = ('train', 'update', 'test_tweet', 'export_tweets')
 
-def tweet_command(args: Dict) -> None:
-    with open(args['model_file'], 'rb') as fp:
-        model = pickle.load(fp)
+
+def _get_twitter_api() -> 'API':
+    import tweepy
 
     auth = tweepy.OAuthHandler(consumer_key=os.environ["TW_CONSUMER_KEY"],
                                consumer_secret=os.environ["TW_CONSUMER_SECRET"])
     auth.set_access_token(key=os.environ["TW_ACCESS_TOKEN"],
                           secret=os.environ["TW_ACCESS_SECRET"])
-    api = tweepy.API(auth)
+    return tweepy.API(auth, wait_on_rate_limit=True)
+
+
+def _wake_up(api: 'API', state: 'TwitterState', args: Dict, tweeting_now: bool,
+             get_model: Callable[[], 'Model']) -> None:
+    # Replies to any new mentions, and tweets if it's time to. get_model is only called if the queue ran out
+    from utils.TweetPoster import get_tweets_to_reply_to, post_reply_tweets, post_tweet, get_random_follower
+
+    tweets_to_reply_to = get_tweets_to_reply_to(api, state)
+    if len(tweets_to_reply_to) == 0 and not tweeting_now:
+        return
+
+    from utils.TweetQueue import TweetQueue, TWEET, REPLY, get_model_version
+
+    with TweetQueue(args['queue_file'], get_model_version(args['model_file']), args['queue_size']) as queue:
+        reply_tweets = queue.pop(REPLY, len(tweets_to_reply_to))
+        tweets = queue.pop(TWEET, 1) if tweeting_now else []
+
+    num_replies_missing = len(tweets_to_reply_to) - len(reply_tweets)
+    if num_replies_missing > 0 or len(tweets) < int(tweeting_now):
+        from utils.TweetBuilder import create_tweets
+
+        model = get_model()
+        reply_tweets += create_tweets(model, _TWEET_LENGTHS[REPLY], num_replies_missing)
+        tweets += create_tweets(model, _TWEET_LENGTHS[TWEET], int(tweeting_now) - len(tweets))
 
-    for tweet_id in get_tweet_ids_to_reply_to(api):
-        tweet = create_tweet(model, 200)  # TODO 240?
-        post_reply_tweet(api, tweet, tweet_id)
+    post_reply_tweets(api, state, [(tweet, tweet_id, author)
+                                   for tweet, (tweet_id, author) in zip(reply_tweets, tweets_to_reply_to)])
 
-    if args['force_tweet'] or should_tweet_now(args['min_between_wakeups'], args['target_avg_tweets_per_day']):
-        tweet = create_tweet(model, 240)
+    if tweeting_now:
+        tweet = tweets[0]
 
         # If we're about to randomly @ somebody, swap it out for one of our followers
         if tweet.startswith('@'):
-            random_follower_name = get_random_follower(api)
+            random_follower_name = get_random_follower(api, state)
             tweet = re.sub(r'^@\S* ', f'@{random_follower_name} ', tweet)
 
         post_tweet(api, tweet)
 
 
+def tweet_command(args: Dict) -> None:
+    tweeting_now = args['force_tweet'] or should_tweet_now(args['min_between_wakeups'],
+                                                           args['target_avg_tweets_per_day'])
+
+    from utils.TwitterState import TwitterState
+
+    def get_model() -> 'Model':
+        from utils.ModelFile import load_model
+        return load_model(args['model_file'])
+
+    with TwitterState(args['twitter_state_file']) as state:
+        _wake_up(_get_twitter_api(), state, args, tweeting_now, get_model)
+
+
+def _serve(api: 'API', args: Dict, stopping: 'Event') -> int:
+    # Wakes up every min_between_wakeups minutes until stopping is set, keeping the model loaded in between and
+    # reloading it whenever train replaces the file. With --poisson, tweets go out at exponentially distributed
+    # intervals instead of by chance at each wakeup. After each wakeup the tweet queue gets topped up, so the idle time
+    # pays for the next tweets. Returns how many wakeups there were
+    import time
+    import traceback
+    from utils.ModelFile import ResidentModel
+    from utils.TweetScheduler import get_minutes_until_next_tweet
+    from utils.TwitterState import TwitterState
+
+    model = ResidentModel(args['model_file'])
+    next_wakeup = time.monotonic()
+    next_tweet = next_wakeup + get_minutes_until_next_tweet(args['target_avg_tweets_per_day']) * 60
+    num_wakeups = 0
+
+    with TwitterState(args['twitter_state_file']) as state:
+        while not stopping.is_set():
+            now = time.monotonic()
+            while next_wakeup <= now:  # Skips any wakeups that were missed while the last one ran
+                next_wakeup += args['min_between_wakeups'] * 60
+
+            if args['poisson']:
+                tweeting_now = now >= next_tweet
+                if tweeting_now:
+                    next_tweet = now + get_minutes_until_next_tweet(args['target_avg_tweets_per_day']) * 60
+            else:
+                tweeting_now = should_tweet_now(args['min_between_wakeups'], args['target_avg_tweets_per_day'])
+
+            try:
+                _wake_up(api, state, args, tweeting_now, model.get)
+                _top_up_tweet_queue(args, model.get)
+            except Exception:  # Like when cron ran each wakeup, one failing shouldn't stop the ones after it
+                traceback.print_exc()
+            num_wakeups += 1
+
+            wake_at = min(next_wakeup, next_tweet) if args['poisson'] else next_wakeup
+            stopping.wait(max(wake_at - time.monotonic(), 0))
+
+    return num_wakeups
+
+
+def serve_command(args: Dict) -> None:
+    import signal
+    import threading
+
+    # Stops once the current wakeup is done, rather than partway through posting
+    stopping = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stopping.set())
+
+    print(f'Waking up every {args["min_between_wakeups"]} minutes', flush=True)
+    num_wakeups = _serve(_get_twitter_api(), args, stopping)
+    print(f'Stopped after {num_wakeups} wakeups', flush=True)
+
+
+def _profile_model(model: 'Model') -> None:
+    if not is_profiling():
+        return
+
+    try:
+        set_profile_value('order_sizes', [size._asdict() for size in model.get_order_sizes()])
+    except ValueError:  # Lazily fit models don't count anything up front
+        pass
+
+
+def _fill_tweet_queue(queue: 'TweetQueue', model: 'Model') -> None:
+    from utils.TweetBuilder import create_tweets
+
+    for kind, max_length in _TWEET_LENGTHS.items():
+        num_added = queue.push(kind, create_tweets(model, max_length, queue.num_missing(kind)))
+        print(f'Added {num_added} to the {kind} queue')
+
+
 def train_command(args: Dict) -> None:
-    # TODO use partial fit method
-    model = train_model_from_file(args['tweet_file'], args['min_ngram_length'], args['max_ngram_length'],
-                                  args['lazy_fit'])
-    with open(args['model_file'], 'wb') as fp:
-        pickle.dump(model, fp)
+    from utils.Model import train_model_from_file, can_update_model, update_model_from_file
+    from utils.ModelFile import load_model, save_model
+    from utils.TokenCache import TokenCache, clear_token_cache
+    from utils.TweetQueue import TweetQueue, get_model_version
+
+    if args['clear_token_cache']:
+        clear_token_cache(args['token_cache_file'])
+
+    model = None
+    if args['incremental'] and os.path.exists(args['model_file']):
+        model = load_model(args['model_file'])
+        if not can_update_model(model, args['min_ngram_length'], args['max_ngram_length'], args['lazy_fit']):
+            print("Existing model can't be updated, retraining from scratch")
+            model = None
+
+    with TokenCache(args['token_cache_file']) as token_cache:
+        if model is not None:
+            new_tweet_count = update_model_from_file(model, args['tweet_file'], token_cache, args['jobs'])
+            print(f'Updated model with {new_tweet_count} new tweets')
+        else:
+            model = train_model_from_file(args['tweet_file'], args['min_ngram_length'], args['max_ngram_length'],
+                                          args['lazy_fit'], token_cache, args['jobs'])
+
+    if args['prune']:
+        model.prune(args['min_context_count'])
+    save_model(model, args['model_file'])
+    _profile_model(model)
+
+    print(f'Token cache: {token_cache.hits} hits, {token_cache.misses} misses')
+
+    # Saving the model invalidated everything in the queue, so refill it from the new one
+    with TweetQueue(args['queue_file'], get_model_version(args['model_file']), args['queue_size']) as queue:
+        _fill_tweet_queue(queue, model)
+
+
+def _top_up_tweet_queue(args: Dict, get_model: Callable[[], 'Model']) -> None:
+    # get_model is only called if the queue is missing tweets
+    from utils.TweetQueue import TweetQueue, get_model_version
+
+    with TweetQueue(args['queue_file'], get_model_version(args['model_file']), args['queue_size']) as queue:
+        if any(queue.num_missing(kind) > 0 for kind in _TWEET_LENGTHS):
+            _fill_tweet_queue(queue, get_model())
+
+
+def pregenerate_command(args: Dict) -> None:
+    from utils.ModelFile import load_model
+
+    _top_up_tweet_queue(args, lambda: load_model(args['model_file']))
+
+
+def queue_stats_command(args: Dict) -> None:
+    import json
+    from utils.TweetQueue import TweetQueue, get_model_version
+
+    with TweetQueue(args['queue_file'], get_model_version(args['model_file']), args['queue_size']) as queue:
+        print(json.dumps(queue.stats(), indent=2))
+
+
+def _format_share(counts: Dict[int, int], key: int) -> str:
+    # A dash if nothing was counted, e.g. with --sample_chains 0 or a model that can't generate anything
+    total = sum(counts.values())
+    return f'{counts[key] / total:6.1%}' if total > 0 else f'{"-":>6}'
+
+
+def prune_command(args: Dict) -> None:
+    import numpy as np
+    from utils.CompactWeights import CompactWeights
+    from utils.ModelFile import load_model, save_model
+    from utils.TweetQueue import TweetQueue, get_model_version
+
+    model = load_model(args['model_file'])
+    if not isinstance(model._weights, CompactWeights):
+        print(f"{args['model_file']} can't be pruned, since it was fit with --lazy-fit")
+        exit(1)
+
+    max_num_tokens = max(_TWEET_LENGTHS.values()) + 1
+
+    # Generates the same sample before and after, to see how often each order gets used and whether anything changed
+    seed = args['seed'] if args['seed'] is not None else np.random.SeedSequence().entropy
+    sizes_before = model.get_order_sizes()
+    chains_before = model.generate_batch(args['sample_chains'], max_num_tokens, np.random.default_rng(seed))
+    orders_before = model.count_backoff_orders(chains_before)
+
+    model.prune(args['min_context_count'])
+    _profile_model(model)
+    sizes_after = {size.n: size for size in model.get_order_sizes()}
+    chains_after = model.generate_batch(args['sample_chains'], max_num_tokens, np.random.default_rng(seed))
+    orders_after = model.count_backoff_orders(chains_after)
+
+    print(f'{"n":>3} {"contexts":>10} {"usable":>10} {"kept":>10} {"size":>9} {"pruned":>9}  predicted from n')
+    for size in sizes_before:
+        size_after = sizes_after.get(size.n, size._replace(contexts=0, num_bytes=0))
+        print(f'{size.n:3} {size.contexts:10} {size.usable_contexts:10} {size_after.contexts:10} '
+              f'{size.num_bytes / 2 ** 20:8.1f}M {size_after.num_bytes / 2 ** 20:8.1f}M  '
+              f'{_format_share(orders_before, size.n)} -> {_format_share(orders_after, size.n)}')
+
+    total_before = sum(size.num_bytes for size in sizes_before)
+    total_after = sum(size.num_bytes for size in sizes_after.values())
+    num_same = sum(before == after for before, after in zip(chains_before, chains_after))
+    print(f'{total_before / 2 ** 20:.1f}MB -> {total_after / 2 ** 20:.1f}MB. '
+          f'{num_same} of {len(chains_before)} sample chains unchanged')
+
+    save_model(model, args['model_file'])
+    with TweetQueue(args['queue_file'], get_model_version(args['model_file']), args['queue_size']) as queue:
+        _fill_tweet_queue(queue, model)
+
+
+def _migrate_model_file(args: Dict) -> None:
+    # Bots deployed before the binary model format only have the pickled model, so it gets converted the first time a
+    # command needs it. Checking is just a stat, so the tweet command stays light
+    if os.path.exists(args['model_file']) or not os.path.exists(args['pickled_model_file']):
+        return
+
+    from utils.ModelFile import migrate_pickled_model
+
+    model_file = migrate_pickled_model(args['model_file'], args['pickled_model_file'])
+    if model_file == args['model_file']:
+        print(f'Converted {args["pickled_model_file"]} to {model_file}')
+    else:  # Lazily fit models can't be converted, so the pickle stays the model file
+        print(f'Using {model_file} as the model file')
+        args['model_file'] = model_file
+
+
+def _migrate_tweet_file(args: Dict) -> None:
+    # Bots deployed before the tweet archive only have the ndjson dump, so it gets imported the first time a command
+    # needs it. Otherwise update would start a new archive with only the tweets the download state hasn't seen yet
+    if os.path.exists(args['tweet_file']) or not os.path.exists(args['ndjson_tweet_file']):
+        return
+
+    from utils.TweetArchive import ARCHIVE_SUFFIX, is_tweet_archive
+    from utils.TweetDump import copy_tweets
+
+    if not is_tweet_archive(args['tweet_file']):
+        return
+
+    # Imported under another name first, so an interrupted import gets redone instead of leaving half an archive
+    importing_file = f'{args["tweet_file"][:-len(ARCHIVE_SUFFIX)]}.importing{ARCHIVE_SUFFIX}'
+    num_copied = copy_tweets(args['ndjson_tweet_file'], importing_file)
+    os.replace(importing_file, args['tweet_file'])
+    print(f'Imported {num_copied} tweets from {args["ndjson_tweet_file"]} into {args["tweet_file"]}')
+
+
+def convert_command(args: Dict) -> None:
+    from utils.ModelFile import convert_pickled_model
+
+    convert_pickled_model(args['pickled_model_file'], args['model_file'])
+
+
+def import_tweets_command(args: Dict) -> None:
+    from utils.TweetDump import copy_tweets
+
+    num_copied = copy_tweets(args['ndjson_tweet_file'], args['tweet_file'])
+    print(f'Imported {num_copied} tweets from {args["ndjson_tweet_file"]} into {args["tweet_file"]}')
+
+
+def export_tweets_command(args: Dict) -> None:
+    from utils.TweetDump import copy_tweets
+
+    num_copied = copy_tweets(args['tweet_file'], args['ndjson_tweet_file'])
+    print(f'Exported {num_copied} tweets from {args["tweet_file"]} to {args["ndjson_tweet_file"]}')
 
 
 def update_command(args: Dict) -> None:
-    add_new_tweets_to_dump(args['tweet_file'])
+    from utils.TweetDownloader import add_new_tweets_to_dump
+
+    num_added = add_new_tweets_to_dump(args['tweet_file'], args['download_state_file'])
+    print(f'Added {num_added} new tweets to {args["tweet_file"]}')
 
 
 def test_tweet_command(args: Dict) -> None:
+    import numpy as np
+    from utils.Model import train_model_from_file
+    from utils.TweetBuilder import create_tweets
+
     train_time_start = timer()
     model = train_model_from_file(args['tweet_file'], args['min_ngram_length'], args['max_ngram_length'],
-                                  args['lazy_fit'])
+                                  args['lazy_fit'], processes=args['jobs'])
     train_time_total = timer() - train_time_start
+    _profile_model(model)
 
     tweet_time_start = timer()
-    tweets = []
-    for i in range(0, args['tweets_to_build']):
-        tweets.append(create_tweet(model, 240))
+    tweets = create_tweets(model, 240, args['tweets_to_build'], np.random.default_rng(args['seed']))
     tweet_time_total = timer() - tweet_time_start
 
     print(f'Model training time: {train_time_total:.2f}s')
@@ -80,20 +360,52 @@ def test_tweet_command(args: Dict) -> None:
 
 def main():
     parser = argparse.ArgumentParser(description='Command line interface for @DonaldTrumBot')
-    parser.add_argument('command', type=str, choices=['tweet', 'train', 'update', 'test_tweet'])
+    parser.add_argument('command', type=str, choices=['tweet', 'train', 'update', 'test_tweet', 'convert',
+                                                      'pregenerate', 'queue_stats', 'import_tweets',
+                                                      'export_tweets', 'prune', 'serve'])
 
-    parser.add_argument('--model_file', type=str, default='data/model.pkl')
-    parser.add_argument('--tweet_file', type=str, default='data/trump_tweets.ndjson')
+    parser.add_argument('--model_file', type=str, default='data/model.bin')
+    parser.add_argument('--pickled_model_file', type=str, default='data/model.pkl')
+    parser.add_argument('--tweet_file', type=str, default='data/trump_tweets.archive')  # Or an ndjson dump
+    parser.add_argument('--ndjson_tweet_file', type=str, default='data/trump_tweets.ndjson')  # For import/export
+    parser.add_argument('--queue_file', type=str, default='data/tweet_queue.sqlite3')
+    parser.add_argument('--queue_size', type=int, default=50)  # Per kind of tweet
+    parser.add_argument('--twitter_state_file', type=str, default='data/twitter_state.sqlite3')
+    parser.add_argument('--token_cache_file', type=str, default='data/token_cache.sqlite3')
+    parser.add_argument('--download_state_file', type=str, default='data/download_state.json')  # ETags per year
+    parser.add_argument('--clear-token-cache', action='store_true')
     parser.add_argument('--min_between_wakeups', type=float, default=10)
     parser.add_argument('--target_avg_tweets_per_day', type=float, default=2.5)
     parser.add_argument('--force-tweet', action='store_true')
+    parser.add_argument('--poisson', action='store_true')  # For serve. Tweet at any time, not just at wakeups
     parser.add_argument('--min-ngram-length', type=int, default=2)
     parser.add_argument('--max-ngram-length', type=int, default=10)
     parser.add_argument('--tweets_to_build', type=int, default=10)
     parser.add_argument('--lazy-fit', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--prune', action='store_true')  # Prune after training. The prune command prunes a saved model
+    parser.add_argument('--min-context-count', type=int, default=0)  # Above 0, pruning changes predictions
+    parser.add_argument('--sample_chains', type=int, default=1000)  # Generated by prune to report its effect
+    parser.add_argument('--seed', type=int, default=None)  # Makes test_tweet reproducible
+    parser.add_argument('--jobs', type=int, default=None)  # Worker processes for training. Defaults to one per CPU
+    parser.add_argument('--profile', action='store_true')  # Or set DTB_PROFILE=1
+    parser.add_argument('--profile_file', type=str, default='data/profile.ndjson')  # Appended to. '-' prints instead
 
     args = vars(parser.parse_args())
 
+    if args['profile']:
+        enable_profiling()
+
+    # Checked before training rather than after, so a night's training isn't thrown away
+    if args['command'] == 'train' and args['prune'] and args['lazy_fit']:
+        print("--prune can't be used with --lazy-fit, since lazily fit models can't be pruned")
+        exit(1)
+
+    if args['command'] in _MODEL_READING_COMMANDS or (args['command'] == 'train' and args['incremental']):
+        _migrate_model_file(args)
+    if args['command'] in _TWEET_READING_COMMANDS:
+        _migrate_tweet_file(args)
+
     if args['command'] == 'tweet':
         tweet_command(args)
     elif args['command'] == 'train':
@@ -102,10 +414,27 @@ def main():
         update_command(args)
     elif args['command'] == 'test_tweet':
         test_tweet_command(args)
+    elif args['command'] == 'convert':
+        convert_command(args)
+    elif args['command'] == 'pregenerate':
+        pregenerate_command(args)
+    elif args['command'] == 'queue_stats':
+        queue_stats_command(args)
+    elif args['command'] == 'import_tweets':
+        import_tweets_command(args)
+    elif args['command'] == 'export_tweets':
+        export_tweets_command(args)
+    elif args['command'] == 'prune':
+        prune_command(args)
+    elif args['command'] == 'serve':
+        serve_command(args)
     else:  # This should never be reached
         print('Invalid command')
         exit(1)
 
+    if is_profiling():
+        save_profile(args['profile_file'] if args['profile_file'] != '-' else None, command=args['command'])
+
     exit()
 
 
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Twitter API calls and time per wakeup of the tweet command, the old way (page through every like, recent mention,
+# follower and friend each time, and reply one at a time) against utils.TweetPoster with a TwitterState. Runs against a
+# stand-in for tweepy's API that keeps an account's history in memory and sleeps --latency seconds per call
+# Usage: python3 -m benchmarks.api_calls --wakeups 144
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Set
+
+from utils.TweetPoster import get_random_follower, get_tweets_to_reply_to, post_reply_tweets, post_tweet
+from utils.TwitterState import TwitterState
+
+_TIMELINE_PAGE_SIZE = 20  # What Twitter gives without a count, which is what tweepy.Cursor asks for
+_IDS_PAGE_SIZE = 5000
+
+
+class _FakeAPI:
+    # Only the parts of tweepy.API that TweetPoster uses, with the same paging behaviour as Twitter
+    def __init__(self, num_followers: int, num_friends: int, num_old_likes: int, latency: float, seed: int):
+        self._rng = random.Random(seed)
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._next_id = 10 ** 6
+        self.calls: Counter = Counter()
+
+        self.follower_ids = list(range(1, num_followers + 1))
+        self.friend_ids = self._rng.sample(self.follower_ids, min(num_friends, num_followers))
+        self.mentions: List[SimpleNamespace] = []
+        self.liked_ids: List[int] = list(range(1, num_old_likes + 1))
+
+    def add_mention(self, created_at: datetime) -> None:
+        with self._lock:
+            self._next_id += 1
+            self.mentions.append(SimpleNamespace(id=self._next_id, created_at=created_at, favorited=False,
+                                                 author=SimpleNamespace(screen_name=f'user{self._next_id}')))
+
+    def _call(self, name: str) -> None:
+        time.sleep(self._latency)
+        with self._lock:
+            self.calls[name] += 1
+
+    def mentions_timeline(self, count: int = _TIMELINE_PAGE_SIZE, since_id: Optional[int] = None,
+                          max_id: Optional[int] = None) -> List[SimpleNamespace]:
+        self._call('mentions_timeline')
+        mentions = [mention for mention in reversed(self.mentions)
+                    if (since_id is None or mention.id > since_id) and (max_id is None or mention.id <= max_id)]
+        return mentions[:count]
+
+    def favorites(self, page: int = 1) -> List[SimpleNamespace]:
+        self._call('favorites')
+        liked_ids = list(reversed(self.liked_ids))[(page - 1) * _TIMELINE_PAGE_SIZE:page * _TIMELINE_PAGE_SIZE]
+        return [SimpleNamespace(id=liked_id) for liked_id in liked_ids]
+
+    def followers_ids(self, cursor: int = -1):
+        return self._page_ids('followers_ids', self.follower_ids, cursor)
+
+    def friends_ids(self, cursor: int = -1):
+        return self._page_ids('friends_ids', self.friend_ids, cursor)
+
+    def _page_ids(self, name: str, ids: List[int], cursor: int):
+        self._call(name)
+        start = 0 if cursor == -1 else cursor
+        next_cursor = start + _IDS_PAGE_SIZE if start + _IDS_PAGE_SIZE < len(ids) else 0
+        return ids[start:start + _IDS_PAGE_SIZE], (0, next_cursor)
+
+    def create_favorite(self, status_id: int) -> None:
+        self._call('create_favorite')
+        with self._lock:
+            self.liked_ids.append(status_id)
+            for mention in self.mentions:
+                if mention.id == status_id:
+                    mention.favorited = True
+
+    def get_status(self, status_id: int) -> SimpleNamespace:
+        self._call('get_status')
+        return next(mention for mention in self.mentions if mention.id == status_id)
+
+    def get_user(self, user_id: int) -> SimpleNamespace:
+        self._call('get_user')
+        return SimpleNamespace(screen_name=f'user{user_id}')
+
+    def update_status(self, status: str, in_reply_to_status_id: Optional[int] = None, **kwargs) -> None:
+        self._call('update_status')
+
+
+def _page_all(method: Callable, **kwargs) -> List:
+    # Page by page until an empty one, like tweepy.Cursor does for these methods
+    results, page = [], 1
+    while True:
+        items = method(page=page, **kwargs)
+        if len(items) == 0:
+            return results
+        results.extend(items)
+        page += 1
+
+
+def _old_wakeup(api: _FakeAPI, tweeting_now: bool, now: datetime) -> None:
+    # How the tweet command used to talk to Twitter
+    liked_ids = set(tweet.id for tweet in _page_all(api.favorites))
+
+    mentions, max_id = [], None
+    while True:
+        page = api.mentions_timeline(max_id=max_id)
+        if len(page) == 0:
+            break
+        mentions.extend(page)
+        max_id = min(tweet.id for tweet in page) - 1
+    mention_ids = set(tweet.id for tweet in mentions if tweet.created_at > now - timedelta(days=1))
+
+    for tweet_id in mention_ids - liked_ids:
+        api.create_favorite(tweet_id)
+        user_to_reply_to = api.get_status(tweet_id).author.screen_name
+        api.update_status(f'@{user_to_reply_to} covfefe', tweet_id, auto_populate_reply_metadata=True)
+
+    if tweeting_now:
+        following_ids = set(_page_ids_all(api.friends_ids))
+        follower_ids = list(_page_ids_all(api.followers_ids))
+        api.get_user(user_id=random.choices(follower_ids,
+                                            [3 if user_id in following_ids else 1 for user_id in follower_ids])[0])
+        api.update_status('covfefe')
+
+
+def _page_ids_all(method: Callable) -> Set[int]:
+    ids, cursor = [], -1
+    while cursor != 0:
+        page, (_, cursor) = method(cursor=cursor)
+        ids.extend(page)
+    return set(ids)
+
+
+def _new_wakeup(api: _FakeAPI, state: TwitterState, tweeting_now: bool) -> None:
+    tweets_to_reply_to = get_tweets_to_reply_to(api, state)
+    post_reply_tweets(api, state, [('covfefe', tweet_id, author) for tweet_id, author in tweets_to_reply_to])
+    if tweeting_now:
+        get_random_follower(api, state)
+        post_tweet(api, 'covfefe')
+
+
+def _simulate(wakeup: Callable[[_FakeAPI, bool, datetime], None], args: Dict) -> None:
+    api = _FakeAPI(args['followers'], args['friends'], args['old_likes'], args['latency'], args['seed'])
+    rng = random.Random(args['seed'])
+    for _ in range(args['old_mentions']):
+        api.add_mention(datetime.utcnow() - timedelta(days=rng.uniform(1, 30)))
+    for mention in api.mentions:
+        mention.favorited = True
+
+    elapsed = []
+    for _ in range(args['wakeups']):
+        now = datetime.utcnow()
+        for _ in range(rng.choices([0, 1, 2, 5], [0.7, 0.15, 0.1, 0.05])[0]):
+            api.add_mention(now)
+
+        start = time.perf_counter()
+        wakeup(api, rng.random() < args['tweet_probability'], now)
+        elapsed.append(time.perf_counter() - start)
+
+    num_calls = sum(api.calls.values())
+    print(f'  {num_calls / args["wakeups"]:7.1f} calls/wakeup, {sum(elapsed) / len(elapsed):6.3f}s/wakeup, '
+          f'{max(elapsed):6.3f}s worst')
+    print('  ' + ', '.join(f'{name}: {count}' for name, count in api.calls.most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Twitter API calls per wakeup benchmark')
+    parser.add_argument('--wakeups', type=int, default=144)  # A day at one every ten minutes
+    parser.add_argument('--followers', type=int, default=20000)
+    parser.add_argument('--friends', type=int, default=500)
+    parser.add_argument('--old-likes', type=int, default=2000)
+    parser.add_argument('--old-mentions', type=int, default=500)
+    parser.add_argument('--tweet-probability', type=float, default=2.5 / 144)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    print('old:')
+    _simulate(lambda api, tweeting_now, now: _old_wakeup(api, tweeting_now, now), args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        with TwitterState(os.path.join(directory, 'twitter_state.sqlite3')) as state:
+            print('new:')
+            _simulate(lambda api, tweeting_now, now: _new_wakeup(api, state, tweeting_now), args)
+
+
+if __name__ == '__main__':
+    main()
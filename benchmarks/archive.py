@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Reading a synthetic tweet dump as ndjson against reading the same tweets from a TweetArchive, for the ways the CLI
+# reads it: opening it to find the newest tweet (update), reading the usable tweets (train), and reading everything.
+# Peak memory is what tracemalloc sees, which leaves out the archive's mapped files since those are paged in by the OS
+# Usage: python3 -m benchmarks.archive --lines 60000
+import argparse
+import os
+import tempfile
+import tracemalloc
+from timeit import default_timer as timer
+from typing import Callable, Tuple
+
+import ndjson
+
+from benchmarks.ingestion import _write_synthetic_dump
+from namedtuples.Tweet import tweet_json_decode_hook
+from utils.TweetArchive import ARCHIVE_SUFFIX
+from utils.TweetDump import copy_tweets, read_last_tweet, read_tweets
+
+
+def _measure(function: Callable[[], object]) -> Tuple[object, float, int]:
+    tracemalloc.start()
+    start = timer()
+    result = function()
+    elapsed = timer() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak_bytes
+
+
+def _load_all_ndjson(filename: str) -> int:
+    # How train and update used to read the dump
+    with open(filename, 'r') as fp:
+        return len(ndjson.load(fp, object_hook=tweet_json_decode_hook))
+
+
+def _get_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tweet archive benchmark')
+    parser.add_argument('--lines', type=int, default=60000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ndjson_filename = os.path.join(temp_dir, 'tweets.ndjson')
+        archive_filename = os.path.join(temp_dir, f'tweets{ARCHIVE_SUFFIX}')
+        _write_synthetic_dump(ndjson_filename, args['lines'], args['seed'])
+
+        start = timer()
+        copy_tweets(ndjson_filename, archive_filename)
+        print(f'{args["lines"]} tweets. ndjson: {_get_size(ndjson_filename) / 2 ** 20:.1f}MB, '
+              f'archive: {_get_size(archive_filename) / 2 ** 20:.1f}MB (imported in {timer() - start:.2f}s)')
+        print()
+
+        runs = [
+            ('load all (ndjson.load)', lambda: _load_all_ndjson(ndjson_filename), None),
+            ('newest tweet', lambda: read_last_tweet(ndjson_filename), lambda: read_last_tweet(archive_filename)),
+            ('usable tweets', lambda: list(read_tweets(ndjson_filename, only_usable=True)),
+             lambda: list(read_tweets(archive_filename, only_usable=True))),
+            ('all tweets', lambda: list(read_tweets(ndjson_filename)), lambda: list(read_tweets(archive_filename))),
+        ]
+        for name, read_ndjson, read_archive in runs:
+            ndjson_result, ndjson_time, ndjson_peak = _measure(read_ndjson)
+            line = f'{name:24} ndjson: {ndjson_time:7.3f}s {ndjson_peak / 2 ** 20:7.1f}MB'
+            if read_archive is not None:
+                archive_result, archive_time, archive_peak = _measure(read_archive)
+                line += f'   archive: {archive_time:7.3f}s {archive_peak / 2 ** 20:7.1f}MB' \
+                        f'   {ndjson_time / archive_time:5.1f}x'
+                if archive_result != ndjson_result:
+                    print(f'{name}: the archive and the ndjson dump disagree!')
+                    exit(1)
+            print(line)
+
+        exported_filename = os.path.join(temp_dir, 'exported.ndjson')
+        copy_tweets(archive_filename, exported_filename)
+        if list(read_tweets(exported_filename)) != list(read_tweets(ndjson_filename)):
+            print('Exporting the archive back to ndjson changed it!')
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Training throughput of the old per-order ngram counting against the single-pass and sharded counting, on synthetic
+# tokenized tweets
+# Usage: python3 -m benchmarks.counting --tweets 40000 --processes 4
+import argparse
+import random
+from timeit import default_timer as timer
+from typing import Callable, List
+
+from namedtuples.Token import Token
+from utils.CompactWeights import CompactWeights
+from utils.Model import Model
+
+
+def _synthetic_tokenized_tweets(num_tweets: int, vocabulary_size: int, seed: int) -> List[List[Token]]:
+    rng = random.Random(seed)
+    vocabulary = [Token(f'word{i}', 'NN') for i in range(vocabulary_size)]
+    # Zipf-ish, so that low-order contexts have lots of successors like real text does
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    return [rng.choices(vocabulary, weights, k=rng.randint(3, 50)) for _ in range(num_tweets)]
+
+
+def _count_per_order(weights: CompactWeights, tweets: List[List[Token]], min_n: int, max_n: int) -> None:
+    # How Model.partial_fit used to count: one pass over every tweet for each order
+    for n in range(min_n, max_n + 1):
+        for tweet in tweets:
+            for n_plus_one_gram in Model._to_ngrams(tweet, n + 1):
+                weights.add(n_plus_one_gram[:-1], n_plus_one_gram[-1])
+
+
+def _time(count: Callable[[CompactWeights], None]) -> float:
+    weights = CompactWeights()
+    start = timer()
+    count(weights)
+    weights.freeze()
+    return timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ngram counting throughput benchmark')
+    parser.add_argument('--tweets', type=int, default=40000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    min_n, max_n = args['min_ngram_length'], args['max_ngram_length']
+    tweets = _synthetic_tokenized_tweets(args['tweets'], args['vocabulary'], args['seed'])
+    num_tokens = sum(len(tweet) for tweet in tweets)
+
+    runs = [
+        ('per order', lambda weights: _count_per_order(weights, tweets, min_n, max_n)),
+        ('single pass', lambda weights: weights.add_sequences(tweets, min_n, max_n, 1)),
+        (f'sharded x{args["processes"]}',
+         lambda weights: weights.add_sequences(tweets, min_n, max_n, args['processes'])),
+    ]
+
+    print(f'Tweets: {len(tweets)}, Tokens: {num_tokens}')
+    for name, count in runs:
+        elapsed = _time(count)
+        print(f'{name:12} {elapsed:7.2f}s  {num_tokens / elapsed:10.0f} tokens/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# What a wakeup costs when cron starts a new process for it, against one in the serve command's process, which keeps
+# the model loaded. Both run against benchmarks.api_calls' stand-in for Twitter, on a model fit to synthetic tweets.
+# Also times reloading the model after train replaces it, and checks that serve replies to every mention, picks up a
+# new model and stops promptly once asked to
+# Usage: python3 -m benchmarks.daemon --wakeups 20
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from timeit import default_timer as timer
+from typing import Dict, List
+
+from benchmarks.api_calls import _FakeAPI
+from benchmarks.counting import _synthetic_tokenized_tweets
+from utils.Model import Model
+from utils.ModelFile import ResidentModel, save_model
+
+_COLD_WAKEUP = '''
+import sys
+from benchmarks.api_calls import _FakeAPI
+from DonaldTrumBot import _wake_up
+from utils.ModelFile import load_model
+from utils.TwitterState import TwitterState
+
+args = {'model_file': sys.argv[1], 'queue_file': sys.argv[2], 'twitter_state_file': sys.argv[3],
+        'queue_size': int(sys.argv[4])}
+with TwitterState(args['twitter_state_file']) as state:
+    _wake_up(_FakeAPI(100, 10, 0, 0, 0), state, args, True, lambda: load_model(args['model_file']))
+'''
+
+
+def _train(filename: str, num_tweets: int, seed: int) -> None:
+    model = Model(2, 10)
+    model.fit_tokenized(_synthetic_tokenized_tweets(num_tweets, 5000, seed), processes=1)
+    save_model(model, filename)
+
+
+def _get_args(directory: str) -> Dict:
+    return {'model_file': os.path.join(directory, 'model.bin'), 'queue_file': os.path.join(directory, 'queue.sqlite3'),
+            'twitter_state_file': os.path.join(directory, 'twitter_state.sqlite3'), 'queue_size': 50,
+            'min_between_wakeups': 0.001, 'target_avg_tweets_per_day': 24 * 60 * 60 * 10, 'poisson': True}
+
+
+def _time_cold_wakeups(args: Dict, wakeups: int) -> List[float]:
+    times = []
+    for _ in range(wakeups):
+        start = timer()
+        subprocess.run([sys.executable, '-c', _COLD_WAKEUP, args['model_file'], args['queue_file'],
+                        args['twitter_state_file'], str(args['queue_size'])], check=True, stdout=subprocess.DEVNULL,
+                       env=dict(os.environ, PYTHONPATH=os.getcwd()))
+        times.append(timer() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Daemon vs cron wakeup benchmark')
+    parser.add_argument('--wakeups', type=int, default=20)
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    from DonaldTrumBot import _serve, _top_up_tweet_queue, _wake_up
+    from utils.TwitterState import TwitterState
+
+    with tempfile.TemporaryDirectory() as directory:
+        bot_args = _get_args(directory)
+        _train(bot_args['model_file'], args['tweets'], args['seed'])
+
+        for name, queue_size in (('queue full', 50), ('queue empty', 0)):
+            bot_args['queue_size'] = queue_size
+            model = ResidentModel(bot_args['model_file'])
+            with redirect_stdout(io.StringIO()):  # Leaves out what topping up the queue prints
+                _top_up_tweet_queue(bot_args, model.get)
+
+            cold_times = _time_cold_wakeups(bot_args, args['wakeups'])
+
+            warm_times = []
+            with TwitterState(bot_args['twitter_state_file']) as state, redirect_stdout(io.StringIO()):
+                api = _FakeAPI(100, 10, 0, 0, 0)
+                for _ in range(args['wakeups']):
+                    start = timer()
+                    _wake_up(api, state, bot_args, True, model.get)
+                    warm_times.append(timer() - start)
+                    _top_up_tweet_queue(bot_args, model.get)  # Between wakeups, so not timed
+
+            print(f'{name:12} cron: {statistics.median(cold_times) * 1e3:7.1f}ms/wakeup   '
+                  f'serve: {statistics.median(warm_times) * 1e3:7.1f}ms/wakeup   '
+                  f'{statistics.median(cold_times) / statistics.median(warm_times):5.1f}x')
+
+        # A new model file, as train would write it
+        old_model = model.get()
+        _train(bot_args['model_file'], args['tweets'], args['seed'] + 1)
+        start = timer()
+        reloaded = model.get() is not old_model
+        print(f'Reloading the model after train replaced it: {(timer() - start) * 1e3:.1f}ms')
+
+        # serve itself, tweeting on every wakeup and with mentions coming in while it runs
+        bot_args['queue_size'] = 50
+        api = _FakeAPI(100, 10, 0, 0, 0)
+        stopping = threading.Event()
+        num_wakeups = []
+        with redirect_stdout(io.StringIO()):
+            server = threading.Thread(target=lambda: num_wakeups.append(_serve(api, bot_args, stopping)))
+            server.start()
+            for _ in range(5):
+                api.add_mention(datetime.utcnow())
+                time.sleep(0.2)
+
+            start = timer()
+            stopping.set()
+            server.join()
+        print(f'serve: {num_wakeups[0]} wakeups, stopped {(timer() - start) * 1e3:.1f}ms after being asked to')
+
+        unreplied = [mention.id for mention in api.mentions if not mention.favorited]
+        if len(unreplied) > 0 or not reloaded:
+            print(f'serve missed mentions {unreplied} or kept the old model!')
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
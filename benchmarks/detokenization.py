@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Checks TweetBuilder._join_tokens against a golden corpus of outputs from the old implementation, and times the two.
+# Both run the same str.replace() chain. The only difference is that _join_tokens fixes up quotes and parentheses in a
+# loop instead of recursing, so what's being measured is the recursion: about the same speed on tweet-sized input, and
+# no RecursionError on input with thousands of quotes. The corpus is random token sequences biased heavily towards the
+# punctuation, quotes and special cases the chain has rules for. Inputs where a closing parenthesis comes before an
+# opening one are left out, since the old implementation duplicated chunks of the tweet for those
+# Usage: python3 -m benchmarks.detokenization [--write-golden]
+import argparse
+import json
+import random
+import sys
+from timeit import default_timer as timer
+from typing import Iterable, List, Tuple
+
+from namedtuples.Token import Token
+from utils.TweetBuilder import _join_tokens
+
+_GOLDEN_FILE = 'benchmarks/data/detokenizer_golden.ndjson'
+
+_WORDS = ['the', 'great', 'America', 'is', 'win', 'new', 'w', 'MS', 'DMS', 'Trump', 'very', 'fake', 'news', 'do', 'it',
+          'people', '13', '100', '2016', 'https', 'http', '//t.co/abc', '//bit.ly/x', 'amp', '&', 'and']
+_PUNCTUATION = [',', '.', '!', '?', ':', ';', '...', '…', '-', '--', '/', '@', '#', '$', '%', "n't", "'s", "'re", "'ll",
+                "'m", "'ve", "'", '’', '‘', '“', '”', '``', "''", '(', ')', "'t", '08', '0', '.@']
+_SNIPPETS = [['``', 'W', 'W', "''"], ['(', 'W', ')'], ['(', 'W', 'W', ')'], ['@', 'W'], ['#', 'W'], ['$', '100'],
+             ['100', '%'], ['https', ':', '//t.co/abc'], ['http', ':', '//x.co'], ['&', 'amp', ';'], ['do', "n't"],
+             ['W', "'s"], ['MS', '-', '13'], ['w', '/', 'W'], ['W', '/', 'W'], ['“', 'W', '”'], ["'", 's'],
+             ["'", '08'], ['’', 'W', '’'], ['W', '.', '@', 'W'], ['W', '-', '-', 'W']]
+
+
+def _old_fix_quotes(s: str) -> str:
+    first_quote_index = s.find('"')
+    second_quote_index = s.find('"', first_quote_index + 1)
+
+    if second_quote_index == -1:
+        return s.replace(' " ', ' ')
+    else:
+        head = s[:second_quote_index + 2]
+        fixed_head = head.replace(' " ', ' "', 1).replace(' " ', '" ', 1)
+        return f'{fixed_head}{_old_fix_quotes(s[second_quote_index + 2:])}'
+
+
+def _old_fix_parenthesis(s: str) -> str:
+    first_opener_index = s.find('(')
+    first_closer_index = s.find(')')
+
+    if first_opener_index == -1:
+        return s.replace(')', ' ')
+    elif first_closer_index == -1:
+        return s.replace('(', ' ')
+    else:
+        up_to_first_opener = s[:first_opener_index].strip()
+        between_parenthesis = s[first_opener_index + 1:first_closer_index].strip()
+        after_first_closer = s[first_closer_index + 1:].strip()
+        return f'{up_to_first_opener} ({_old_fix_parenthesis(between_parenthesis)}) ' \
+               f'{_old_fix_parenthesis(after_first_closer)}'
+
+
+def _old_join_tokens(tokens: Iterable[Token]) -> str:
+    # TweetBuilder._join_tokens with the recursive quote and parenthesis fixes
+    output = ' '.join(token.word for token in tokens)
+
+    replacements = [
+        (' ,', ','), (' .', '.'), (' ?', '?'), (' !', '!'), (' :', ':'), (' ;', ';'), ('... ', '...'), (' …', '…'),
+        ('. @', '.@'), ('@ ', '@'), ('- -', '--'), ('$ ', '$'), (' %', '%'), ('MS - 13', 'MS-13'),
+        ('# ', '#'), ('w /', 'w/'), (' / ', '/'), ('“', '"'), ('”', '"'), ('``', '"'), ("''", '"'), ('‘', "'"),
+        ('’', "'"), (" n't", "n't"), (" 't", "'t"), (" ' t", "'t"), (" 's", "'s"), (" ' s", "'s"), (" 'v", "'v"),
+        (" ' v", "'v"), (" 'm", "'m"), (" 're", "'re"), (" ' re", "'re"), (" 'll", "'ll"), ("' 0", "'0"),
+        ('https: //', 'https://'), ('http: //', 'http://'), ('& amp;', '&'), (" ' ", ' " '),
+    ]
+    for replacement_pair in replacements:
+        output = output.replace(*replacement_pair)
+
+    output = _old_fix_quotes(output)
+    output = _old_fix_parenthesis(output)
+    output = output.replace('   ', ' ')
+    output = output.replace('  ', ' ')
+    return output.strip()
+
+
+def _has_reversed_parentheses(words: List[str]) -> bool:
+    position = 0
+    while True:
+        opener = next((i for i in range(position, len(words)) if words[i] == '('), None)
+        closer = next((i for i in range(position, len(words)) if words[i] == ')'), None)
+        if opener is None or closer is None:
+            return False
+        elif closer < opener:
+            return True
+        position = closer + 1
+
+
+def _random_words(rng: random.Random, max_length: int, special_rate: float = None) -> List[str]:
+    special_rate = special_rate if special_rate is not None else rng.choice([0.1, 0.3, 0.6])
+    words = []
+    for _ in range(rng.randint(1, max_length)):
+        r = rng.random()
+        if r < special_rate / 2:
+            words.extend(rng.choice(_WORDS) if word == 'W' else word for word in rng.choice(_SNIPPETS))
+        elif r < special_rate:
+            words.append(rng.choice(_PUNCTUATION))
+        else:
+            words.append(rng.choice(_WORDS))
+    return words
+
+
+def _to_tokens(words: List[str]) -> List[Token]:
+    return [Token(word, 'NN') for word in words]
+
+
+def _write_golden(num_cases: int, seed: int) -> None:
+    rng = random.Random(seed)
+    with open(_GOLDEN_FILE, 'w') as fp:
+        written = 0
+        while written < num_cases:
+            words = _random_words(rng, 40)
+            if not _has_reversed_parentheses(words):
+                fp.write(json.dumps({'words': words, 'expected': _old_join_tokens(_to_tokens(words))}) + '\n')
+                written += 1
+
+
+def _read_golden() -> List[Tuple[List[Token], str]]:
+    with open(_GOLDEN_FILE, 'r') as fp:
+        cases = (json.loads(line) for line in fp if line.strip() != '')
+        return [(_to_tokens(case['words']), case['expected']) for case in cases]
+
+
+def _throughput(join_tokens, token_lists: List[List[Token]], repeats: int) -> str:
+    try:
+        start = timer()
+        for _ in range(repeats):
+            for tokens in token_lists:
+                join_tokens(tokens)
+        return f'{sum(len(tokens) for tokens in token_lists) * repeats / (timer() - start):10.0f} tokens/s'
+    except RecursionError:
+        return f'{"RecursionError":>19}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Detokenizer golden corpus check and throughput benchmark')
+    parser.add_argument('--write-golden', action='store_true')  # Regenerates the corpus from the old implementation
+    parser.add_argument('--cases', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    if args['write_golden']:
+        _write_golden(args['cases'], args['seed'])
+
+    golden = _read_golden()
+    mismatches = [(tokens, expected) for tokens, expected in golden if _join_tokens(tokens) != expected]
+    print(f'Golden corpus: {len(golden) - len(mismatches)}/{len(golden)} match')
+    for tokens, expected in mismatches[:5]:
+        print(f'  {" ".join(token.word for token in tokens)!r}\n    expected {expected!r}\n    got      '
+              f'{_join_tokens(tokens)!r}')
+
+    # Tweet-sized token lists with about as much punctuation as real tweets, much longer ones, and ones with enough
+    # quotes for the recursion to hit the limit
+    rng = random.Random(args['seed'])
+    cases = [
+        ('tweet sized', [_to_tokens(_random_words(rng, 80, 0.15)) for _ in range(500)], args['repeats']),
+        ('long', [_to_tokens(_random_words(rng, 2000, 0.15)) for _ in range(20)], args['repeats']),
+        ('many quotes', [_to_tokens(['a', '``', 'b', "''"] * 2000)], 1),
+    ]
+    for name, token_lists, repeats in cases:
+        print(f'{name:12} recursive: {_throughput(_old_join_tokens, token_lists, repeats)}  '
+              f'iterative: {_throughput(_join_tokens, token_lists, repeats)}')
+
+    if len(mismatches) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Checks that every backend gives each context the same next token distribution as the dict backend, on synthetic
+# tokenized tweets. Predictions draw from Beta(3, 1) and pick the first successor whose cumulative probability is at
+# least the draw, so the order equally common successors are in decides how likely each of them is, and matching counts
+# aren't enough. Compares the exact probability of every successor of every context, for compact weights fit in one
+# process, in several, and a part at a time, and for indexed weights
+# Usage: python3 -m benchmarks.distributions --tweets 2000 --processes 4
+import argparse
+from typing import Dict, List, Sequence, Tuple
+
+from benchmarks.counting import _synthetic_tokenized_tweets
+from namedtuples.Token import Token
+from namedtuples.TokenProbability import TokenProbability
+from utils.CompactWeights import CompactWeights
+from utils.Model import LazyFitModel, Model, _Weights
+
+_NGram = Tuple[Token, ...]
+_TOLERANCE = 1e-9
+
+
+def _draw_probabilities(successors: Sequence[TokenProbability]) -> Dict[Token, float]:
+    # How likely each successor is to be predicted, given them in the order predictions go through them. The CDF of
+    # Beta(3, 1) is x ** 3
+    probabilities, cumulative = {}, 0.0
+    for token, probability in successors:
+        probabilities[token] = (cumulative + probability) ** 3 - cumulative ** 3
+        cumulative += probability
+    return probabilities
+
+
+def _in_prediction_order(successors: List[TokenProbability]) -> List[TokenProbability]:
+    # What Model.predict_next_token does with get_successor_probabilities when it isn't frozen
+    return list(sorted(successors, key=lambda successor: successor.probability))
+
+
+def _compact_successors(weights: CompactWeights, ngram: _NGram) -> List[TokenProbability]:
+    # A frozen row is already in the order predictions go through it
+    successor_ids, counts = weights._get_successors(weights._find_node(ngram))
+    total_count = int(counts.sum())
+    return [TokenProbability(weights.vocabulary.get_token(int(successor_id)), int(count) / total_count)
+            for successor_id, count in zip(successor_ids, counts)]
+
+
+def _total_variation(a: Dict[Token, float], b: Dict[Token, float]) -> float:
+    return sum(abs(a.get(token, 0.0) - b.get(token, 0.0)) for token in a.keys() | b.keys()) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Next token distribution check against the dict backend')
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--vocabulary', type=int, default=500)  # Small, so there are lots of equally common successors
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=6)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    min_n, max_n = args['min_ngram_length'], args['max_ngram_length']
+    tweets = _synthetic_tokenized_tweets(args['tweets'], args['vocabulary'], args['seed'])
+    halfway = len(tweets) // 2
+
+    expected_weights = _Weights()
+    expected_weights.add_sequences(tweets, min_n, max_n)
+    contexts = list(expected_weights._counts.keys())
+    expected = [_draw_probabilities(_in_prediction_order(expected_weights.get_successor_probabilities(context)))
+                for context in contexts]
+    print(f'Tweets: {len(tweets)}, Contexts: {len(contexts)}')
+
+    models = []
+    for name, processes in (('compact', 1), (f'compact x{args["processes"]}', args['processes'])):
+        model = Model(min_n, max_n)
+        model.fit_tokenized(tweets, processes)
+        models.append((name, model))
+
+        model = Model(min_n, max_n)
+        model.fit_tokenized(tweets[:halfway], processes)
+        model.partial_fit_tokenized(tweets[halfway:], processes)
+        models.append((f'{name} in parts', model))
+
+    lazy_model = LazyFitModel(min_n, max_n)
+    lazy_model.fit_tokenized(tweets)
+    models.append(('indexed', lazy_model))
+
+    different = []
+    for name, model in models:
+        if isinstance(model._weights, CompactWeights):
+            actual = [_draw_probabilities(_compact_successors(model._weights, context)) for context in contexts]
+        else:
+            actual = [_draw_probabilities(_in_prediction_order(model._weights.get_successor_probabilities(context)))
+                      for context in contexts]
+
+        distances = [_total_variation(a, b) for a, b in zip(expected, actual)]
+        num_different = sum(distance > _TOLERANCE for distance in distances)
+        print(f'{name:20} {num_different:8} contexts differ  mean TV {sum(distances) / len(distances):.6f}  '
+              f'max TV {max(distances):.6f}')
+        if num_different > 0:
+            different.append(name)
+
+    if len(different) > 0:
+        print(f'{", ".join(different)} predicted differently from the dict backend!')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Downloads a synthetic archive from a local stand-in for trumptwitterarchive.com, the old way (one year after another,
+# a new connection each time, every year in full) against utils.TweetDownloader. The stand-in sends ETag and
+# Last-Modified headers, answers conditional requests with 304s, redirects years it doesn't have to an HTML homepage
+# like the real site does, and waits --latency seconds before each response. Also checks that both dumps match
+# Usage: python3 -m benchmarks.downloading --tweets-per-year 5000
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer as timer
+from typing import Callable, Dict, List
+
+import ndjson
+import requests
+
+import utils.TweetDownloader as TweetDownloader
+from namedtuples.Tweet import Tweet, encode_tweet_for_json, tweet_json_decode_hook
+from utils.TweetDump import read_tweets
+
+_HOMEPAGE = b'<!DOCTYPE html><html><body>Trump Twitter Archive</body></html>'
+
+
+def _synthetic_archive(first_year: int, last_year: int, tweets_per_year: int, seed: int) -> Dict[int, bytes]:
+    rng = random.Random(seed)
+    words = [f'word{i}' for i in range(2000)]
+    archive = {}
+    for year in range(first_year, last_year + 1):
+        start = datetime(year, 1, 1, tzinfo=timezone.utc)
+        tweets = [Tweet(int(f'{year}{i:07}'), ' '.join(rng.choices(words, k=rng.randint(5, 40))), 'Twitter for iPhone',
+                        start + timedelta(minutes=i), False)
+                  for i in range(tweets_per_year)]
+        rng.shuffle(tweets)  # The archive isn't sorted
+        archive[year] = json.dumps([encode_tweet_for_json(tweet) for tweet in tweets]).encode('utf-8')
+    return archive
+
+
+def _start_server(archive: Dict[int, bytes], latency: float) -> ThreadingHTTPServer:
+    last_modified = 'Wed, 01 Jan 2020 00:00:00 GMT'
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            year = self.path.rsplit('/', 1)[-1][:-len('.json')] if self.path.endswith('.json') else ''
+            if not year.isdigit() or int(year) not in archive:
+                if self.path == '/':
+                    self._respond(200, 'text/html', _HOMEPAGE)
+                else:
+                    self.send_response(302)
+                    self.send_header('Location', '/')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                return
+
+            etag = f'"{year}-{len(archive[int(year)])}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+            else:
+                self._respond(200, 'application/json', archive[int(year)], {'ETag': etag,
+                                                                            'Last-Modified': last_modified})
+
+        def _respond(self, status: int, content_type: str, body: bytes, headers: Dict[str, str] = None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _old_full_dump(output_file: str, first_year: int) -> None:
+    # How TweetDownloader used to download everything
+    all_tweets: List[Tweet] = []
+    year = first_year
+    while True:
+        response = requests.get(TweetDownloader._ARCHIVE_URL.format(year=year))
+        if response.text.startswith('<!DOCTYPE html>'):
+            break
+        all_tweets.extend(sorted(response.json(object_hook=tweet_json_decode_hook), key=lambda tw: tw.id))
+        year += 1
+
+    with open(output_file, 'w') as fp:
+        ndjson.dump((encode_tweet_for_json(tweet) for tweet in sorted(all_tweets, key=lambda tw: tw.id)), fp)
+
+
+def _time(run: Callable[[], None]) -> float:
+    start = timer()
+    run()
+    return timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive downloading benchmark')
+    parser.add_argument('--first-year', type=int, default=2009)
+    parser.add_argument('--last-year', type=int, default=2020)
+    parser.add_argument('--tweets-per-year', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    archive = _synthetic_archive(args['first_year'], args['last_year'], args['tweets_per_year'], args['seed'])
+    server = _start_server(archive, args['latency'])
+    TweetDownloader._ARCHIVE_URL = f'http://127.0.0.1:{server.server_port}/data/realdonaldtrump/{{year}}.json'
+    TweetDownloader._FIRST_YEAR = args['first_year']
+
+    with tempfile.TemporaryDirectory() as directory:
+        old_dump, new_dump = os.path.join(directory, 'old.ndjson'), os.path.join(directory, 'new.ndjson')
+        validators_file = os.path.join(directory, 'download_state.json')
+
+        print(f'Archive: {len(archive)} years, {sum(map(len, archive.values())) / 1e6:.1f}MB')
+        print(f'old full dump:    {_time(lambda: _old_full_dump(old_dump, args["first_year"])):6.2f}s')
+        print(f'new full dump:    {_time(lambda: TweetDownloader.full_dump(new_dump, validators_file)):6.2f}s')
+
+        def update() -> None:
+            TweetDownloader.add_new_tweets_to_dump(new_dump, validators_file)
+
+        print(f'new update:       {_time(update):6.2f}s  (unchanged years answered with 304s)')
+        os.remove(validators_file)
+        print(f'new update, cold: {_time(update):6.2f}s  (no saved validators)')
+
+        if list(read_tweets(old_dump)) != list(read_tweets(new_dump)):
+            print('Dumps differ!')
+            exit(1)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Filtering the tweet dump one tweet at a time with should_use_tweet (as it was, re-parsing its dates and recompiling
+# its regex on every call, and as it is now) against find_usable_tweets over a TweetColumns, and checks that all three
+# keep exactly the same tweets. Uses the real dump if there is one, and a synthetic one with every kind of tweet the
+# tests look for otherwise
+# Usage: python3 -m benchmarks.filtering --tweet_file data/trump_tweets.ndjson
+import argparse
+import os
+import random
+import re
+from datetime import datetime, timedelta, timezone
+from timeit import default_timer as timer
+from typing import Callable, List, TypeVar
+
+import numpy as np
+
+from namedtuples.Tweet import Tweet
+from namedtuples.TweetColumns import tweets_to_columns
+from utils.TweetDump import read_tweets
+from utils.TweetValidator import find_usable_tweets, should_use_tweet
+
+_T = TypeVar('_T')
+
+_SOURCES = ('Twitter for iPhone', 'Twitter for Android', 'Twitter Web Client', 'TweetDeck', 'Twitter Media Studio')
+_TEXT_STARTS = ('', '', '', '"', '“', 'Via @Someone ', '@someone ', 'http://t.co/abc', '|"Quoted" - ')
+_TEXT_ENDS = ('', '', '', ' - Albert Einstein', ' Emerson', '" - ', '”\n- someone')
+
+
+def _synthetic_tweets(num_tweets: int, seed: int) -> List[Tweet]:
+    rng = random.Random(seed)
+    start = datetime(2009, 5, 1, tzinfo=timezone.utc)
+    tweets = []
+    for i in range(num_tweets):
+        words = ' '.join(f'word{rng.randint(0, 5000)}' for _ in range(rng.choice([0, 1, 3, 4, 5, 20, 40])))
+        text = f'{rng.choice(_TEXT_STARTS)}{words}{rng.choice(_TEXT_ENDS)}'
+        created_at = start + timedelta(minutes=rng.randint(0, 11 * 365 * 24 * 60))
+        tweets.append(Tweet(i + 1, text, rng.choice(_SOURCES), created_at, rng.random() < 0.1))
+    return tweets
+
+
+def _old_should_use_tweet(tweet: Tweet) -> bool:
+    # How TweetValidator's tests used to be written
+    def not_from_trump_device() -> bool:
+        if tweet.source in {'Twitter for Android', 'Twitter Web Client'}:
+            return False
+        elif tweet.source == 'Twitter for iPhone':
+            return tweet.created_at < datetime.strptime('Feb 01 2017 +0000', '%b %d %Y %z')
+        else:
+            return True
+
+    def is_quote() -> bool:
+        bad_starts = ('"', '“', 'Via @')
+        commonly_quoted = {'Albert Einstein', 'Aristotle', 'Benjamin Franklin', 'Emerson'}
+        return tweet.text.startswith(bad_starts) or any((person in tweet.text) for person in commonly_quoted) \
+            or (re.match(r'^[“|\"].*[”|\"]\s*[–|\-].*$', tweet.text) is not None)
+
+    return not (tweet.is_retweet or not_from_trump_device() or is_quote()
+                or (tweet.text.startswith('@') and len(tweet.text.split(' ')) <= 5)
+                or tweet.created_at < datetime.strptime('Jan 01 2011 +0000', '%b %d %Y %z')
+                or (len(tweet.text.split(' ')) == 1 and tweet.text.startswith('http')))
+
+
+def _time(function: Callable[[], _T], runs: int) -> (float, _T):
+    times = []
+    for _ in range(runs):
+        start = timer()
+        result = function()
+        times.append(timer() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tweet filtering benchmark')
+    parser.add_argument('--tweet_file', type=str, default='data/trump_tweets.ndjson')
+    parser.add_argument('--synthetic-tweets', type=int, default=60000)  # Only used if there's no tweet_file
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    if os.path.exists(args['tweet_file']):
+        tweets = list(read_tweets(args['tweet_file']))
+        print(f'{args["tweet_file"]}: {len(tweets)} tweets')
+    else:
+        tweets = _synthetic_tweets(args['synthetic_tweets'], args['seed'])
+        print(f'Synthetic dump: {len(tweets)} tweets')
+
+    old_time, old_mask = _time(lambda: np.array([_old_should_use_tweet(tweet) for tweet in tweets]), args['runs'])
+    scalar_time, scalar_mask = _time(lambda: np.array([should_use_tweet(tweet) for tweet in tweets]), args['runs'])
+    columns_time, columns = _time(lambda: tweets_to_columns(tweets), args['runs'])
+    masks_time, (mask, rejection_counts) = _time(lambda: find_usable_tweets(columns), args['runs'])
+
+    print(f'per tweet (old)     {old_time:7.3f}s')
+    print(f'per tweet           {scalar_time:7.3f}s  {old_time / scalar_time:5.1f}x')
+    print(f'columns             {masks_time:7.3f}s  {old_time / masks_time:5.1f}x  '
+          f'(+{columns_time:.3f}s to build them: {old_time / (masks_time + columns_time):.1f}x)')
+    print(f'Usable: {int(mask.sum())} of {len(tweets)}. Rejected by ' +
+          ', '.join(f'{name}: {count}' for name, count in rejection_counts.items()))
+
+    if not np.array_equal(old_mask, scalar_mask) or not np.array_equal(old_mask, mask):
+        print('Filters disagree!')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Generation throughput of one chain at a time against Model.generate_batch, on a model fit to synthetic tweets. Also
+# checks that the two are statistically equivalent, by comparing how far apart their token frequencies and chain lengths
+# are to how far apart two runs of the scalar path with different seeds are
+# Usage: python3 -m benchmarks.generation --chains 10000
+import argparse
+import random
+from collections import Counter
+from timeit import default_timer as timer
+from typing import List, Tuple
+
+import numpy as np
+
+from benchmarks.counting import _synthetic_tokenized_tweets
+from namedtuples.Token import Token
+from utils.Model import Model
+
+
+def _generate_scalar(model: Model, chains: int, n: int, seed: int) -> Tuple[float, List[List[Token]]]:
+    random.seed(seed)
+    np.random.seed(seed)
+    start = timer()
+    generated = [model.generate_tokens(n) for _ in range(chains)]
+    return timer() - start, generated
+
+
+def _generate_batch(model: Model, chains: int, n: int, seed: int) -> Tuple[float, List[List[Token]]]:
+    start = timer()
+    generated = model.generate_batch(chains, n, np.random.default_rng(seed))
+    return timer() - start, generated
+
+
+def _total_variation(a: Counter, b: Counter) -> float:
+    total_a, total_b = sum(a.values()), sum(b.values())
+    return sum(abs(a[key] / total_a - b[key] / total_b) for key in a.keys() | b.keys()) / 2
+
+
+def _distances(a: List[List[Token]], b: List[List[Token]]) -> Tuple[float, float]:
+    # Total variation distance between the token frequencies, and between the chain length distributions
+    token_distance = _total_variation(Counter(token for chain in a for token in chain),
+                                      Counter(token for chain in b for token in chain))
+    length_distance = _total_variation(Counter(len(chain) for chain in a), Counter(len(chain) for chain in b))
+    return token_distance, length_distance
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scalar vs batch generation benchmark')
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    parser.add_argument('--chains', type=int, default=10000)
+    parser.add_argument('--tokens', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    model = Model(args['min_ngram_length'], args['max_ngram_length'])
+    model.fit_tokenized(_synthetic_tokenized_tweets(args['tweets'], args['vocabulary'], args['seed']))
+
+    chains, n, seed = args['chains'], args['tokens'], args['seed']
+    scalar_time, scalar = _generate_scalar(model, chains, n, seed)
+    _, scalar_reference = _generate_scalar(model, chains, n, seed + 1)
+    batch_time, batch = _generate_batch(model, chains, n, seed)
+
+    for name, elapsed, generated in (('scalar', scalar_time, scalar), ('batch', batch_time, batch)):
+        num_tokens = sum(len(chain) for chain in generated)
+        print(f'{name:6} {elapsed:7.2f}s  {num_tokens / elapsed:10.0f} tokens/s  '
+              f'avg length: {num_tokens / len(generated):5.1f}')
+
+    print(f'Speedup: {scalar_time / batch_time:.1f}x')
+    print('Total variation distance (tokens, lengths):')
+    print('  scalar vs scalar: {:.4f}, {:.4f}'.format(*_distances(scalar, scalar_reference)))
+    print('  scalar vs batch:  {:.4f}, {:.4f}'.format(*_distances(scalar, batch)))
+
+
+if __name__ == '__main__':
+    main()
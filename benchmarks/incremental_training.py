@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Times a full retrain against the way train --incremental updates a saved model with only the newest tweets
+# (can_update_model and update_model_from_file), and checks that both models generate exactly the same tweets for the
+# same random seeds. Runs offline on a synthetic tweet dump, with the same nltk stand-in as benchmarks.suite
+# Usage: python3 -m benchmarks.incremental_training --tweets 20000 --new_tweets 50
+import argparse
+import os
+import random
+import tempfile
+from timeit import default_timer as timer
+from typing import List
+
+import numpy as np
+
+from benchmarks.suite import _install_offline_nltk, _synthetic_tweets
+from namedtuples.Token import Token
+from utils.Model import Model, can_update_model, train_model_from_file, update_model_from_file
+from utils.ModelFile import load_model, save_model
+from utils.TweetDump import write_tweets
+
+
+def _generate(model: Model, seed: int, chains: int) -> List[List[Token]]:
+    random.seed(seed)
+    np.random.seed(seed)
+    return [model.generate_tokens(80) for _ in range(chains)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental training benchmark and equivalence check')
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    parser.add_argument('--new_tweets', type=int, default=50)
+    parser.add_argument('--chains', type=int, default=1000)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    _install_offline_nltk()
+    min_n, max_n, jobs = args['min_ngram_length'], args['max_ngram_length'], args['jobs']
+    tweets = _synthetic_tweets(args['tweets'], args['vocabulary'], args['seed'])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        old_tweet_filename = os.path.join(temp_dir, 'old_tweets.ndjson')
+        tweet_filename = os.path.join(temp_dir, 'tweets.ndjson')
+        model_filename = os.path.join(temp_dir, 'model.bin')
+        write_tweets(old_tweet_filename, tweets[:-args['new_tweets']])
+        write_tweets(tweet_filename, tweets)
+
+        start = timer()
+        full_model = train_model_from_file(tweet_filename, min_n, max_n, False, processes=jobs)
+        full_time = timer() - start
+
+        save_model(train_model_from_file(old_tweet_filename, min_n, max_n, False, processes=jobs), model_filename)
+
+        # The same steps as train --incremental
+        start = timer()
+        updated_model = load_model(model_filename)
+        if not can_update_model(updated_model, min_n, max_n, False):
+            print("The saved model can't be updated!")
+            exit(1)
+        new_tweet_count = update_model_from_file(updated_model, tweet_filename, processes=jobs)
+        incremental_time = timer() - start
+
+        identical = all(_generate(full_model, seed, args['chains']) == _generate(updated_model, seed, args['chains'])
+                        for seed in range(5))
+
+    print(f'Full retrain:      {full_time:.2f}s')
+    print(f'Incremental train: {incremental_time:.2f}s ({new_tweet_count} new tweets)')
+    print(f'Identical output:  {identical}')
+    if not identical:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Compares loading the whole tweet dump against streaming it, and rewriting it against appending to it, on a synthetic
+# dump of configurable size
+# Usage: python3 -m benchmarks.ingestion --lines 2000000
+import argparse
+import json
+import os
+import random
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from timeit import default_timer as timer
+from typing import Callable, Tuple
+
+import ndjson
+
+from namedtuples.Tweet import Tweet, encode_tweet_for_json, tweet_json_decode_hook
+from utils.TweetDump import read_tweets, read_last_tweet, append_tweets
+from utils.TweetValidator import should_use_tweet
+
+_SOURCES = ('Twitter for iPhone', 'Twitter for Android', 'Twitter Web Client', 'TweetDeck')
+
+
+def _random_tweet(rng: random.Random, tweet_id: int, created_at: datetime) -> Tweet:
+    text = ' '.join(f'word{rng.randint(0, 5000)}' for _ in range(rng.randint(3, 40)))
+    return Tweet(tweet_id, text, rng.choice(_SOURCES), created_at, rng.random() < 0.1)
+
+
+def _write_synthetic_dump(filename: str, lines: int, seed: int) -> None:
+    rng = random.Random(seed)
+    start = datetime(2011, 1, 1, tzinfo=timezone.utc)
+    with open(filename, 'w') as fp:
+        for i in range(lines):
+            tweet = _random_tweet(rng, i + 1, start + timedelta(minutes=i))
+            fp.write(json.dumps(encode_tweet_for_json(tweet)))
+            fp.write('\n')
+
+
+def _measure(function: Callable[[], object]) -> Tuple[object, float, int]:
+    tracemalloc.start()
+    start = timer()
+    result = function()
+    elapsed = timer() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak_bytes
+
+
+def _load_and_filter(filename: str) -> int:
+    with open(filename, 'r') as fp:
+        tweets = ndjson.load(fp, object_hook=tweet_json_decode_hook)
+    return len([tweet for tweet in tweets if should_use_tweet(tweet)])
+
+
+def _load_and_rewrite(filename: str, new_tweets: int) -> None:
+    with open(filename, 'r') as fp:
+        tweets = ndjson.load(fp, object_hook=tweet_json_decode_hook)
+
+    rng = random.Random(0)
+    tweets.extend(_random_tweet(rng, tweets[-1].id + i + 1, tweets[-1].created_at) for i in range(new_tweets))
+    with open(filename, 'w') as fp:
+        ndjson.dump((encode_tweet_for_json(tweet) for tweet in tweets), fp)
+
+
+def _read_tail_and_append(filename: str, new_tweets: int) -> None:
+    last_tweet = read_last_tweet(filename)
+    rng = random.Random(0)
+    append_tweets(filename, (_random_tweet(rng, last_tweet.id + i + 1, last_tweet.created_at)
+                             for i in range(new_tweets)))
+
+
+def _print_result(name: str, elapsed: float, peak_bytes: int) -> None:
+    print(f'{name:28} {elapsed:8.2f}s  peak: {peak_bytes / 2 ** 20:8.1f}MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tweet dump ingestion benchmark')
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--new_tweets', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'tweets.ndjson')
+        _write_synthetic_dump(filename, args['lines'], args['seed'])
+        print(f'Synthetic dump: {args["lines"]} lines, {os.path.getsize(filename) / 2 ** 20:.1f}MB')
+        print()
+
+        loaded_count, elapsed, peak_bytes = _measure(lambda: _load_and_filter(filename))
+        _print_result('train read (load all)', elapsed, peak_bytes)
+
+        streamed_count, elapsed, peak_bytes = _measure(lambda: sum(1 for _ in read_tweets(filename, True)))
+        _print_result('train read (streaming)', elapsed, peak_bytes)
+        assert loaded_count == streamed_count
+
+        _, elapsed, peak_bytes = _measure(lambda: _load_and_rewrite(filename, args['new_tweets']))
+        _print_result('update (load and rewrite)', elapsed, peak_bytes)
+
+        _, elapsed, peak_bytes = _measure(lambda: _read_tail_and_append(filename, args['new_tweets']))
+        _print_result('update (tail and append)', elapsed, peak_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Compares the memory and generation latency of lazily fit models against eagerly fit ones on synthetic tweets, and
+# checks that both generate the same tokens for the same random seed
+# Usage: python3 -m benchmarks.lazy_prediction --tweets 40000
+import argparse
+import random
+import tracemalloc
+from timeit import default_timer as timer
+from typing import List, Tuple
+
+import numpy as np
+
+from benchmarks.counting import _synthetic_tokenized_tweets
+from namedtuples.Token import Token
+from utils.Model import Model, LazyFitModel
+
+
+def _fit(model: Model, tweets: List[List[Token]]) -> Tuple[float, int]:
+    tracemalloc.start()
+    start = timer()
+    model.fit_tokenized(tweets)
+    elapsed = timer() - start
+    resident_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, resident_bytes
+
+
+def _generate(model: Model, chains: int, seed: int) -> Tuple[float, List[List[Token]]]:
+    random.seed(seed)
+    np.random.seed(seed)
+    start = timer()
+    generated = [model.generate_tokens(80) for _ in range(chains)]
+    return timer() - start, generated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lazy vs eager model benchmark')
+    parser.add_argument('--tweets', type=int, default=40000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    parser.add_argument('--chains', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    tweets = _synthetic_tokenized_tweets(args['tweets'], args['vocabulary'], args['seed'])
+
+    outputs = []
+    for name, model_class in (('eager', Model), ('lazy', LazyFitModel)):
+        model = model_class(args['min_ngram_length'], args['max_ngram_length'])
+        fit_time, resident_bytes = _fit(model, tweets)
+        generate_time, generated = _generate(model, args['chains'], args['seed'])
+        num_tokens = sum(len(chain) for chain in generated)
+        outputs.append(generated)
+
+        print(f'{name:6} fit: {fit_time:6.2f}s  memory: {resident_bytes / 2 ** 20:7.1f}MB  '
+              f'generation: {generate_time / num_tokens * 1e3:6.3f}ms / token')
+
+    print(f'Identical output: {outputs[0] == outputs[1]}')
+
+
+if __name__ == '__main__':
+    main()
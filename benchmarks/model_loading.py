@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Compares cold-start time and peak RSS of loading a pickled model against mapping a binary model file
+# Usage: python3 -m benchmarks.model_loading --model_file data/model.bin --pickled_model_file data/model.pkl
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+from timeit import default_timer as timer
+from typing import Dict, List
+
+
+def _child(model_filename: str) -> None:
+    start = timer()
+    from utils.ModelFile import load_model
+    model = load_model(model_filename)
+    load_time = timer() - start
+
+    start = timer()
+    model.generate_tokens(80)
+    generate_time = timer() - start
+
+    print(json.dumps({
+        'load_time': load_time,
+        'generate_time': generate_time,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }))
+
+
+def _run_children(model_filename: str, runs: int) -> List[Dict]:
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.model_loading', '--child', model_filename],
+                                check=True, stdout=subprocess.PIPE).stdout
+        results.append(json.loads(output))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model loading benchmark')
+    parser.add_argument('--model_file', type=str, default='data/model.bin')
+    parser.add_argument('--pickled_model_file', type=str, default='data/model.pkl')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', type=str)
+    args = vars(parser.parse_args())
+
+    if args['child'] is not None:
+        _child(args['child'])
+        return
+
+    for name, filename in (('pickle', args['pickled_model_file']), ('mmap', args['model_file'])):
+        results = _run_children(filename, args['runs'])
+        print(f'{name:7} load: {statistics.median(r["load_time"] for r in results):.3f}s  '
+              f'first tweet: {statistics.median(r["generate_time"] for r in results):.3f}s  '
+              f'max RSS: {statistics.median(r["max_rss_kb"] for r in results) / 1024:.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
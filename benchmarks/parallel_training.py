@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# How well training scales with --jobs. Trains through Model.fit on synthetic tweets, a chunk at a time like the CLI,
+# with the same nltk stand-in as benchmarks.suite. Compares counting in one process against the old way of using more:
+# contiguous shards of each chunk, each counted into a whole trie that's pickled back and merged in one at a time, and
+# against partitioning positions by the token before them, where each worker's subtrees are memory mapped back and put
+# together without any lookups. Counting includes merging. Efficiency is the counting speedup over one process divided
+# by the number of processes, so it can't be better than the number of CPUs allows. Also checks that every way gives
+# the same model
+# Usage: python3 -m benchmarks.parallel_training --tweets 40000 --jobs 1 2 4 8
+import argparse
+import multiprocessing as mp
+import os
+from functools import partial
+from timeit import default_timer as timer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import utils.Model
+from benchmarks.pruning import _predict_everything
+from benchmarks.suite import _install_offline_nltk, _synthetic_tweets
+from namedtuples.Token import Token
+from namedtuples.Tweet import Tweet
+from utils.CompactWeights import CompactWeights
+from utils.Model import Model
+from utils.Profiler import enable_profiling, get_profile, profile_stage, reset_profile
+
+
+def _count_shard(shard: Tuple[int, List[List[int]]], min_n: int, max_n: int) -> CompactWeights:
+    weights = CompactWeights()
+    weights._num_positions, id_sequences = shard
+    for ids in id_sequences:
+        weights._add_id_sequence(ids, min_n, max_n)
+    weights.compact()
+    return weights
+
+
+class _ShardedWeights(CompactWeights):
+    # How CompactWeights.add_sequences used more than one process before
+    def add_sequences(self, token_sequences: Sequence[Sequence[Token]], min_n: int, max_n: int,
+                      processes: Optional[int] = None) -> None:
+        id_sequences = [[self.vocabulary.intern(token) for token in tokens] for tokens in token_sequences]
+        shard_size = -(-len(id_sequences) // processes)
+        shards = [id_sequences[i:i + shard_size] for i in range(0, len(id_sequences), shard_size)]
+        # Each shard's sequence numbers carry on from the ones before it
+        shard_lengths = [sum(len(ids) for ids in shard) for shard in shards]
+        first_positions = self._num_positions + np.cumsum([0] + shard_lengths[:-1])
+        self._num_positions += sum(shard_lengths)
+
+        count_shard = partial(_count_shard, min_n=min_n, max_n=max_n)
+        with mp.Pool(processes) as pool:
+            for shard_weights in pool.imap_unordered(count_shard, zip(first_positions.tolist(), shards)):
+                with profile_stage('merge'):
+                    self._merge_shard(shard_weights)
+
+
+class _ShardedModel(Model):
+    def _new_weights(self) -> CompactWeights:
+        return _ShardedWeights()
+
+
+def _train(model: Model, tweets: List[Tweet], processes: int) -> Tuple[float, Dict[str, Dict[str, float]]]:
+    reset_profile()
+    start = timer()
+    model.fit(tweets, processes=processes)
+    return timer() - start, get_profile()['stages']
+
+
+def _stage_seconds(stages: Dict[str, Dict[str, float]], name: str) -> float:
+    return stages[name]['seconds'] if name in stages else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel training scaling benchmark')
+    parser.add_argument('--tweets', type=int, default=40000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    parser.add_argument('--fit_chunk_size', type=int, default=utils.Model._FIT_CHUNK_SIZE)  # Tweets per chunk
+    parser.add_argument('--jobs', type=int, nargs='+', default=None)  # Defaults to powers of two up to the CPU count
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    _install_offline_nltk()
+    utils.Model._FIT_CHUNK_SIZE = args['fit_chunk_size']
+    num_cpus = os.cpu_count() or 1
+    all_jobs = args['jobs'] or [2 ** i for i in range(max(num_cpus, 2).bit_length())]
+    min_n, max_n = args['min_ngram_length'], args['max_ngram_length']
+    tweets = _synthetic_tweets(args['tweets'], args['vocabulary'], args['seed'])
+
+    enable_profiling()
+    expected = Model(min_n, max_n)
+    serial_seconds, stages = _train(expected, tweets, 1)
+    serial_count_seconds = _stage_seconds(stages, 'count')
+    tokenized_tweets = expected._tokenize(tweets, None, 1)
+    expected_sizes = expected.get_order_sizes()
+    expected_predictions = _predict_everything(expected, tokenized_tweets, args['seed'])
+    print(f'Tweets: {len(tweets)}, Tokens: {sum(len(tweet) for tweet in tokenized_tweets)}, '
+          f'Chunks: {-(-len(tweets) // args["fit_chunk_size"])}, CPUs: {num_cpus}')
+    print(f'{"1 process":16} {serial_seconds:7.2f}s  counting {serial_count_seconds:5.2f}s')
+
+    different = []
+    for jobs in all_jobs:
+        if jobs == 1:
+            continue
+
+        for name, model in (('sharded', _ShardedModel(min_n, max_n)), ('partitioned', Model(min_n, max_n))):
+            elapsed, stages = _train(model, tweets, jobs)
+            count_seconds = _stage_seconds(stages, 'count')
+            print(f'{f"{name} x{jobs}":16} {elapsed:7.2f}s  counting {count_seconds:5.2f}s  '
+                  f'{serial_count_seconds / count_seconds:5.2f}x  '
+                  f'efficiency {serial_count_seconds / count_seconds / jobs:4.0%}  '
+                  f'merging {_stage_seconds(stages, "merge"):5.2f}s')
+
+            if model.get_order_sizes() != expected_sizes or \
+                    (_predict_everything(model, tokenized_tweets, args['seed']) != expected_predictions).any():
+                different.append(f'{name} x{jobs}')
+
+    if len(different) > 0:
+        print(f'{", ".join(different)} trained a different model than 1 process!')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
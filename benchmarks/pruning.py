@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Model size before and after Model.prune for each max ngram length, on a model fit to synthetic tweets, along with how
+# often generation ends up predicting from each order. Checks that a model pruned with the default settings makes
+# exactly the same predictions as the unpruned one, both for every context in the training data and for generated
+# chains with the same seed, and reports how many chains a --min-context-count prune changes
+# Usage: python3 -m benchmarks.pruning --tweets 20000
+import argparse
+import os
+import random
+import tempfile
+from typing import List
+
+import numpy as np
+
+from benchmarks.counting import _synthetic_tokenized_tweets
+from namedtuples.Token import Token
+from utils.ModelFile import load_model, save_model
+from utils.Model import Model
+
+
+def _predict_everything(model: Model, tweets: List[List[Token]], seed: int) -> np.ndarray:
+    # The successor picked for every position in the training data, all with the same random numbers
+    weights = model._weights
+    contexts = [[weights.vocabulary.get_id(token) for token in tweet[max(i - model._max_n, 0):i]]
+                for tweet in tweets for i in range(model._min_n, len(tweet))]
+
+    predictions = np.full(len(contexts), -1, dtype=np.int64)
+    random_nums = np.random.default_rng(seed).beta(3, 1, size=len(contexts))
+    for length in range(model._min_n, model._max_n + 1):
+        indexes = np.array([i for i, context in enumerate(contexts) if len(context) == length], dtype=np.int64)
+        if len(indexes) == 0:
+            continue
+
+        nodes = weights.find_backoff_nodes(np.array([contexts[i] for i in indexes], dtype=np.int64), model._min_n,
+                                           model._max_n)
+        found = nodes >= 0
+        predictions[indexes[found]] = weights.sample_successor_ids(nodes[found], random_nums[indexes[found]])
+    return predictions
+
+
+def _generate_scalar(model: Model, chains: int, seed: int) -> List[List[Token]]:
+    random.seed(seed)
+    np.random.seed(seed)
+    return [model.generate_tokens(100) for _ in range(chains)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model pruning benchmark')
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-lengths', type=int, nargs='+', default=[3, 4, 6, 8, 10])
+    parser.add_argument('--min-context-count', type=int, default=5)
+    parser.add_argument('--chains', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    tweets = _synthetic_tokenized_tweets(args['tweets'], args['vocabulary'], args['seed'])
+    print(f'{len(tweets)} synthetic tweets, {sum(len(tweet) for tweet in tweets)} tokens')
+    print()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_filename = os.path.join(temp_dir, 'model.bin')
+        pruned_filename = os.path.join(temp_dir, 'pruned.bin')
+
+        for max_n in args['max_ngram_lengths']:
+            model = Model(args['min_ngram_length'], max_n)
+            model.fit_tokenized(tweets, processes=1)
+            save_model(model, model_filename)
+
+            model = load_model(model_filename)
+            pruned = load_model(model_filename)
+            pruned.prune()
+            save_model(pruned, pruned_filename)
+            pruned = load_model(pruned_filename)
+
+            same_predictions = np.array_equal(_predict_everything(model, tweets, args['seed']),
+                                              _predict_everything(pruned, tweets, args['seed']))
+            chains = model.generate_batch(args['chains'], 100, np.random.default_rng(args['seed']))
+            same_chains = chains == pruned.generate_batch(args['chains'], 100, np.random.default_rng(args['seed'])) \
+                and _generate_scalar(model, args['chains'], args['seed']) == \
+                _generate_scalar(pruned, args['chains'], args['seed'])
+
+            thresholded = load_model(model_filename)
+            thresholded.prune(args['min_context_count'])
+            thresholded_chains = thresholded.generate_batch(args['chains'], 100, np.random.default_rng(args['seed']))
+            num_unchanged = sum(a == b for a, b in zip(chains, thresholded_chains))
+
+            orders = model.count_backoff_orders(chains)
+            top_order_share = orders[max_n] / sum(orders.values())
+            print(f'max_n {max_n:2}: {os.path.getsize(model_filename) / 2 ** 20:6.1f}MB -> '
+                  f'{os.path.getsize(pruned_filename) / 2 ** 20:6.1f}MB pruned '
+                  f'({os.path.getsize(pruned_filename) / os.path.getsize(model_filename):4.0%}), '
+                  f'{top_order_share:5.1%} of tokens predicted from n={max_n}. '
+                  f'min count {args["min_context_count"]}: {num_unchanged} of {len(chains)} chains unchanged')
+
+            if not same_predictions or not same_chains:
+                print(f'max_n {max_n}: the pruned model predicts differently!')
+                exit(1)
+
+        print()
+        print(f'Per order, for max_n {max_n}:')
+        sizes_after = {size.n: size for size in pruned.get_order_sizes()}
+        for size in model.get_order_sizes():
+            size_after = sizes_after.get(size.n, size._replace(contexts=0, num_bytes=0))
+            print(f'  n {size.n:2}: {size.contexts:9} contexts ({size.usable_contexts:8} usable), '
+                  f'{size.num_bytes / 2 ** 20:6.1f}MB -> {size_after.num_bytes / 2 ** 20:6.1f}MB, '
+                  f'{orders[size.n] / sum(orders.values()):5.1%} of tokens')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Measures the cold-start import cost of each CLI command's code path using `python -X importtime`
+# Usage: python3 -m benchmarks.startup
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# The modules each code path imports. Keep in sync with the imports inside the commands in DonaldTrumBot.py
+_CODE_PATHS = {
+    'cli': ['DonaldTrumBot'],
+    'tweet (not tweeting)': ['DonaldTrumBot', 'tweepy', 'utils.TweetPoster'],
+    'tweet (tweeting)': ['DonaldTrumBot', 'tweepy', 'utils.TweetPoster', 'utils.TweetQueue'],
+    'tweet (queue empty)': ['DonaldTrumBot', 'tweepy', 'utils.TweetPoster', 'utils.TweetQueue', 'utils.ModelFile',
+                            'utils.TweetBuilder'],
+    'train': ['DonaldTrumBot', 'utils.Model', 'utils.ModelFile', 'utils.TokenCache', 'utils.TweetQueue',
+              'utils.TweetBuilder', 'nltk'],
+    'pregenerate': ['DonaldTrumBot', 'utils.ModelFile', 'utils.TweetQueue', 'utils.TweetBuilder'],
+    'update': ['DonaldTrumBot', 'utils.TweetDownloader'],
+    'test_tweet': ['DonaldTrumBot', 'utils.Model', 'utils.TweetBuilder'],
+}
+
+_IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def _measure_imports(modules: List[str]) -> Tuple[float, List[Tuple[str, float]]]:
+    # Returns the total import time and the slowest top-level imports, both in seconds
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {", ".join(modules)}'],
+                            check=True, stderr=subprocess.PIPE, universal_newlines=True).stderr
+
+    top_level_imports = []
+    for line in output.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if match is not None and len(match.group(3)) == 1:  # Only one space of indentation means it's top-level
+            top_level_imports.append((match.group(4), int(match.group(2)) / 1e6))
+
+    total = sum(seconds for _, seconds in top_level_imports)
+    return total, list(sorted(top_level_imports, key=lambda pair: pair[1], reverse=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CLI startup benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=3)
+    args = vars(parser.parse_args())
+
+    for code_path, modules in _CODE_PATHS.items():
+        runs = [_measure_imports(modules) for _ in range(args['runs'])]
+        totals: Dict[str, List[float]] = {}
+        for _, top_level_imports in runs:
+            for module, seconds in top_level_imports:
+                totals.setdefault(module, []).append(seconds)
+
+        slowest = sorted(totals.items(), key=lambda pair: statistics.median(pair[1]), reverse=True)[:args['top']]
+        slowest_description = ', '.join(f'{module} {statistics.median(times):.3f}s' for module, times in slowest)
+        print(f'{code_path:22} {statistics.median(total for total, _ in runs):.3f}s  ({slowest_description})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Times training, generation, tweet dump I/O, model files and CLI startup on a synthetic tweet dump built from fixed
+# seeds, and compares the times against a JSON baseline from an earlier run on the same machine. Exits with 1 if
+# anything got slower than the baseline by more than --tolerance, so it can run nightly.
+# Runs offline: unless --real-nltk is given, nltk is replaced by a stand-in that splits words with a regex and tags
+# them by shape, so the numbers cover everything but nltk itself. Training uses one process by default so that
+# baselines don't depend on the number of CPUs
+# Usage: python3 -m benchmarks.suite --tweets 5000 [--save-baseline]
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import types
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from timeit import default_timer as timer
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from namedtuples.Tweet import Tweet
+from utils.Model import train_model_from_file
+from utils.ModelFile import load_model, save_model
+from utils.Profiler import enable_profiling, get_profile, reset_profile
+from utils.TweetBuilder import create_tweet, create_tweets
+from utils.TweetDump import copy_tweets, read_tweets, write_tweets
+
+_SENTENCE_ENDS = ('.', '.', '.', '!', '?')
+_EXTRAS = (',', ':', 'the', 'a', "'s", '"', '@someone', '#hashtag', '$5', '100%')
+_USABLE_SOURCE = 'Twitter for iPhone'
+_UNUSABLE_SOURCE = 'Twitter for Android'
+_FIRST_TWEET_TIME = datetime(2017, 3, 1, tzinfo=timezone.utc)
+
+# Results are only compared against a baseline run with the same values of these
+_CONFIG_ARGS = ('tweets', 'vocabulary', 'min_ngram_length', 'max_ngram_length', 'chains', 'jobs', 'seed',
+                'real_nltk')
+_CLI_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DonaldTrumBot.py')
+
+_WORD_PATTERN = re.compile(r"\w+(?:'\w+)?|[^\w\s]")
+_SENTENCE_END_WORDS = frozenset(_SENTENCE_ENDS)
+
+
+def _install_offline_nltk() -> None:
+    # Just the two functions Model uses. Worker processes are forked from this one, so they get it too
+    nltk = types.ModuleType('nltk')
+    nltk.word_tokenize = _WORD_PATTERN.findall
+    nltk.pos_tag = lambda words: [(word, _offline_tag(word)) for word in words]
+    sys.modules['nltk'] = nltk
+
+
+def _offline_tag(word: str) -> str:
+    if word in _SENTENCE_END_WORDS:
+        return '.'
+    elif not word[0].isalnum():
+        return word
+    elif word[0].isupper():
+        return 'NNP'
+    else:
+        return 'NN'
+
+
+def _synthetic_tweets(num_tweets: int, vocabulary_size: int, seed: int) -> List[Tweet]:
+    # Zipf-ish words in whole sentences. About a tenth come from a source TweetValidator filters out
+    rng = random.Random(seed)
+    vocabulary = [f'word{i}' for i in range(vocabulary_size)] + list(_EXTRAS)
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)] + [0.05] * len(_EXTRAS)
+
+    tweets = []
+    for i in range(num_tweets):
+        sentences = []
+        for _ in range(rng.randint(1, 3)):
+            words = rng.choices(vocabulary, weights, k=rng.randint(3, 15))
+            sentences.append(' '.join([words[0].capitalize()] + words[1:]) + rng.choice(_SENTENCE_ENDS))
+
+        source = _UNUSABLE_SOURCE if rng.random() < 0.1 else _USABLE_SOURCE
+        tweets.append(Tweet(i + 1, ' '.join(sentences), source, _FIRST_TWEET_TIME + timedelta(hours=i), False))
+    return tweets
+
+
+def _time(function: Callable[[], object], runs: int) -> Tuple[float, object]:
+    # The fastest of the runs, which is the least affected by whatever else the machine is doing
+    times, result = [], None
+    for _ in range(runs):
+        start = timer()
+        result = function()
+        times.append(timer() - start)
+    return min(times), result
+
+
+def _time_generation(generate: Callable[[], List[List]], seed: int, runs: int) -> float:
+    # Seconds per generated token
+    def seeded_generate():
+        random.seed(seed)
+        np.random.seed(seed)
+        return generate()
+
+    elapsed, chains = _time(seeded_generate, runs)
+    return elapsed / sum(len(chain) for chain in chains)
+
+
+def _time_cli(cli_args: List[str], runs: int) -> float:
+    # Median wall time of running the CLI in a fresh interpreter, imports and all
+    times = []
+    for _ in range(runs):
+        start = timer()
+        subprocess.run([sys.executable, _CLI_FILENAME] + cli_args, check=True, stdout=subprocess.DEVNULL)
+        times.append(timer() - start)
+    return statistics.median(times)
+
+
+def _run(args: Dict, directory: str) -> Dict:
+    ndjson_filename = os.path.join(directory, 'tweets.ndjson')
+    archive_filename = os.path.join(directory, 'tweets.archive')
+    model_filename = os.path.join(directory, 'model.bin')
+    queue_filename = os.path.join(directory, 'queue.sqlite3')
+    min_n, max_n, jobs, runs, seed = (args['min_ngram_length'], args['max_ngram_length'], args['jobs'], args['runs'],
+                                      args['seed'])
+
+    write_tweets(ndjson_filename, _synthetic_tweets(args['tweets'], args['vocabulary'], seed))
+
+    metrics, info = OrderedDict(), OrderedDict()
+    metrics['io.import_archive'], _ = _time(lambda: copy_tweets(ndjson_filename, archive_filename), runs)
+    metrics['io.read_usable_ndjson'], _ = _time(lambda: list(read_tweets(ndjson_filename, only_usable=True)), runs)
+    metrics['io.read_usable_archive'], _ = _time(lambda: list(read_tweets(archive_filename, only_usable=True)), runs)
+
+    metrics['train.eager'], model = _time(lambda: train_model_from_file(archive_filename, min_n, max_n, False,
+                                                                        processes=jobs), runs)
+    metrics['train.lazy'], lazy_model = _time(lambda: train_model_from_file(archive_filename, min_n, max_n, True,
+                                                                            processes=jobs), runs)
+
+    metrics['model.serialize'], _ = _time(lambda: save_model(model, model_filename), runs)
+    metrics['model.load'], model = _time(lambda: load_model(model_filename), runs)
+    info['model_bytes'] = os.path.getsize(model_filename)
+
+    metrics['generate.eager_per_token'] = _time_generation(
+        lambda: [model.generate_tokens(100) for _ in range(args['chains'])], seed, runs)
+    metrics['generate.lazy_per_token'] = _time_generation(
+        lambda: [lazy_model.generate_tokens(100) for _ in range(args['chains'])], seed, runs)
+    metrics['generate.batch_per_token'] = _time_generation(
+        lambda: model.generate_batch(args['chains'], 100, np.random.default_rng(seed)), seed, runs)
+
+    elapsed, _ = _time(lambda: [create_tweet(model, 240) for _ in range(args['chains'])], runs)
+    metrics['create_tweet.per_tweet'] = elapsed / args['chains']
+    elapsed, _ = _time(lambda: create_tweets(model, 240, args['chains'], np.random.default_rng(seed)), runs)
+    metrics['create_tweets.per_tweet'] = elapsed / args['chains']
+
+    cli_args = ['--model_file', model_filename, '--queue_file', queue_filename]
+    subprocess.run([sys.executable, _CLI_FILENAME, 'pregenerate'] + cli_args, check=True,
+                   stdout=subprocess.DEVNULL)
+    metrics['startup.queue_stats'] = _time_cli(['queue_stats'] + cli_args, runs)
+    metrics['startup.pregenerate_full_queue'] = _time_cli(['pregenerate'] + cli_args, runs)
+
+    # Training once more with profiling on, for where its time goes. Last, since profiling can't be turned back off
+    enable_profiling()
+    reset_profile()
+    train_model_from_file(archive_filename, min_n, max_n, False, processes=jobs)
+    info['train_stages'] = OrderedDict((name, stage['seconds']) for name, stage in get_profile()['stages'].items())
+
+    return OrderedDict([('config', OrderedDict((name, args[name]) for name in _CONFIG_ARGS)),
+                        ('python', sys.version.split()[0]), ('metrics', metrics), ('info', info)])
+
+
+def _compare(results: Dict, baseline: Dict, tolerance: float) -> bool:
+    # Prints each metric against the baseline. Returns whether any got slower by more than the tolerance
+    regressed = False
+    for name, seconds in results['metrics'].items():
+        baseline_seconds = baseline['metrics'].get(name)
+        if baseline_seconds is None:
+            print(f'{name:32} {seconds * 1e3:10.3f}ms  (not in baseline)')
+            continue
+
+        ratio = seconds / baseline_seconds
+        slower = ratio > 1 + tolerance
+        regressed |= slower
+        print(f'{name:32} {seconds * 1e3:10.3f}ms  baseline {baseline_seconds * 1e3:10.3f}ms  {ratio:5.2f}x'
+              f'{"  SLOWER" if slower else ""}')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite')
+    parser.add_argument('--tweets', type=int, default=5000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    parser.add_argument('--chains', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--real-nltk', action='store_true')  # Needs the nltk punkt and tagger data
+    parser.add_argument('--baseline', type=str, default='data/benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')  # Replaces the baseline with this run's results
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', type=str, default=None)  # Also writes this run's results here
+    args = vars(parser.parse_args())
+
+    if not args['real_nltk']:
+        _install_offline_nltk()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = _run(args, directory)
+
+    if args['output'] is not None:
+        with open(args['output'], 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args['save_baseline']:
+        os.makedirs(os.path.dirname(args['baseline']) or '.', exist_ok=True)
+        with open(args['baseline'], 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print(f'Saved baseline to {args["baseline"]}')
+
+    baseline = None
+    if not args['save_baseline'] and os.path.exists(args['baseline']):
+        with open(args['baseline'], 'r') as fp:
+            baseline = json.load(fp)
+
+    if baseline is None:
+        for name, seconds in results['metrics'].items():
+            print(f'{name:32} {seconds * 1e3:10.3f}ms')
+    elif baseline['config'] != results['config']:
+        print(f'{args["baseline"]} was run with different settings: {json.dumps(baseline["config"])}')
+        exit(1)
+    elif _compare(results, baseline, args['tolerance']):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
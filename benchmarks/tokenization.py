@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Tokenization and tagging throughput of the old two-pass pool.map against the chunked, fused workers, for each
+# process count up to the number of CPUs. Needs the nltk punkt and tagger data
+# Usage: python3 -m benchmarks.tokenization --tweet_file data/tweets.ndjson --tweets 20000
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+from timeit import default_timer as timer
+from typing import List
+
+from namedtuples.Token import Token
+from namedtuples.Tweet import Tweet
+from utils.Model import Model
+from utils.TweetDump import read_tweets
+
+
+def _preprocess_two_pass(tweets: List[Tweet], processes: int) -> List[List[Token]]:
+    # How Model used to tokenize: one pool.map to tokenize, then another to tag, sending back a tuple per token
+    import nltk
+
+    with mp.Pool(processes) as pool:
+        tokenized_tweets = pool.map(nltk.word_tokenize, (tweet.text for tweet in tweets))
+        tagged_tweets = pool.map(nltk.pos_tag, tokenized_tweets)
+    return [[Token(word, pos) for word, pos in tweet] for tweet in tagged_tweets]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tokenization throughput benchmark')
+    parser.add_argument('--tweet_file', type=str, default='data/tweets.ndjson')
+    parser.add_argument('--tweets', type=int, default=20000)
+    args = vars(parser.parse_args())
+
+    tweets = list(itertools.islice(read_tweets(args['tweet_file'], only_usable=True), args['tweets']))
+    max_processes = os.cpu_count() or 1
+
+    start = timer()
+    expected = _preprocess_two_pass(tweets, max_processes)
+    print(f'Tweets: {len(tweets)}, Tokens: {sum(len(tweet) for tweet in expected)}')
+    print(f'{"two pass":12} {timer() - start:7.2f}s')
+
+    baseline = None
+    for processes in range(1, max_processes + 1):
+        start = timer()
+        tokenized_tweets = Model._preprocess_tweets(tweets, processes)
+        elapsed = timer() - start
+        baseline = baseline or elapsed
+
+        matches = 'matches' if tokenized_tweets == expected else 'MISMATCH'
+        print(f'{f"chunked x{processes}":12} {elapsed:7.2f}s  {len(tweets) / elapsed:8.0f} tweets/s  '
+              f'{baseline / elapsed:5.2f}x  {matches}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# How much generation gets thrown away building tweets, the old way (generate a fixed number of tokens, then cut the
+# text back to whole sentences with nltk's sentence tokenizer) against stopping once the tweet's length runs out. Uses a
+# model fit to synthetic tweets made of whole sentences. Needs the nltk punkt data for the old path
+# Usage: python3 -m benchmarks.tweet_length --tweets 2000
+import argparse
+import random
+from timeit import default_timer as timer
+from typing import List, Tuple
+
+import numpy as np
+
+from namedtuples.Token import Token
+from utils.Model import Model
+from utils.TweetBuilder import _fit_sentences, _join_tokens, _token_length
+
+_SENTENCE_ENDS = [Token('.', '.'), Token('!', '.'), Token('?', '.')]
+_PUNCTUATION = [Token(',', ','), Token(':', ':'), Token("'s", 'POS'), Token('"', "''")]
+
+
+def _synthetic_sentence_tweets(num_tweets: int, vocabulary_size: int, seed: int) -> List[List[Token]]:
+    rng = random.Random(seed)
+    vocabulary = [Token(f'word{i}', 'NN') for i in range(vocabulary_size)] + _PUNCTUATION
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)] + [0.05] * len(_PUNCTUATION)
+
+    tweets = []
+    for _ in range(num_tweets):
+        tweet = []
+        for _ in range(rng.randint(1, 4)):
+            tweet.extend(rng.choices(vocabulary, weights, k=rng.randint(3, 20)))
+            tweet.append(rng.choice(_SENTENCE_ENDS))
+        tweets.append(tweet)
+    return tweets
+
+
+def _prune_tweet(tweet: str, max_length: int) -> str:
+    import nltk
+
+    result = ''
+    for sentence in nltk.tokenize.sent_tokenize(tweet):
+        result_after_appending = f'{result} {sentence}'
+        if len(result_after_appending) > max_length:
+            break
+        else:
+            result = result_after_appending
+
+    return result.strip()
+
+
+def _kept_tokens(tokens: List[Token], tweet: str) -> int:
+    # Only the text of the tweet is left, so this counts the longest run of tokens that renders no longer than it
+    kept = 0
+    while kept < len(tokens) and len(_join_tokens(tokens[:kept + 1])) <= len(tweet):
+        kept += 1
+    return kept
+
+
+def _create_tweet_old(model: Model, max_length: int) -> Tuple[str, List[Token], int, int]:
+    # Returns the tweet, the tokens it was cut from, how many tokens were generated in all and how many attempts it took
+    tweet, tokens, num_generated, num_attempts = '', [], 0, 0
+    while len(tweet) < 5:
+        tokens = model.generate_tokens(max_length // 3)
+        tweet = _prune_tweet(_join_tokens(tokens), max_length)
+        num_generated += len(tokens)
+        num_attempts += 1
+    return tweet, tokens, num_generated, num_attempts
+
+
+def _create_tweet_new(model: Model, max_length: int) -> Tuple[str, List[Token], int, int]:
+    tweet, tokens, num_generated, num_attempts = '', [], 0, 0
+    while len(tweet) < 5:
+        tokens = model.generate_tokens(max_length + 1, _token_length, max_length)
+        tweet = _fit_sentences(tokens, max_length)
+        num_generated += len(tokens)
+        num_attempts += 1
+    return tweet, tokens, num_generated, num_attempts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wasted generation per tweet benchmark')
+    parser.add_argument('--corpus-tweets', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=4)
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--max-length', type=int, default=240)
+    parser.add_argument('--seed', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    model = Model(args['min_ngram_length'], args['max_ngram_length'])
+    model.fit_tokenized(_synthetic_sentence_tweets(args['corpus_tweets'], args['vocabulary'], args['seed']))
+
+    for name, create_tweet in (('old', _create_tweet_old), ('new', _create_tweet_new)):
+        random.seed(args['seed'])
+        np.random.seed(args['seed'])
+        start = timer()
+        results = [create_tweet(model, args['max_length']) for _ in range(args['tweets'])]
+        elapsed = timer() - start
+
+        tweets, _, _, attempts = zip(*results)
+        wasted = [num_generated - _kept_tokens(tokens, tweet) for tweet, tokens, num_generated, _ in results]
+        print(f'{name:4} {len(tweets) / elapsed:7.0f} tweets/s  '
+              f'avg length: {sum(map(len, tweets)) / len(tweets):5.1f}  '
+              f'wasted tokens/tweet: {sum(wasted) / len(tweets):5.1f}  '
+              f'retries/tweet: {(sum(attempts) - len(tweets)) / len(tweets):.3f}  '
+              f'max retries: {max(attempts) - 1}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Compares the memory used by the dict and compact ngram weight backends on a tweet dump
+# Usage: python3 -m benchmarks.weights_memory --tweet_file data/trump_tweets.ndjson
+import argparse
+import gc
+import pickle
+import tracemalloc
+from timeit import default_timer as timer
+from typing import Dict, List
+
+import ndjson
+
+from namedtuples.Token import Token
+from namedtuples.Tweet import tweet_json_decode_hook
+from utils.CompactWeights import CompactWeights
+from utils.Model import Model, _Weights
+from utils.TweetValidator import should_use_tweet
+
+
+def _measure(weights_class: type, tokenized_tweets: List[List[Token]], min_n: int, max_n: int) -> Dict:
+    gc.collect()
+    tracemalloc.start()
+    start = timer()
+
+    weights = weights_class()
+    for n in range(min_n, max_n + 1):
+        for tweet in tokenized_tweets:
+            for n_plus_one_gram in Model._to_ngrams(tweet, n + 1):
+                weights.add(n_plus_one_gram[:-1], n_plus_one_gram[-1])
+    weights.compact()
+
+    build_time = timer() - start
+    resident_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'build_time': build_time,
+        'resident_bytes': resident_bytes,
+        'peak_bytes': peak_bytes,
+        'pickled_bytes': len(pickle.dumps(weights, protocol=pickle.HIGHEST_PROTOCOL))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark for the ngram weight backends')
+    parser.add_argument('--tweet_file', type=str, default='data/trump_tweets.ndjson')
+    parser.add_argument('--min-ngram-length', type=int, default=2)
+    parser.add_argument('--max-ngram-length', type=int, default=10)
+    args = vars(parser.parse_args())
+
+    with open(args['tweet_file'], 'r') as fp:
+        tweets = [tweet for tweet in ndjson.load(fp, object_hook=tweet_json_decode_hook) if should_use_tweet(tweet)]
+    tokenized_tweets = Model._preprocess_tweets(tweets)
+
+    print(f'Tweets: {len(tokenized_tweets)}, Tokens: {sum(len(tweet) for tweet in tokenized_tweets)}')
+    print()
+    for name, weights_class in (('dict', _Weights), ('compact', CompactWeights)):
+        result = _measure(weights_class, tokenized_tweets, args['min_ngram_length'], args['max_ngram_length'])
+        print(f'{name:8} resident: {result["resident_bytes"] / 2 ** 20:8.1f}MB  '
+              f'peak: {result["peak_bytes"] / 2 ** 20:8.1f}MB  '
+              f'pickled: {result["pickled_bytes"] / 2 ** 20:8.1f}MB  '
+              f'build: {result["build_time"]:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
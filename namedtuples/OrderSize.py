@@ -0,0 +1,9 @@
+from typing import NamedTuple
+
+
+class OrderSize(NamedTuple):
+    n: int  # Context length
+    contexts: int
+    usable_contexts: int  # Ones there's enough data to predict from without backing off
+    successors: int
+    num_bytes: int
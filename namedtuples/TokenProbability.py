@@ -0,0 +1,8 @@
+from typing import NamedTuple
+
+from namedtuples.Token import Token
+
+
+class TokenProbability(NamedTuple):
+    token: Token
+    probability: float
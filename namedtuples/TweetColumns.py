@@ -0,0 +1,45 @@
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+
+from namedtuples.Tweet import Tweet
+
+TEXT_ENCODING = 'utf-8'
+TEXT_ENCODING_ERRORS = 'surrogatepass'  # The archive has a few tweets with emoji cut in half
+
+
+class TweetColumns(NamedTuple):
+    # The same fields as Tweet, with one array per field instead of one object per tweet. created_at is in seconds
+    # since the epoch, and sources are indexes into source_names. The texts are encoded back to back in text_blob, with
+    # tweet i's text between text_offsets[i] and text_offsets[i + 1]
+    ids: np.ndarray
+    created_at: np.ndarray
+    is_retweet: np.ndarray
+    sources: np.ndarray
+    source_names: List[str]
+    text_offsets: np.ndarray
+    text_blob: np.ndarray
+
+
+def tweets_to_columns(tweets: Sequence[Tweet]) -> TweetColumns:
+    source_names = list(sorted(set(tweet.source for tweet in tweets)))
+    source_indexes = {source: i for i, source in enumerate(source_names)}
+
+    encoded_texts = [tweet.text.encode(TEXT_ENCODING, TEXT_ENCODING_ERRORS) for tweet in tweets]
+    text_offsets = np.zeros(len(tweets) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded_texts], out=text_offsets[1:])
+
+    return TweetColumns(
+        np.array([tweet.id for tweet in tweets], dtype=np.int64),
+        np.array([int(tweet.created_at.timestamp()) for tweet in tweets], dtype=np.int64),
+        np.array([tweet.is_retweet for tweet in tweets], dtype=bool),
+        np.array([source_indexes[tweet.source] for tweet in tweets], dtype=np.int32),
+        source_names,
+        text_offsets,
+        np.frombuffer(b''.join(encoded_texts), dtype=np.uint8)
+    )
+
+
+def get_text(columns: TweetColumns, index: int) -> str:
+    text = columns.text_blob[columns.text_offsets[index]:columns.text_offsets[index + 1]].tobytes()
+    return text.decode(TEXT_ENCODING, TEXT_ENCODING_ERRORS)
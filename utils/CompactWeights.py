@@ -0,0 +1,733 @@
+import itertools
+import multiprocessing as mp
+import os
+import tempfile
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from namedtuples.OrderSize import OrderSize
+from namedtuples.Token import Token
+from namedtuples.TokenProbability import TokenProbability
+from utils.Profiler import count_event, is_profiling, profile_stage
+
+_NGram = Tuple[Token, ...]
+
+_ID_BITS = 32
+_ID_MASK = (1 << _ID_BITS) - 1
+_ROOT_NODE = 0
+
+# Everything needed to rebuild a frozen CompactWeights, minus the vocabulary
+_FROZEN_ARRAY_NAMES = ('node_keys', 'node_ids', 'offsets', 'successor_ids', 'successor_counts',
+                       'successor_first_seen', 'cumulative_counts', 'enough_data')
+
+# Bytes each node and each successor takes up across those arrays, once frozen
+_NODE_BYTES = np.dtype(np.uint64).itemsize + np.dtype(np.uint32).itemsize + np.dtype(np.int64).itemsize \
+    + np.dtype(np.bool_).itemsize
+_SUCCESSOR_BYTES = 3 * np.dtype(np.uint32).itemsize + np.dtype(np.int64).itemsize
+
+# What _count_partition sends back, in this order
+_PARTITION_ARRAY_NAMES = ('node_keys', 'node_ids', 'offsets', 'successor_ids', 'successor_counts',
+                          'successor_first_seen')
+_PARTITIONS_PER_PROCESS = 4  # More partitions than processes, so one with a very common token can't hold up the rest
+
+# A file's name, and the dtype and length of each array in it
+_ArrayFile = Tuple[str, List[Tuple[str, int]]]
+# Where workers write what they've counted. Memory on Linux, so the files never touch a disk
+_SHARED_MEMORY_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Most the files can take up per position: a node for every context length, and a successor for every counted one
+_NODE_FILE_BYTES = np.dtype(np.uint64).itemsize + np.dtype(np.uint32).itemsize + np.dtype(np.int64).itemsize
+_SUCCESSOR_FILE_BYTES = 3 * np.dtype(np.uint32).itemsize
+
+
+class Vocabulary:
+    def __init__(self):
+        self._ids: Dict[Token, int] = {}
+        self._tokens: List[Token] = []
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def intern(self, token: Token) -> int:
+        token_id = self._ids.get(token)
+        if token_id is None:
+            token_id = len(self._tokens)
+            self._ids[token] = token_id
+            self._tokens.append(token)
+        return token_id
+
+    def get_id(self, token: Token) -> Optional[int]:
+        return self._ids.get(token)
+
+    def get_token(self, token_id: int) -> Token:
+        return self._tokens[token_id]
+
+    def __getstate__(self) -> List[Token]:
+        return self._tokens  # The id lookup can be rebuilt from the list, so there's no need to pickle both
+
+    def __setstate__(self, tokens: List[Token]) -> None:
+        self._tokens = tokens
+        self._ids = {token: token_id for token_id, token in enumerate(tokens)}
+
+
+class CompactWeights:
+    # Contexts are stored as a trie over their tokens in reverse order, so the contexts of every order that end at the
+    # same position in a tweet lie along a single path from the root. Each trie edge is a packed (parent node, token id)
+    # integer key, and each node's successor counts are a row in CSR-style arrays sorted by token id.
+    # Every position data is added at gets the next sequence number, and each successor keeps the first one it was seen
+    # at after its context, so that successors can still be put in the order the dict backend would have them in.
+    # New data is staged in plain dicts by add() and folded into the arrays by compact(). Sequences added with more than
+    # one process are only staged as token ids, and compact() counts everything staged at once, so a fit done a chunk
+    # at a time still gets partitioned once and put together without lookups
+    # freeze() additionally sorts each row by count and precomputes what predictions need, so that sampling a successor
+    # is just a binary search over the row's cumulative counts
+    def __init__(self):
+        self._vocabulary = Vocabulary()
+        self._num_nodes = 1  # Just the root, which is the context of length 0
+
+        self._node_keys = np.zeros(0, dtype=np.uint64)  # Sorted
+        self._node_ids = np.zeros(0, dtype=np.uint32)
+        self._pending_nodes: Dict[int, int] = {}
+
+        self._offsets = np.zeros(1, dtype=np.int64)  # Indexed by node id
+        self._successor_ids = np.zeros(0, dtype=np.uint32)
+        self._successor_counts = np.zeros(0, dtype=np.uint32)
+        self._successor_first_seen = np.zeros(0, dtype=np.uint32)
+        self._pending_counts: Dict[int, int] = {}
+        self._pending_first_seen: Dict[int, int] = {}
+        self._num_positions = 0  # The next sequence number
+        self._staged_ids: List[np.ndarray] = []
+        self._staged_lengths: List[np.ndarray] = []
+        self._staged_settings: Optional[Tuple[int, int, int]] = None  # min_n, max_n and processes
+        self._staged_first_position = 0
+
+        # Only set while frozen
+        self._cumulative_counts: Optional[np.ndarray] = None
+        self._enough_data: Optional[np.ndarray] = None
+
+    @property
+    def frozen(self) -> bool:
+        return self._cumulative_counts is not None
+
+    @property
+    def vocabulary(self) -> 'Vocabulary':
+        return self._vocabulary
+
+    @classmethod
+    def from_arrays(cls, vocabulary: 'Vocabulary', arrays: Dict[str, np.ndarray]) -> 'CompactWeights':
+        weights = cls()
+        weights._vocabulary = vocabulary
+        for name in _FROZEN_ARRAY_NAMES:
+            if name in arrays:
+                setattr(weights, f'_{name}', arrays[name])
+        weights._num_nodes = len(weights._offsets) - 1
+
+        if 'successor_first_seen' not in arrays:  # Saved before it was tracked, so the rows' order is all there is
+            weights._successor_first_seen = _get_row_positions(weights._offsets)
+        weights._num_positions = _get_next_position(weights._successor_first_seen)
+        return weights
+
+    def __setstate__(self, state: Dict) -> None:
+        # Weights pickled before first sequence numbers were tracked keep the order their rows were in
+        self.__dict__.update(state)
+        if '_staged_ids' not in state:
+            self._staged_ids, self._staged_lengths, self._staged_settings = [], [], None
+            self._staged_first_position = 0
+        if '_successor_first_seen' not in state:
+            self._successor_first_seen = _get_row_positions(self._offsets)[:len(self._successor_ids)]
+            self._pending_first_seen = {key: 0 for key in self._pending_counts}
+            self._num_positions = _get_next_position(self._successor_first_seen)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        self.freeze()
+        return {name: getattr(self, f'_{name}') for name in _FROZEN_ARRAY_NAMES}
+
+    def add(self, ngram: _NGram, next_token: Token, count: int = 1) -> None:
+        self._count_staged()  # So that sequence numbers stay in the order things were added
+        node = _ROOT_NODE
+        for token in reversed(ngram):
+            node = self._intern_child(node, self._vocabulary.intern(token))
+
+        key = (node << _ID_BITS) | self._vocabulary.intern(next_token)
+        self._pending_counts[key] = self._pending_counts.get(key, 0) + count
+        self._pending_first_seen.setdefault(key, self._num_positions)
+        self._num_positions += 1
+        self._cumulative_counts = None
+        self._enough_data = None
+
+    def add_sequences(self, token_sequences: Sequence[Sequence[Token]], min_n: int, max_n: int,
+                      processes: Optional[int] = None) -> None:
+        # Counts every (n+1)-gram for n in min_n..max_n. For each position the contexts of every order lie along one
+        # path in the trie, so each position is a single walk back through the previous max_n tokens.
+        # With more than one process, the sequences are staged until compact(), and then positions are split up by
+        # the token just before them. That token is the first edge of every context at the position, so each worker
+        # builds its own subtrees of the trie and they can be put together without looking anything up. processes
+        # defaults to one per CPU, like multiprocessing.Pool
+        id_sequences = [[self._vocabulary.intern(token) for token in tokens] for tokens in token_sequences]
+        processes = processes or os.cpu_count() or 1
+
+        if processes > 1:
+            self._stage_id_sequences(id_sequences, (min_n, max_n, processes))
+        else:
+            self._count_staged()
+            for ids in id_sequences:
+                self._add_id_sequence(ids, min_n, max_n)
+
+    def enough_data_for_prediction(self, ngram: _NGram) -> bool:
+        # Returns True if we can predict without just copying a single existing tweet
+        successor_ids, counts = self._get_successors(self._find_node(ngram))
+        return len(successor_ids) > 1 or counts.sum() > 2
+
+    def get_successor_probabilities(self, ngram: _NGram) -> List[TokenProbability]:
+        # In the order the successors were first seen, like the dict backend
+        node = self._find_node(ngram)
+        successor_ids, counts = self._get_successors(node)
+        if node is not None:
+            order = np.argsort(self._successor_first_seen[self._offsets[node]:self._offsets[node + 1]], kind='stable')
+            successor_ids, counts = successor_ids[order], counts[order]
+
+        total_count = int(counts.sum())
+        return [TokenProbability(self._vocabulary.get_token(int(successor_id)), int(count) / total_count)
+                for successor_id, count in zip(successor_ids, counts)]
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def find_backoff_node(self, tokens: Sequence[Token], min_n: int, max_n: int) -> Optional[int]:
+        # Same backoff as Model.predict_next_token, but walks the trie once for all orders. Requires freeze()
+        path = self._find_path(tokens, min(max_n, len(tokens)))
+
+        for n in reversed(range(min_n, max_n + 1)):
+            depth = min(n, len(tokens))
+            node = path[depth] if depth < len(path) else None
+
+            if node is not None and (self._enough_data[node] or n == min_n):
+                if self._offsets[node] == self._offsets[node + 1]:
+                    return None
+
+                if is_profiling():
+                    count_event(f'backoff_n{depth}')
+                return node
+
+        return None
+
+    def sample_successor(self, node: int, random_num: float) -> Token:
+        # Equivalent to picking the first successor whose cumulative probability is >= random_num. Requires freeze()
+        start, end = self._offsets[node], self._offsets[node + 1]
+        cumulative_counts = self._cumulative_counts[start:end]
+        index = int(np.searchsorted(cumulative_counts, random_num * cumulative_counts[-1]))
+        return self._vocabulary.get_token(int(self._successor_ids[start + min(index, end - start - 1)]))
+
+    def find_backoff_nodes(self, context_ids: np.ndarray, min_n: int, max_n: int) -> np.ndarray:
+        # find_backoff_node for many contexts at once. context_ids has a row of token ids per context, all of the same
+        # length. Contexts with nothing to predict get -1. Requires freeze()
+        num_contexts, context_length = context_ids.shape
+        max_depth = min(max_n, context_length)
+
+        path = [np.full(num_contexts, _ROOT_NODE, dtype=np.int64)]
+        for depth in range(1, max_depth + 1):
+            with profile_stage(f'lookup_n{depth}'):
+                parents = path[-1]
+                keys = (np.maximum(parents, 0).astype(np.uint64) << np.uint64(_ID_BITS)) \
+                    | context_ids[:, -depth].astype(np.uint64)
+                indices = np.minimum(np.searchsorted(self._node_keys, keys), max(len(self._node_keys) - 1, 0))
+                if len(self._node_keys) > 0:
+                    found = (parents >= 0) & (self._node_keys[indices] == keys)
+                    path.append(np.where(found, self._node_ids[indices].astype(np.int64), -1))
+                else:
+                    path.append(np.full(num_contexts, -1, dtype=np.int64))
+
+        nodes = np.full(num_contexts, -1, dtype=np.int64)
+        orders = np.zeros(num_contexts, dtype=np.int64)
+        undecided = np.ones(num_contexts, dtype=bool)
+        for n in reversed(range(min_n, max_n + 1)):
+            candidates = path[min(n, context_length)]
+            existing = candidates >= 0
+            chosen = undecided & existing
+            if n != min_n:
+                chosen[existing] &= self._enough_data[candidates[existing]]
+
+            nodes[chosen] = candidates[chosen]
+            orders[chosen] = min(n, context_length)  # Shorter contexts than n back off to themselves
+            undecided &= ~chosen
+
+        has_successors = nodes >= 0
+        has_successors[has_successors] = self._offsets[nodes[has_successors]] < self._offsets[nodes[has_successors] + 1]
+        if is_profiling():
+            for n, num_contexts_at_n in enumerate(np.bincount(orders[has_successors], minlength=max_n + 1).tolist()):
+                if num_contexts_at_n > 0:
+                    count_event(f'backoff_n{n}', num_contexts_at_n)
+
+        return np.where(has_successors, nodes, -1)
+
+    def sample_successor_ids(self, nodes: np.ndarray, random_nums: np.ndarray) -> np.ndarray:
+        # sample_successor for many nodes at once, as a binary search over every row in lockstep. Returns token ids
+        # rather than Tokens. Requires freeze()
+        starts, ends = self._offsets[nodes], self._offsets[nodes + 1] - 1
+        targets = random_nums * self._cumulative_counts[ends]
+
+        low, high = starts, ends
+        while np.any(low < high):
+            middle = (low + high) // 2
+            go_right = self._cumulative_counts[middle] < targets
+            low = np.where(go_right, middle + 1, low)
+            high = np.where(go_right, high, middle)
+
+        return self._successor_ids[low]
+
+    def freeze(self) -> None:
+        self.compact()
+        if self.frozen:
+            return
+
+        row_lengths = np.diff(self._offsets)
+        nodes = np.repeat(np.arange(len(row_lengths)), row_lengths)
+
+        # Least to most common within each row, and equally common successors in the order they were first seen. That's
+        # how the dict backend's successors end up once sorted by probability, and since the draw is compared against
+        # cumulative counts, it decides how likely each tied successor is
+        order = np.lexsort((self._successor_first_seen, self._successor_counts, nodes))
+        self._successor_ids = self._successor_ids[order]
+        self._successor_counts = self._successor_counts[order]
+        self._successor_first_seen = self._successor_first_seen[order]
+
+        running_totals = np.cumsum(self._successor_counts, dtype=np.int64)
+        row_start_totals = np.concatenate(([0], running_totals))[self._offsets[:-1]]
+        self._cumulative_counts = running_totals - np.repeat(row_start_totals, row_lengths)
+
+        row_totals = np.concatenate(([0], running_totals))[self._offsets[1:]] - row_start_totals
+        self._enough_data = (row_lengths > 1) | (row_totals > 2)
+
+    def get_node_depths(self) -> np.ndarray:
+        # The length of each node's context. Worked out a level of the trie at a time, like _merge_shard
+        self.compact()
+        parents, children = self._get_node_parents()
+        depths = np.zeros(self._num_nodes, dtype=np.int64)
+        known = np.zeros(self._num_nodes, dtype=bool)
+        known[_ROOT_NODE] = True
+
+        unknown = np.ones(len(children), dtype=bool)
+        while unknown.any():
+            level = unknown & known[parents]
+            depths[children[level]] = depths[parents[level]] + 1
+            known[children[level]] = True
+            unknown &= ~level
+
+        return depths
+
+    def get_order_sizes(self) -> List[OrderSize]:
+        # How many contexts of each length there are, and how much memory they take up once frozen
+        self.freeze()
+        depths = self.get_node_depths()
+        row_lengths = np.diff(self._offsets)
+
+        sizes = []
+        for n in range(1, int(depths.max(initial=0)) + 1):
+            at_depth = depths == n
+            successors = int(row_lengths[at_depth].sum())
+            sizes.append(OrderSize(n, int(at_depth.sum()), int(self._enough_data[at_depth].sum()), successors,
+                                   int(at_depth.sum()) * _NODE_BYTES + successors * _SUCCESSOR_BYTES))
+        return sizes
+
+    def prune(self, min_n: int, min_count: int = 0) -> None:
+        # Drops every context longer than min_n without enough data to predict from, along with its successors. Those
+        # are never used, since find_backoff_node always backs off past them, so predictions stay exactly the same.
+        # Contexts longer than min_n that were seen fewer than min_count times are dropped too, which does change
+        # predictions: they back off to a shorter context instead. Either way, a longer context is only kept if every
+        # shorter one on its path is, which is always true for counts from add_sequences, since a shorter context
+        # has been seen at least as often as any longer one ending with it
+        self.freeze()
+        depths = self.get_node_depths()
+        row_lengths = np.diff(self._offsets)
+        row_totals = np.zeros(self._num_nodes, dtype=np.int64)
+        row_totals[row_lengths > 0] = self._cumulative_counts[self._offsets[1:][row_lengths > 0] - 1]
+
+        keep = (depths <= min_n) | (self._enough_data & (row_totals >= min_count))
+        parents, children = self._get_node_parents()
+        for depth in range(min_n + 1, int(depths.max(initial=0)) + 1):
+            at_depth = depths[children] == depth
+            keep[children[at_depth]] &= keep[parents[at_depth]]
+
+        # Renumbering in the same order keeps both parents before their children and the node keys sorted
+        new_ids = np.cumsum(keep) - 1
+        kept_nodes = keep[children]
+        token_ids = self._node_keys[kept_nodes] & np.uint64(_ID_MASK)
+        self._node_keys = (new_ids[parents[kept_nodes]].astype(np.uint64) << np.uint64(_ID_BITS)) | token_ids
+        self._node_ids = new_ids[children[kept_nodes]].astype(np.uint32)
+
+        kept_successors = np.repeat(keep, row_lengths)
+        self._offsets = np.zeros(int(keep.sum()) + 1, dtype=np.int64)
+        np.cumsum(row_lengths[keep], out=self._offsets[1:])
+        self._successor_ids = self._successor_ids[kept_successors]
+        self._successor_counts = self._successor_counts[kept_successors]
+        self._successor_first_seen = self._successor_first_seen[kept_successors]
+        self._cumulative_counts = self._cumulative_counts[kept_successors]
+        self._enough_data = self._enough_data[keep]
+        self._num_nodes = int(keep.sum())
+
+    def compact(self) -> None:
+        self._count_staged()
+        if len(self._pending_nodes) > 0:
+            self._compact_nodes()
+        if len(self._pending_counts) > 0 or len(self._offsets) < self._num_nodes + 1:
+            self._compact_counts()
+
+    def _compact_nodes(self) -> None:
+        pending_keys = np.fromiter(self._pending_nodes.keys(), dtype=np.uint64, count=len(self._pending_nodes))
+        pending_ids = np.fromiter(self._pending_nodes.values(), dtype=np.uint32, count=len(self._pending_nodes))
+
+        keys = np.concatenate((self._node_keys, pending_keys))
+        ids = np.concatenate((self._node_ids, pending_ids))
+        order = np.argsort(keys, kind='stable')
+
+        self._node_keys = keys[order]
+        self._node_ids = ids[order]
+        self._pending_nodes.clear()
+
+    def _compact_counts(self) -> None:
+        pending_keys = np.fromiter(self._pending_counts.keys(), dtype=np.uint64, count=len(self._pending_counts))
+        pending_counts = np.fromiter(self._pending_counts.values(), dtype=np.uint32, count=len(self._pending_counts))
+        pending_first_seen = np.fromiter((self._pending_first_seen[key] for key in self._pending_counts),
+                                         dtype=np.uint32, count=len(self._pending_counts))
+        self._merge_counts(pending_keys, pending_counts, pending_first_seen)
+        self._pending_counts.clear()
+        self._pending_first_seen.clear()
+
+    def _get_node_parents(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Every node but the root, as parallel arrays of parent and child ids
+        return (self._node_keys >> np.uint64(_ID_BITS)).astype(np.int64), self._node_ids.astype(np.int64)
+
+    def _expand_counts(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # The CSR rows as packed (node, successor id) keys, their counts and their first sequence numbers
+        row_lengths = np.diff(self._offsets)
+        nodes = np.repeat(np.arange(len(row_lengths), dtype=np.uint64), row_lengths)
+        return (nodes << np.uint64(_ID_BITS)) | self._successor_ids.astype(np.uint64), self._successor_counts, \
+            self._successor_first_seen
+
+    def _merge_counts(self, new_keys: np.ndarray, new_counts: np.ndarray, new_first_seen: np.ndarray) -> None:
+        existing_keys, existing_counts, existing_first_seen = self._expand_counts()
+        all_keys = np.concatenate((existing_keys, new_keys))
+        all_first_seen = np.concatenate((existing_first_seen, new_first_seen))
+
+        # Sorting by first sequence number within each key puts the earliest first, so every key's group of duplicates
+        # can be summed up and keep the first one's sequence number
+        order = np.lexsort((all_first_seen, all_keys))
+        all_keys = all_keys[order]
+        is_group_start = np.ones(len(all_keys), dtype=bool)
+        is_group_start[1:] = all_keys[1:] != all_keys[:-1]
+        group_starts = np.flatnonzero(is_group_start)
+        keys = all_keys[group_starts]
+        counts = np.add.reduceat(np.concatenate((existing_counts, new_counts))[order], group_starts) \
+            if len(keys) > 0 else np.zeros(0, dtype=np.uint32)
+
+        nodes = (keys >> np.uint64(_ID_BITS)).astype(np.int64)
+        self._offsets = np.zeros(self._num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(nodes, minlength=self._num_nodes), out=self._offsets[1:])
+        self._successor_ids = (keys & np.uint64(_ID_MASK)).astype(np.uint32)
+        self._successor_counts = counts.astype(np.uint32)
+        self._successor_first_seen = all_first_seen[order][group_starts].astype(np.uint32)
+        self._cumulative_counts = None
+        self._enough_data = None
+
+    def _stage_id_sequences(self, id_sequences: List[List[int]], settings: Tuple[int, int, int]) -> None:
+        if settings != self._staged_settings:
+            self._count_staged()
+            self._staged_settings = settings
+            self._staged_first_position = self._num_positions
+
+        lengths = np.array([len(ids) for ids in id_sequences], dtype=np.int64)
+        self._staged_ids.append(np.fromiter(itertools.chain.from_iterable(id_sequences), dtype=np.uint32,
+                                            count=int(lengths.sum())))
+        self._staged_lengths.append(lengths)
+        self._num_positions += int(lengths.sum())
+        self._cumulative_counts = None
+        self._enough_data = None
+
+    def _count_staged(self) -> None:
+        # Staged sequences were numbered one after another from _staged_first_position, so their positions' sequence
+        # numbers are that plus their index into all the staged ids
+        if self._staged_settings is None:
+            return
+
+        (min_n, max_n, processes), first_position = self._staged_settings, self._staged_first_position
+        ids = np.concatenate(self._staged_ids).astype(np.int64)
+        lengths = np.concatenate(self._staged_lengths)
+        self._staged_ids, self._staged_lengths, self._staged_settings = [], [], None
+
+        sequence_offsets = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        if len(lengths) > processes:
+            self._add_partitioned(ids, sequence_offsets, min_n, max_n, processes, first_position)
+        else:
+            positions = np.flatnonzero(sequence_offsets >= max(min_n, 1))
+            self._add_positions(ids.tolist(), positions.tolist(), sequence_offsets[positions].tolist(), min_n, max_n,
+                                first_position)
+
+    def _add_partitioned(self, ids: np.ndarray, sequence_offsets: np.ndarray, min_n: int, max_n: int, processes: int,
+                         first_position: int) -> None:
+        partitions = _partition_positions(ids, sequence_offsets, min_n, processes * _PARTITIONS_PER_PROCESS)
+        if len(partitions) == 0:
+            return
+
+        # Workers write their tries to files that get memory mapped here, rather than pickling them through the pool's
+        # pipes
+        num_file_bytes = len(ids) * (max_n * _NODE_FILE_BYTES + (max_n - min_n + 1) * _SUCCESSOR_FILE_BYTES)
+        with tempfile.TemporaryDirectory(dir=_get_partition_directory(num_file_bytes)) as directory:
+            with mp.Pool(processes, initializer=_init_partition_worker, initargs=(ids, sequence_offsets)) as pool:
+                count_partition = partial(_count_partition, min_n=min_n, max_n=max_n, first_position=first_position,
+                                          directory=directory)
+                array_files = list(pool.imap_unordered(count_partition, partitions))
+
+            with profile_stage('merge'):
+                merged = CompactWeights._from_partitions(_map_array_file(array_file) for array_file in array_files)
+
+        if self._num_nodes == 1 and len(self._pending_counts) == 0:
+            for name in ('num_nodes', ) + _PARTITION_ARRAY_NAMES:
+                setattr(self, f'_{name}', getattr(merged, f'_{name}'))
+            self._cumulative_counts = None
+            self._enough_data = None
+        else:
+            with profile_stage('merge'):
+                self._merge_shard(merged)
+
+    @classmethod
+    def _from_partitions(cls, partitions: Iterable[Sequence[np.ndarray]]) -> 'CompactWeights':
+        # Puts together the compacted tries of _count_partition, which share nothing but the root. So each partition's
+        # other nodes just get ids after the ones before it, and their successor rows go after those partitions' rows
+        weights = cls()
+        root_keys, root_ids, node_keys, node_ids = [], [], [], []
+        offsets, successor_ids, successor_counts, successor_first_seen = [np.zeros(2, dtype=np.int64)], [], [], []
+        num_successors = 0
+
+        for keys, ids, partition_offsets, partition_successor_ids, partition_successor_counts, \
+                partition_successor_first_seen in partitions:
+            shift = weights._num_nodes - 1
+            num_root_children = int(np.searchsorted(keys, np.uint64(1 << _ID_BITS)))  # They sort first
+
+            root_keys.append(keys[:num_root_children])
+            root_ids.append(ids[:num_root_children] + np.uint32(shift))
+            node_keys.append(keys[num_root_children:] + np.uint64(shift << _ID_BITS))  # Moves up the parent
+            node_ids.append(ids[num_root_children:] + np.uint32(shift))
+
+            # The root never has successors, so its row is empty in every partition
+            offsets.append(partition_offsets[2:] + num_successors)
+            successor_ids.append(partition_successor_ids)
+            successor_counts.append(partition_successor_counts)
+            successor_first_seen.append(partition_successor_first_seen)
+            num_successors += len(partition_successor_ids)
+            weights._num_nodes += len(partition_offsets) - 2
+
+        # Partitions have different root children and increasing parents otherwise, so only the root children need
+        # sorting
+        root_keys, root_ids = np.concatenate(root_keys), np.concatenate(root_ids)
+        order = np.argsort(root_keys)
+        weights._node_keys = np.concatenate([root_keys[order]] + node_keys)
+        weights._node_ids = np.concatenate([root_ids[order]] + node_ids)
+        weights._offsets = np.concatenate(offsets)
+        weights._successor_ids = np.concatenate(successor_ids)
+        weights._successor_counts = np.concatenate(successor_counts)
+        weights._successor_first_seen = np.concatenate(successor_first_seen)
+        return weights
+
+    def _merge_shard(self, shard: 'CompactWeights') -> None:
+        # Adds the counts from a compacted CompactWeights that was built with this one's token ids
+        self.compact()
+
+        # Maps the shard's node ids to ours. A node's parent always has a smaller id than it, but the trie is still
+        # mapped a level at a time so each level can be done with whole-array operations
+        node_map = np.full(shard._num_nodes, -1, dtype=np.int64)
+        node_map[_ROOT_NODE] = _ROOT_NODE
+
+        shard_parents = (shard._node_keys >> np.uint64(_ID_BITS)).astype(np.int64)
+        shard_token_ids = shard._node_keys & np.uint64(_ID_MASK)
+        unmapped = np.ones(len(shard._node_keys), dtype=bool)
+
+        new_keys, new_ids = [], []
+        while unmapped.any():
+            level = unmapped & (node_map[shard_parents] >= 0)
+            keys = (node_map[shard_parents[level]].astype(np.uint64) << np.uint64(_ID_BITS)) | shard_token_ids[level]
+
+            indices = np.minimum(np.searchsorted(self._node_keys, keys), max(len(self._node_keys) - 1, 0))
+            found = self._node_keys[indices] == keys if len(self._node_keys) > 0 else np.zeros(len(keys), dtype=bool)
+
+            ids = np.empty(len(keys), dtype=np.int64)
+            ids[found] = self._node_ids[indices[found]]
+            ids[~found] = np.arange(self._num_nodes, self._num_nodes + (~found).sum())
+            self._num_nodes += int((~found).sum())
+
+            node_map[shard._node_ids[level]] = ids
+            new_keys.append(keys[~found])
+            new_ids.append(ids[~found].astype(np.uint32))
+            unmapped &= ~level
+
+        keys = np.concatenate([self._node_keys] + new_keys)
+        ids = np.concatenate([self._node_ids] + new_ids)
+        order = np.argsort(keys, kind='stable')
+        self._node_keys = keys[order]
+        self._node_ids = ids[order]
+
+        shard_keys, shard_counts, shard_first_seen = shard._expand_counts()
+        shard_nodes = node_map[(shard_keys >> np.uint64(_ID_BITS)).astype(np.int64)].astype(np.uint64)
+        self._merge_counts((shard_nodes << np.uint64(_ID_BITS)) | (shard_keys & np.uint64(_ID_MASK)), shard_counts,
+                           shard_first_seen)
+
+    def _add_id_sequence(self, ids: List[int], min_n: int, max_n: int) -> None:
+        positions = range(min_n, len(ids))
+        self._add_positions(ids, positions, positions, min_n, max_n, self._num_positions)
+        self._num_positions += len(ids)
+
+    def _add_positions(self, ids: Sequence[int], positions: Iterable[int], sequence_offsets: Iterable[int],
+                       min_n: int, max_n: int, first_position: int) -> None:
+        # Counts the contexts before each of the positions in ids. Each position's offset into its tweet is how far
+        # back its contexts can go, and its sequence number is first_position plus its index into ids
+        pending_counts = self._pending_counts
+        pending_first_seen = self._pending_first_seen
+
+        for i, offset in zip(positions, sequence_offsets):
+            next_id = ids[i]
+            node = _ROOT_NODE
+            for depth in range(1, min(max_n, offset) + 1):
+                node = self._intern_child(node, ids[i - depth])
+                if depth >= min_n:
+                    key = (node << _ID_BITS) | next_id
+                    count = pending_counts.get(key)
+                    if count is None:
+                        pending_counts[key] = 1
+                        pending_first_seen[key] = first_position + i
+                    else:
+                        pending_counts[key] = count + 1
+
+        self._cumulative_counts = None
+        self._enough_data = None
+
+    def _intern_child(self, node: int, token_id: int) -> int:
+        child = self._find_child(node, token_id)
+        if child is None:
+            child = self._num_nodes
+            self._num_nodes += 1
+            self._pending_nodes[(node << _ID_BITS) | token_id] = child
+        return child
+
+    def _find_child(self, node: int, token_id: int) -> Optional[int]:
+        key = (node << _ID_BITS) | token_id
+        child = self._pending_nodes.get(key)
+
+        if child is None and len(self._node_keys) > 0:
+            index = int(np.searchsorted(self._node_keys, np.uint64(key)))
+            if index < len(self._node_keys) and int(self._node_keys[index]) == key:
+                child = int(self._node_ids[index])
+
+        return child
+
+    def _find_path(self, tokens: Sequence[Token], max_depth: int) -> List[int]:
+        # Nodes for the contexts made of the last 0, 1, 2... tokens, stopping early at the first unseen context
+        path = [_ROOT_NODE]
+        for token in itertools.islice(reversed(tokens), max_depth):
+            token_id = self._vocabulary.get_id(token)
+            child = self._find_child(path[-1], token_id) if token_id is not None else None
+            if child is None:
+                break
+            path.append(child)
+
+        return path
+
+    def _find_node(self, ngram: _NGram) -> Optional[int]:
+        self._count_staged()  # Staged sequences have no nodes until they're counted
+        node = _ROOT_NODE
+        for token in reversed(ngram):
+            token_id = self._vocabulary.get_id(token)
+            if token_id is None:
+                return None
+
+            node = self._find_child(node, token_id)
+            if node is None:
+                return None
+
+        return node
+
+    def _get_successors(self, node: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        self.compact()
+
+        if node is None:
+            return self._successor_ids[:0], self._successor_counts[:0]
+        else:
+            start, end = self._offsets[node], self._offsets[node + 1]
+            return self._successor_ids[start:end], self._successor_counts[start:end]
+
+
+def _get_next_position(successor_first_seen: np.ndarray) -> int:
+    # Any sequence number after the ones already used will do, since they're only ever compared within a row
+    return int(successor_first_seen.max()) + 1 if len(successor_first_seen) > 0 else 0
+
+
+def _get_row_positions(offsets: np.ndarray) -> np.ndarray:
+    # Each successor's index into its CSR row
+    row_lengths = np.diff(offsets)
+    return (np.arange(offsets[-1]) - np.repeat(offsets[:-1], row_lengths)).astype(np.uint32)
+
+
+def _get_partition_directory(num_bytes: int) -> Optional[str]:
+    # /dev/shm can be small, like the 64MB Docker gives containers by default, so counts that might not fit in it go to
+    # the usual temp directory instead
+    if _SHARED_MEMORY_DIRECTORY is not None:
+        stats = os.statvfs(_SHARED_MEMORY_DIRECTORY)
+        if stats.f_bavail * stats.f_frsize >= num_bytes:
+            return _SHARED_MEMORY_DIRECTORY
+    return None
+
+
+def _partition_positions(ids: np.ndarray, sequence_offsets: np.ndarray, min_n: int,
+                         num_partitions: int) -> List[np.ndarray]:
+    # The positions with contexts to count, in about num_partitions groups that each have every position with a given
+    # token before it. Groups are split where that token changes, so one very common token can make its group bigger
+    positions = np.flatnonzero(sequence_offsets >= max(min_n, 1))
+    if len(positions) == 0:
+        return []
+
+    previous_ids = ids[positions - 1]
+    order = np.argsort(previous_ids, kind='stable')
+    positions, previous_ids = positions[order], previous_ids[order]
+
+    targets = np.arange(1, num_partitions) * len(positions) // num_partitions
+    splits = np.unique(np.searchsorted(previous_ids, previous_ids[targets]))
+    return [partition for partition in np.split(positions, splits) if len(partition) > 0]
+
+
+# Set in each worker process by _init_partition_worker
+_worker_ids: List[int] = []
+_worker_sequence_offsets = np.zeros(0, dtype=np.int64)
+
+
+def _init_partition_worker(ids: np.ndarray, sequence_offsets: np.ndarray) -> None:
+    global _worker_ids, _worker_sequence_offsets
+    _worker_ids = ids.tolist()  # Indexing a list is much faster than indexing an array one item at a time
+    _worker_sequence_offsets = sequence_offsets
+
+
+def _count_partition(positions: np.ndarray, min_n: int, max_n: int, first_position: int,
+                     directory: str) -> _ArrayFile:
+    # Runs in a worker process. Token ids are the parent's, so the partition's vocabulary stays empty
+    weights = CompactWeights()
+    weights._add_positions(_worker_ids, positions.tolist(), _worker_sequence_offsets[positions].tolist(), min_n, max_n,
+                           first_position)
+    weights.compact()
+    return _write_array_file([getattr(weights, f'_{name}') for name in _PARTITION_ARRAY_NAMES], directory)
+
+
+def _write_array_file(arrays: List[np.ndarray], directory: str) -> _ArrayFile:
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as fp:
+        for array in arrays:
+            array.tofile(fp)
+            fp.write(bytes(-array.nbytes % 8))  # Keeps every array 8 byte aligned
+    return fp.name, [(array.dtype.str, len(array)) for array in arrays]
+
+
+def _map_array_file(array_file: _ArrayFile) -> List[np.ndarray]:
+    filename, layout = array_file
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    arrays, start = [], 0
+    for dtype, length in layout:
+        arrays.append(np.ndarray(length, dtype, buffer, start))
+        start += -(-arrays[-1].nbytes // 8) * 8
+    return arrays
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from namedtuples.Token import Token
+from namedtuples.TokenProbability import TokenProbability
+from utils.CompactWeights import Vocabulary
+
+_NGram = Tuple[Token, ...]
+_Successors = Tuple[np.ndarray, np.ndarray]  # Successor ids and their counts, in the order they were first seen
+
+_SEPARATOR = -1  # Between tweets in the corpus, so no context or successor spans two tweets
+_CACHE_SIZE = 1024
+
+
+class IndexedWeights:
+    # Stores the tweets instead of ngram counts, and counts a context's successors only when they're asked for. All
+    # tweets are kept as one array of token ids, and an inverted index maps each token id to the positions it appears
+    # at. A context's occurrences are found from the positions of its rarest token, and the most recently used
+    # contexts' successors are kept in a small LRU cache
+    frozen = False
+
+    def __init__(self):
+        self._vocabulary = Vocabulary()
+        self._corpus = np.zeros(0, dtype=np.int32)
+        self._pending_sequences: List[List[int]] = []
+
+        # Token id -> positions in the corpus, stored CSR-style
+        self._posting_offsets = np.zeros(1, dtype=np.int64)
+        self._postings = np.zeros(0, dtype=np.int32)
+
+        self._cache: Dict[Tuple[int, ...], _Successors] = OrderedDict()
+
+    def __getstate__(self) -> Dict:
+        self.compact()
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def add_sequences(self, token_sequences: Sequence[Sequence[Token]], min_n: int, max_n: int,
+                      processes: Optional[int] = None) -> None:
+        # Nothing gets counted up front, so the ngram lengths and process count don't matter here
+        for tokens in token_sequences:
+            self._pending_sequences.append([self._vocabulary.intern(token) for token in tokens])
+
+    def enough_data_for_prediction(self, ngram: _NGram) -> bool:
+        # Returns True if we can predict without just copying a single existing tweet
+        successor_ids, counts = self._get_successors(ngram)
+        return len(successor_ids) > 1 or counts.sum() > 2
+
+    def get_successor_probabilities(self, ngram: _NGram) -> List[TokenProbability]:
+        # In the order they were first seen, like the other backends, so equally likely successors get sampled the same
+        successor_ids, counts = self._get_successors(ngram)
+        total_count = int(counts.sum())
+        return [TokenProbability(self._vocabulary.get_token(int(successor_id)), int(count) / total_count)
+                for successor_id, count in zip(successor_ids, counts)]
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def compact(self) -> None:
+        if len(self._pending_sequences) == 0:
+            return
+
+        new_sequences = []
+        for ids in self._pending_sequences:
+            new_sequences.extend(ids)
+            new_sequences.append(_SEPARATOR)
+        self._corpus = np.concatenate((self._corpus, np.array(new_sequences, dtype=np.int32)))
+        self._pending_sequences.clear()
+
+        positions = np.argsort(self._corpus, kind='stable').astype(np.int32)
+        num_separators = int((self._corpus == _SEPARATOR).sum())
+        self._postings = positions[num_separators:]  # Separators sort first
+
+        token_counts = np.bincount(self._corpus[self._corpus != _SEPARATOR], minlength=len(self._vocabulary))
+        self._posting_offsets = np.zeros(len(self._vocabulary) + 1, dtype=np.int64)
+        np.cumsum(token_counts, out=self._posting_offsets[1:])
+
+        self._cache.clear()
+
+    def freeze(self) -> None:
+        self.compact()
+
+    def _get_successors(self, ngram: _NGram) -> _Successors:
+        self.compact()
+
+        context = self._to_ids(ngram)
+        if context is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+        successors = self._cache.get(context)
+        if successors is not None:
+            self._cache.move_to_end(context)
+        else:
+            successors = self._count_successors(context)
+            self._cache[context] = successors
+            if len(self._cache) > _CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        return successors
+
+    def _count_successors(self, context: Tuple[int, ...]) -> _Successors:
+        posting_lengths = [self._posting_offsets[token_id + 1] - self._posting_offsets[token_id]
+                           for token_id in context]
+        rarest_index = int(np.argmin(posting_lengths))
+        rarest_id = context[rarest_index]
+
+        # Every position the context could start at, given where its rarest token appears
+        starts = self._postings[self._posting_offsets[rarest_id]:self._posting_offsets[rarest_id + 1]] - rarest_index
+        starts = starts[(starts >= 0) & (starts + len(context) < len(self._corpus))]
+
+        for offset, token_id in enumerate(context):
+            if offset != rarest_index:
+                starts = starts[self._corpus[starts + offset] == token_id]
+
+        # The postings are in corpus order, so the first index of each successor is where it was first seen
+        successor_ids = self._corpus[starts + len(context)]
+        successor_ids = successor_ids[successor_ids != _SEPARATOR]
+        successor_ids, first_indices, counts = np.unique(successor_ids, return_index=True, return_counts=True)
+        order = np.argsort(first_indices)
+        return successor_ids[order], counts[order]
+
+    def _to_ids(self, ngram: _NGram) -> Optional[Tuple[int, ...]]:
+        ids = tuple(self._vocabulary.get_id(token) for token in ngram)
+        return None if len(ids) == 0 or None in ids else ids
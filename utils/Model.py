@@ -1,29 +1,38 @@
 import itertools
 import multiprocessing as mp
+import os
 import random
-from collections import defaultdict
+from collections import Counter, defaultdict
 from functools import partial
-from typing import List, NamedTuple, Iterable, Dict, Optional, Tuple
+from timeit import default_timer as timer
+from typing import Callable, List, Iterable, Dict, Optional, Sequence, Tuple, Union
 
-import ndjson
-import nltk
-from nltk.tokenize import word_tokenize
+import numpy as np
 from numpy.random import beta
 
+from namedtuples.OrderSize import OrderSize
 from namedtuples.Token import Token
-from namedtuples.Tweet import Tweet, tweet_json_decode_hook
-from utils.TweetValidator import should_use_tweet
+from namedtuples.TokenProbability import TokenProbability
+from namedtuples.Tweet import Tweet
+from utils.CompactWeights import CompactWeights
+from utils.IndexedWeights import IndexedWeights
+from utils.Profiler import add_stage_time, count_event, is_profiling, profile_stage
+from utils.TokenCache import TokenCache
+from utils.TweetDump import read_tweets
 
 _NGram = Tuple[Token, ...]
-
-
-class _TokenProbability(NamedTuple):
-    token: Token
-    probability: float
+# Distinct (word, pos) pairs, ids, tweet lengths, and the seconds spent tokenizing and tagging
+_EncodedChunk = Tuple[List[Tuple[str, str]], np.ndarray, np.ndarray, float, float]
+_FIT_CHUNK_SIZE = 10000
+_TOKENIZE_CHUNK_SIZE = 250
+_AnyWeights = Union['_Weights', CompactWeights, IndexedWeights]
 
 
 class _Weights:
-    # TODO experiment with storing tokens/ngrams as ints to save memory
+    # Plain dict backend. Uses far more memory per ngram than CompactWeights, but models pickled before it existed
+    # still have one
+    frozen = False
+
     def __init__(self, n_plus_one_grams: Iterable[_NGram] = None):
         # Using partial(defaultdict, int) instead of standard defaultdict(lambda: int) bc the latter cannot be pickled
         self._counts: Dict[_NGram, Dict[Token, int]] = defaultdict(partial(defaultdict, int))
@@ -35,19 +44,32 @@ class _Weights:
     def add(self, ngram: _NGram, next_token: Token) -> None:
         self._counts[ngram][next_token] += 1
 
+    def add_sequences(self, token_sequences: Sequence[Sequence[Token]], min_n: int, max_n: int,
+                      processes: Optional[int] = None) -> None:
+        for n in range(min_n, max_n + 1):
+            n_plus_one_grammed_sequences = (Model._to_ngrams(tokens, n + 1) for tokens in token_sequences)
+            for n_plus_one_gram in itertools.chain(*n_plus_one_grammed_sequences):  # Flattens the nested lists
+                self.add(n_plus_one_gram[:-1], n_plus_one_gram[-1])
+
     def enough_data_for_prediction(self, ngram: _NGram) -> bool:
         # Returns True if we can predict without just copying a single existing tweet
         num_possible_successors = len(self._counts[ngram].keys())
         total_occurences = sum(self._counts[ngram].values())
         return num_possible_successors > 1 or total_occurences > 2
 
-    def get_successor_probabilities(self, ngram: _NGram) -> List[_TokenProbability]:
+    def get_successor_probabilities(self, ngram: _NGram) -> List[TokenProbability]:
         total_count = sum(self._counts[ngram].values())
-        return [_TokenProbability(pair[0], pair[1] / total_count) for pair in self._counts[ngram].items()]
+        return [TokenProbability(pair[0], pair[1] / total_count) for pair in self._counts[ngram].items()]
 
     def clear(self) -> None:
         self._counts.clear()
 
+    def compact(self) -> None:
+        pass
+
+    def freeze(self) -> None:
+        pass
+
 
 class Model:
     def __init__(self, min_n: int, max_n: int, tweets: Iterable[Tweet] = None):
@@ -56,40 +78,69 @@ class Model:
 
         # Initialized when model is fit
         self._seeds: Optional[List[_NGram]] = None
-        self._weights: Optional[_Weights] = None
+        self._weights: Optional[_AnyWeights] = None
+        self._newest_tweet_id: Optional[int] = None  # Only known when fit on Tweets rather than tokens
+        self._pruned = False
 
         if tweets is not None:
             self.fit(tweets)
 
-    def fit(self, tweets: Iterable[Tweet]) -> None:
-        self._seeds = []
-        self._weights = _Weights()
-
-        self.partial_fit(tweets)
-
-    def partial_fit(self, tweets: Iterable[Tweet]) -> None:
-        tokenized_tweets = self._preprocess_tweets(tweets)
-        self._set_seeds(tokenized_tweets)
-
-        if self._weights is None:
-            self._weights = _Weights()
-
-        for n in range(self._min_n, self._max_n + 1):
-            n_plus_one_grammed_tweets = (Model._to_ngrams(tweet, n + 1) for tweet in tokenized_tweets)
-            for n_plus_one_gram in itertools.chain(*n_plus_one_grammed_tweets):  # Flattens the nested lists
-                ngram = n_plus_one_gram[:-1]
-                next_token = n_plus_one_gram[-1]
-                self._weights.add(ngram, next_token)
+    @property
+    def newest_tweet_id(self) -> Optional[int]:
+        return getattr(self, '_newest_tweet_id', None)  # Models pickled before this was tracked don't have it
+
+    @property
+    def pruned(self) -> bool:
+        return getattr(self, '_pruned', False)
+
+    def fit(self, tweets: Iterable[Tweet], token_cache: Optional[TokenCache] = None,
+            processes: Optional[int] = None) -> None:
+        self._reset()
+        self.partial_fit(tweets, token_cache, processes)
+
+    def partial_fit(self, tweets: Iterable[Tweet], token_cache: Optional[TokenCache] = None,
+                    processes: Optional[int] = None) -> None:
+        # Works through the tweets a chunk at a time so the whole archive is never held in memory at once
+        tweets = iter(tweets)
+        with profile_stage('load'):
+            chunk = list(itertools.islice(tweets, _FIT_CHUNK_SIZE))
+        while len(chunk) > 0:
+            count_event('tweets', len(chunk))
+            self._add_tokenized_tweets(self._tokenize(chunk, token_cache, processes), processes)
+            self._track_newest_tweet_id(chunk)
+            with profile_stage('load'):
+                chunk = list(itertools.islice(tweets, _FIT_CHUNK_SIZE))
+
+        self._finish_fitting()
+
+    def fit_tokenized(self, tokenized_tweets: List[List[Token]], processes: Optional[int] = None) -> None:
+        self._reset()
+        self.partial_fit_tokenized(tokenized_tweets, processes)
+
+    def partial_fit_tokenized(self, tokenized_tweets: List[List[Token]], processes: Optional[int] = None) -> None:
+        self._add_tokenized_tweets(tokenized_tweets, processes)
+        self._finish_fitting()
+
+    def get_seed(self, rng: Optional[np.random.Generator] = None) -> List[Token]:
+        # Like predict_next_token and generate_tokens, uses the global random state unless given an rng
+        with profile_stage('seed'):
+            if rng is not None:
+                random_ngram = self._seeds[int(rng.integers(len(self._seeds)))]
+            else:
+                random_ngram = random.choice(self._seeds)
+            return list(random_ngram)
 
-    def get_seed(self) -> List[Token]:
-        random_ngram = random.choice(self._seeds)
-        return list(random_ngram)
+    def predict_next_token(self, tokens: List[Token], rng: Optional[np.random.Generator] = None) -> Optional[Token]:
+        if self._weights.frozen:
+            return self._predict_next_token_frozen(tokens, rng)
 
-    def predict_next_token(self, tokens: List[Token]) -> Optional[Token]:
         for n in reversed(range(self._min_n, self._max_n + 1)):
             last_ngram = tuple(tokens[-n:])
 
             if self._weights.enough_data_for_prediction(last_ngram) or n == self._min_n:
+                if is_profiling():
+                    count_event(f'backoff_n{len(last_ngram)}')
+
                 successors = self._weights.get_successor_probabilities(last_ngram)
                 successors = list(sorted(successors, key=lambda sp: sp.probability))
 
@@ -97,24 +148,171 @@ class Model:
                     successor_tokens, probabilities = zip(*successors)
                     cumulative_probabilities = [prob + sum(probabilities[:i]) for i, prob in enumerate(probabilities)]
 
-                    random_num = beta(3, 1)  # Skews towards higher numbers. Increases bias towards common patterns
+                    # Skews towards higher numbers. Increases bias towards common patterns
+                    random_num = rng.beta(3, 1) if rng is not None else beta(3, 1)
                     chosen_index = next(i for i, prob in enumerate(cumulative_probabilities) if random_num <= prob)
 
                     return successor_tokens[chosen_index]
                 else:
                     return None
 
-    def generate_tokens(self, n: int) -> List[Token]:
-        chain = self.get_seed()
-        while len(chain) < n:
-            next_token = self.predict_next_token(chain)
+    def _predict_next_token_frozen(self, tokens: List[Token], rng: Optional[np.random.Generator]) -> Optional[Token]:
+        with profile_stage('lookup'):
+            node = self._weights.find_backoff_node(tokens, self._min_n, self._max_n)
+
+        if node is not None:
+            with profile_stage('sample'):
+                return self._weights.sample_successor(node, rng.beta(3, 1) if rng is not None else beta(3, 1))
+        else:
+            return None
+
+    def generate_tokens(self, n: int, token_length: Optional[Callable[[Token], int]] = None,
+                        max_length: Optional[int] = None, rng: Optional[np.random.Generator] = None) -> List[Token]:
+        # Given a token_length, also stops once the chain's total length goes over max_length. The token that took it
+        # over is kept, so callers can tell that apart from the chain ending on its own
+        chain = self.get_seed(rng)
+        length = sum(token_length(token) for token in chain) if token_length is not None else 0
+        while len(chain) < n and (token_length is None or length <= max_length):
+            next_token = self.predict_next_token(chain, rng)
             if next_token is not None:
                 chain.append(next_token)
+                length += token_length(next_token) if token_length is not None else 0
             else:
                 break
 
         return chain
 
+    def generate_batch(self, k: int, n: int, rng: Optional[np.random.Generator] = None,
+                       token_length: Optional[Callable[[Token], int]] = None,
+                       max_length: Optional[int] = None) -> List[List[Token]]:
+        # Same as k calls to generate_tokens, but advances every chain in lockstep, so each step is a handful of numpy
+        # operations over all of them. Only frozen CompactWeights support this; anything else falls back to
+        # generate_tokens with the same rng
+        if not isinstance(self._weights, CompactWeights) or not self._weights.frozen or k == 0:
+            return [self.generate_tokens(n, token_length, max_length, rng) for _ in range(k)]
+
+        rng = rng if rng is not None else np.random.default_rng()
+        vocabulary = self._weights.vocabulary
+        count_event('chains', k)
+
+        with profile_stage('seed'):
+            seed_indices = rng.integers(len(self._seeds), size=k)
+            ids_by_token: Dict[Token, int] = {}
+            seed_ids = [[ids_by_token.setdefault(token, vocabulary.get_id(token)) for token in self._seeds[index]]
+                        for index in seed_indices.tolist()]
+
+        chains = np.zeros((k, max(n, self._min_n)), dtype=np.int64)
+        chains[:, :self._min_n] = seed_ids
+        chain_lengths = np.full(k, self._min_n, dtype=np.int64)
+        alive = np.arange(k)
+
+        if token_length is not None:
+            lengths_by_id: Dict[int, int] = {}
+
+            def get_lengths(token_ids: np.ndarray) -> List[int]:
+                token_ids = token_ids.tolist()
+                for token_id in set(token_ids).difference(lengths_by_id):
+                    lengths_by_id[token_id] = token_length(vocabulary.get_token(token_id))
+                return [lengths_by_id[token_id] for token_id in token_ids]
+
+            text_lengths = np.array(get_lengths(chains[:, :self._min_n].ravel()), dtype=np.int64)
+            text_lengths = text_lengths.reshape(k, self._min_n).sum(axis=1)
+
+        for length in range(self._min_n, n):
+            if token_length is not None:
+                alive = alive[text_lengths[alive] <= max_length]
+
+            with profile_stage('lookup'):
+                nodes = self._weights.find_backoff_nodes(chains[alive, max(length - self._max_n, 0):length],
+                                                         self._min_n, self._max_n)
+            alive = alive[nodes >= 0]
+            nodes = nodes[nodes >= 0]
+            if len(alive) == 0:
+                break
+
+            with profile_stage('sample'):
+                random_nums = rng.beta(3, 1, size=len(alive))  # Skews towards higher numbers, like predict_next_token
+                chains[alive, length] = self._weights.sample_successor_ids(nodes, random_nums)
+            chain_lengths[alive] += 1
+            if token_length is not None:
+                text_lengths[alive] += get_lengths(chains[alive, length])
+
+        count_event('tokens_generated', int(chain_lengths.sum()))
+        tokens_by_id = {token_id: vocabulary.get_token(token_id) for token_id in np.unique(chains).tolist()}
+        return [[tokens_by_id[token_id] for token_id in chain[:chain_length]]
+                for chain, chain_length in zip(chains.tolist(), chain_lengths.tolist())]
+
+    def get_order_sizes(self) -> List[OrderSize]:
+        if not isinstance(self._weights, CompactWeights):
+            raise ValueError('Only models with compact weights have per-order sizes')
+
+        return self._weights.get_order_sizes()
+
+    def prune(self, min_count: int = 0) -> None:
+        # Drops the contexts that predictions always back off past, which leaves every prediction the same. See
+        # CompactWeights.prune for min_count. A pruned model has lost counts it would need to be updated, so it can only
+        # be retrained
+        if not isinstance(self._weights, CompactWeights):
+            raise ValueError('Only models with compact weights can be pruned')
+
+        self._weights.prune(self._min_n, min_count)
+        self._pruned = True
+
+    def count_backoff_orders(self, chains: Iterable[Sequence[Token]]) -> Counter:
+        # How many of the chains' tokens would be predicted from a context of each length, i.e. how often each order
+        # actually gets used. Requires frozen CompactWeights
+        depths = self._weights.get_node_depths()
+        orders = Counter()
+        for chain in chains:
+            for length in range(self._min_n, len(chain)):
+                node = self._weights.find_backoff_node(chain[:length], self._min_n, self._max_n)
+                if node is not None:
+                    orders[int(depths[node])] += 1
+        return orders
+
+    def _reset(self) -> None:
+        self._seeds = []
+        self._weights = self._new_weights()
+        self._newest_tweet_id = None
+        self._pruned = False
+
+    def _add_tokenized_tweets(self, tokenized_tweets: List[List[Token]], processes: Optional[int] = None) -> None:
+        self._set_seeds(tokenized_tweets)
+
+        if self._weights is None:
+            self._weights = self._new_weights()
+
+        with profile_stage('count'):
+            self._weights.add_sequences(tokenized_tweets, self._min_n, self._max_n, processes)
+
+    def _finish_fitting(self) -> None:
+        if self._weights is None:
+            self._weights = self._new_weights()
+
+        with profile_stage('count'):  # Whatever the weights staged while being added to
+            self._weights.compact()
+        with profile_stage('freeze'):
+            self._weights.freeze()
+
+    def _new_weights(self) -> _AnyWeights:
+        return CompactWeights()
+
+    def _tokenize(self, tweets: List[Tweet], token_cache: Optional[TokenCache],
+                  processes: Optional[int]) -> List[List[Token]]:
+        preprocess = partial(self._preprocess_tweets, processes=processes)
+        if token_cache is not None:
+            return token_cache.tokenize(tweets, preprocess)
+        else:
+            return preprocess(tweets)
+
+    def _track_newest_tweet_id(self, tweets: List[Tweet]) -> None:
+        tweet_ids = [tweet.id for tweet in tweets]
+        if self.newest_tweet_id is not None:
+            tweet_ids.append(self.newest_tweet_id)
+
+        if len(tweet_ids) > 0:
+            self._newest_tweet_id = max(tweet_ids)
+
     def _set_seeds(self, tokenized_tweets: Iterable[List[Token]]) -> None:
         if self._seeds is None:
             self._seeds = []
@@ -126,64 +324,109 @@ class Model:
         self._seeds.extend(first_ngrams)
 
     @staticmethod
-    def _to_ngrams(tokens: Iterable[Token], n: int) -> List[_NGram]:
-        return list(nltk.ngrams(tokens, n))
+    def _to_ngrams(tokens: Sequence[Token], n: int) -> List[_NGram]:
+        return list(zip(*(tokens[i:] for i in range(n))))
 
     @staticmethod
-    def _preprocess_tweets(tweets: Iterable[Tweet]) -> List[List[Token]]:
+    def _preprocess_tweets(tweets: Iterable[Tweet], processes: Optional[int] = None) -> List[List[Token]]:
+        # Workers tokenize and tag a chunk of tweets at a time, and send back each chunk's distinct (word, pos) pairs
+        # plus arrays of ids into them, which is much cheaper to pickle than a list of tuples per tweet.
+        # processes defaults to one per CPU, like multiprocessing.Pool
         tweet_texts = (tweet.text for tweet in tweets)
-
-        with mp.Pool() as pool:
-            tokenized_tweets = pool.map(word_tokenize, tweet_texts)
-            pos_tagged_tokenized_tweets = pool.map(nltk.pos_tag, tokenized_tweets)
-
-        # Converts the word-pos tuples returned by nltk.pos_tag() to Token objects
-        return [[Token(*token) for token in tweet] for tweet in pos_tagged_tokenized_tweets]
+        chunks = iter(lambda: list(itertools.islice(tweet_texts, _TOKENIZE_CHUNK_SIZE)), [])
+        processes = processes or os.cpu_count() or 1
+
+        tokens_by_pair: Dict[Tuple[str, str], Token] = {}  # So that every occurrence of a token is the same object
+        tokenized_tweets = []
+
+        def decode_chunk(chunk_result: _EncodedChunk) -> None:
+            word_pos_pairs, token_ids, tweet_lengths, tokenize_seconds, tag_seconds = chunk_result
+            add_stage_time('tokenize', tokenize_seconds, len(tweet_lengths))
+            add_stage_time('tag', tag_seconds, len(tweet_lengths))
+            chunk_tokens = [tokens_by_pair.setdefault(pair, Token(*pair)) for pair in word_pos_pairs]
+            token_ids = token_ids.tolist()
+
+            start = 0
+            for length in tweet_lengths.tolist():
+                tokenized_tweets.append([chunk_tokens[token_id] for token_id in token_ids[start:start + length]])
+                start += length
+
+        if processes > 1:
+            with mp.Pool(processes) as pool:
+                for chunk_result in pool.imap(_tokenize_and_tag_chunk, chunks):
+                    decode_chunk(chunk_result)
+        else:
+            for chunk in chunks:
+                decode_chunk(_tokenize_and_tag_chunk(chunk))
+
+        return tokenized_tweets
+
+
+def _tokenize_and_tag_chunk(tweet_texts: List[str]) -> _EncodedChunk:
+    # nltk is slow to import and only needed for training, so loading a trained model shouldn't pull it in
+    import nltk
+
+    ids_by_pair: Dict[Tuple[str, str], int] = {}
+    token_ids = []
+    tweet_lengths = []
+    tokenize_seconds, tag_seconds = 0.0, 0.0
+    for text in tweet_texts:
+        start = timer()
+        words = nltk.word_tokenize(text)
+        tokenized = timer()
+        word_pos_pairs = nltk.pos_tag(words)
+        tokenize_seconds += tokenized - start
+        tag_seconds += timer() - tokenized
+
+        token_ids.extend(ids_by_pair.setdefault(pair, len(ids_by_pair)) for pair in word_pos_pairs)
+        tweet_lengths.append(len(word_pos_pairs))
+
+    return list(ids_by_pair), np.array(token_ids, dtype=np.int32), np.array(tweet_lengths, dtype=np.int32), \
+        tokenize_seconds, tag_seconds
 
 
 class LazyFitModel(Model):
-    def __init__(self, min_n: int, max_n: int, tweets: Iterable[Tweet] = None):
-        self._tokenized_tweets = None
-        super().__init__(min_n, max_n, tweets)
+    # Only indexes the tweets when fit, and counts the successors of a context when a prediction needs them. Uses much
+    # less memory than counting every ngram up front, at the cost of slower predictions
+    def _new_weights(self) -> _AnyWeights:
+        return IndexedWeights()
+
+    def __setstate__(self, state: Dict) -> None:
+        # Models pickled before IndexedWeights kept every tokenized tweet alongside empty dict weights, and counted
+        # from the tweets when predicting. The index gets built from them instead
+        tokenized_tweets = state.pop('_tokenized_tweets', None)
+        self.__dict__.update(state)
+        if tokenized_tweets is not None:
+            self._weights = self._new_weights()
+            self._weights.add_sequences(tokenized_tweets, self._min_n, self._max_n)
+            self._finish_fitting()
+
+
+def train_model_from_file(tweets_ndjson_filename: str, min_n: int, max_n: int, lazy_fitting: bool,
+                          token_cache: Optional[TokenCache] = None, processes: Optional[int] = None) -> Model:
+    tweets = read_tweets(tweets_ndjson_filename, only_usable=True)
 
-    def fit(self, tweets: Iterable[Tweet]) -> None:
-        self._tokenized_tweets = []
-        super().fit(tweets)
-
-    def partial_fit(self, tweets: Iterable[Tweet]) -> None:
-        self._tokenized_tweets = self._preprocess_tweets(tweets)
-        self._set_seeds(self._tokenized_tweets)
-
-        if self._weights is None:
-            self._weights = _Weights()
-
-    def predict_next_token(self, tokens: List[Token]) -> Optional[Token]:
-        for n in range(self._min_n, self._max_n + 1):
-            # TODO only train the model on the n needed (aka avoid parsing the n=1 level unless necessary b/c it's big)
-            last_n_tokens = tokens[-n:]
-            relevant_tweets = (tweet for tweet in self._tokenized_tweets if
-                               all((token in tweet) for token in last_n_tokens))
-
-            for tweet in relevant_tweets:
-                for n_plus_one_gram in Model._to_ngrams(tweet, n + 1):
-                    ngram = n_plus_one_gram[:-1]
-                    next_token = n_plus_one_gram[-1]
-                    self._weights.add(ngram, next_token)
+    if lazy_fitting:
+        model = LazyFitModel(min_n, max_n)
+    else:
+        model = Model(min_n, max_n)
 
-        prediction = super().predict_next_token(tokens)
-        self._weights.clear()
-        return prediction
+    model.fit(tweets, token_cache, processes)
+    return model
 
 
-def train_model_from_file(tweets_ndjson_filename: str, min_n: int, max_n: int, lazy_fitting: bool) -> Model:
-    with open(tweets_ndjson_filename, 'r') as fp:
-        tweets = ndjson.load(fp, object_hook=tweet_json_decode_hook)
+def can_update_model(model: Model, min_n: int, max_n: int, lazy_fitting: bool) -> bool:
+    # Updating only gives the same model as retraining if it was trained with the same settings
+    return model.newest_tweet_id is not None and not model.pruned \
+        and (model._min_n, model._max_n) == (min_n, max_n) and isinstance(model, LazyFitModel) == lazy_fitting
 
-    tweets = (tweet for tweet in tweets if should_use_tweet(tweet))
 
-    if lazy_fitting:
-        model = LazyFitModel(min_n, max_n, tweets)
-    else:
-        model = Model(min_n, max_n, tweets)
+def update_model_from_file(model: Model, tweets_ndjson_filename: str, token_cache: Optional[TokenCache] = None,
+                           processes: Optional[int] = None) -> int:
+    # Fits the model on only the tweets newer than any it has seen. Returns how many new tweets it was fit on
+    tweets = read_tweets(tweets_ndjson_filename, only_usable=True)
+    new_tweets = [tweet for tweet in tweets if tweet.id > model.newest_tweet_id]
+    if len(new_tweets) > 0:
+        model.partial_fit(new_tweets, token_cache, processes)
 
-    return model
+    return len(new_tweets)
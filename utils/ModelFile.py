@@ -0,0 +1,270 @@
+import json
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from collections.abc import Sequence
+from functools import partial
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from namedtuples.Token import Token
+from utils.CompactWeights import CompactWeights, Vocabulary
+from utils.Model import LazyFitModel, Model, _Weights
+from utils.Profiler import profile_stage
+from utils.TweetQueue import get_model_version
+
+# File layout: the header, then the section index, then each section's raw bytes (8-byte aligned).
+# Sections are flat numpy arrays, so loading a model just maps the file and wraps the sections without copying them
+_MAGIC = b'DTBMODEL'
+_VERSION = 1
+_HEADER = struct.Struct('<8sII')  # Magic, version, section count
+_INDEX_ENTRY = struct.Struct('<24s8sQQ')  # Name, dtype, byte offset, item count
+_ALIGNMENT = 8
+
+_TOKEN_SEPARATOR = b'\0'
+
+
+def _encode_token(token: Token) -> bytes:
+    return token.word.encode('utf-8') + _TOKEN_SEPARATOR + token.pos.encode('utf-8')
+
+
+def _decode_token(encoded: bytes) -> Token:
+    word, pos = encoded.split(_TOKEN_SEPARATOR)
+    return Token(word.decode('utf-8'), pos.decode('utf-8'))
+
+
+class MappedVocabulary(Vocabulary):
+    # Read-only view over the token blob of a model file. Tokens are decoded on demand, and ids are looked up with a
+    # binary search over a sorted permutation so no dict of the whole vocabulary is built. Tokens interned after loading
+    # are kept in memory on top of the mapped ones
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, sorted_ids: np.ndarray):
+        super().__init__()
+        self._blob = blob
+        self._blob_offsets = offsets
+        self._sorted_ids = sorted_ids
+        self._num_mapped = len(offsets) - 1
+
+    def __len__(self) -> int:
+        return self._num_mapped + len(self._tokens)
+
+    def intern(self, token: Token) -> int:
+        token_id = self.get_id(token)
+        if token_id is None:
+            token_id = len(self)
+            self._ids[token] = token_id
+            self._tokens.append(token)
+        return token_id
+
+    def get_id(self, token: Token) -> Optional[int]:
+        encoded = _encode_token(token)
+
+        low, high = 0, self._num_mapped
+        while low < high:
+            middle = (low + high) // 2
+            middle_encoded = self._get_encoded(int(self._sorted_ids[middle]))
+            if middle_encoded < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._num_mapped and self._get_encoded(int(self._sorted_ids[low])) == encoded:
+            return int(self._sorted_ids[low])
+        else:
+            return self._ids.get(token)
+
+    def get_token(self, token_id: int) -> Token:
+        if token_id < self._num_mapped:
+            return _decode_token(self._get_encoded(token_id))
+        else:
+            return self._tokens[token_id - self._num_mapped]
+
+    def _get_encoded(self, token_id: int) -> bytes:
+        return self._blob[self._blob_offsets[token_id]:self._blob_offsets[token_id + 1]].tobytes()
+
+
+class _MappedSeeds(Sequence):
+    # Seed ngrams stored as rows of token ids. Supports extend() so that a loaded model can still be partially fit
+    def __init__(self, vocabulary: Vocabulary, seed_ids: np.ndarray):
+        self._vocabulary = vocabulary
+        self._seed_ids = seed_ids
+        self._extra_seeds: List[Tuple[Token, ...]] = []
+
+    def __len__(self) -> int:
+        return len(self._seed_ids) + len(self._extra_seeds)
+
+    def __getitem__(self, index: int) -> Tuple[Token, ...]:
+        if index < 0:
+            index += len(self)
+
+        if index < len(self._seed_ids):
+            return tuple(self._vocabulary.get_token(int(token_id)) for token_id in self._seed_ids[index])
+        else:
+            return self._extra_seeds[index - len(self._seed_ids)]
+
+    def extend(self, seeds) -> None:
+        self._extra_seeds.extend(seeds)
+
+
+def _build_sections(model: Model) -> Dict[str, np.ndarray]:
+    weights: CompactWeights = model._weights
+    vocabulary = weights.vocabulary
+
+    encoded_tokens = [_encode_token(vocabulary.get_token(token_id)) for token_id in range(len(vocabulary))]
+    token_offsets = np.zeros(len(encoded_tokens) + 1, dtype=np.int64)
+    np.cumsum([len(encoded) for encoded in encoded_tokens], out=token_offsets[1:])
+
+    seed_ids = np.array([[vocabulary.get_id(token) for token in seed] for seed in model._seeds],
+                        dtype=np.uint32).reshape(-1, model._min_n)
+
+    metadata = {'min_n': model._min_n, 'max_n': model._max_n, 'newest_tweet_id': model.newest_tweet_id,
+                'pruned': model.pruned}
+
+    sections = {
+        'metadata': np.frombuffer(json.dumps(metadata).encode('utf-8'), dtype=np.uint8),
+        'token_blob': np.frombuffer(b''.join(encoded_tokens), dtype=np.uint8),
+        'token_offsets': token_offsets,
+        'token_sorted_ids': np.array(sorted(range(len(encoded_tokens)), key=lambda i: encoded_tokens[i]),
+                                     dtype=np.uint32),
+        'seed_ids': seed_ids
+    }
+    sections.update(weights.to_arrays())
+    return sections
+
+
+def save_model(model: Model, filename: str) -> None:
+    with profile_stage('serialize'):
+        # Models without compact weights (e.g. LazyFitModel) can't be stored in the binary format, so they get pickled
+        if not isinstance(model._weights, CompactWeights):
+            _replace_file(filename, partial(pickle.dump, model))
+        else:
+            _write_sections(_build_sections(model), filename)
+
+
+def _replace_file(filename: str, write: Callable[[BinaryIO], None]) -> None:
+    # Other processes may have the old file open or mapped, so it gets replaced instead of being overwritten in place.
+    # The temp file's name is unique, so two processes saving at once can't write into each other's
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix=f'{os.path.basename(filename)}.',
+                                         suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            write(fp)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def _write_sections(sections: Dict[str, np.ndarray], filename: str) -> None:
+    data_offset = _HEADER.size + _INDEX_ENTRY.size * len(sections)
+    index = []
+    for name, array in sections.items():
+        data_offset += -data_offset % _ALIGNMENT
+        index.append(_INDEX_ENTRY.pack(name.encode('ascii'), array.dtype.str.encode('ascii'), data_offset, array.size))
+        data_offset += array.nbytes
+
+    def write(fp: BinaryIO) -> None:
+        fp.write(_HEADER.pack(_MAGIC, _VERSION, len(sections)))
+        fp.write(b''.join(index))
+        for array in sections.values():
+            fp.write(b'\0' * (-fp.tell() % _ALIGNMENT))
+            fp.write(np.ascontiguousarray(array).tobytes())
+
+    _replace_file(filename, write)
+
+
+def _read_sections(buffer: mmap.mmap) -> Dict[str, np.ndarray]:
+    magic, version, num_sections = _HEADER.unpack_from(buffer, 0)
+    if magic != _MAGIC:
+        raise ValueError('Not a binary model file')
+    elif version != _VERSION:
+        raise ValueError(f'Unsupported model file version {version} (expected {_VERSION})')
+
+    sections = {}
+    for i in range(num_sections):
+        name, dtype, offset, count = _INDEX_ENTRY.unpack_from(buffer, _HEADER.size + i * _INDEX_ENTRY.size)
+        name = name.rstrip(b'\0').decode('ascii')
+        sections[name] = np.frombuffer(buffer, dtype=np.dtype(dtype.rstrip(b'\0').decode('ascii')), count=count,
+                                       offset=offset)
+    return sections
+
+
+def is_model_file(filename: str) -> bool:
+    with open(filename, 'rb') as fp:
+        return fp.read(len(_MAGIC)) == _MAGIC
+
+
+def load_model(filename: str) -> Model:
+    with profile_stage('load_model'):
+        return _load_model(filename)
+
+
+def _load_model(filename: str) -> Model:
+    if not is_model_file(filename):
+        with open(filename, 'rb') as fp:
+            return pickle.load(fp)
+
+    with open(filename, 'rb') as fp:
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    sections = _read_sections(buffer)
+    metadata = json.loads(sections['metadata'].tobytes().decode('utf-8'))
+
+    vocabulary = MappedVocabulary(sections['token_blob'], sections['token_offsets'], sections['token_sorted_ids'])
+
+    model = Model(metadata['min_n'], metadata['max_n'])
+    model._seeds = _MappedSeeds(vocabulary, sections['seed_ids'].reshape(-1, metadata['min_n']))
+    model._weights = CompactWeights.from_arrays(vocabulary, sections)
+    model._newest_tweet_id = metadata.get('newest_tweet_id')
+    model._pruned = metadata.get('pruned', False)
+    return model
+
+
+def convert_pickled_model(pickled_model_filename: str, output_filename: str) -> None:
+    with open(pickled_model_filename, 'rb') as fp:
+        model: Model = pickle.load(fp)
+
+    if isinstance(model, LazyFitModel):
+        raise ValueError('Lazily fit models have no weights to convert')
+
+    # Models pickled before CompactWeights existed store their counts in nested dicts
+    if isinstance(model._weights, _Weights):
+        compact_weights = CompactWeights()
+        for ngram, successor_counts in model._weights._counts.items():
+            for next_token, count in successor_counts.items():
+                compact_weights.add(ngram, next_token, count)
+        model._weights = compact_weights
+
+    model._weights.freeze()
+    save_model(model, output_filename)
+
+
+def migrate_pickled_model(model_filename: str, pickled_model_filename: str) -> str:
+    # For deployments from before the binary format, which only have a pickled model. Converts it if there's no model
+    # file yet, and returns the file to use from then on: the pickle itself for lazily fit models, which can't be
+    # converted
+    if os.path.exists(model_filename) or not os.path.exists(pickled_model_filename):
+        return model_filename
+
+    try:
+        convert_pickled_model(pickled_model_filename, model_filename)
+        return model_filename
+    except ValueError:
+        return pickled_model_filename
+
+
+class ResidentModel:
+    # Keeps a model loaded between uses, for processes that run for a long time. The model file is checked on every
+    # get(), and a new one (e.g. from train) is loaded in place of the old
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._model: Optional[Model] = None
+        self._version: Optional[str] = None
+
+    def get(self) -> Model:
+        version = get_model_version(self._filename)
+        if self._model is None or version != self._version:
+            self._model = load_model(self._filename)
+            self._version = version
+        return self._model
@@ -0,0 +1,112 @@
+import os
+import sys
+from collections import OrderedDict
+from contextlib import nullcontext
+from timeit import default_timer as timer
+from typing import ContextManager, Dict, Optional
+
+# Per-stage timings and counters for the train and generate paths. Off unless enable_profiling() is called or the
+# environment variable below is set. While it's off, profile_stage() returns a shared no-op and the other functions
+# return straight away, so the calls can stay in the hot paths. The module is cheap to import too, since the CLI always
+# does.
+# Stage times include any stages nested inside them. Stages that run in worker processes are timed there and added up
+# with add_stage_time(), so they can add up to more than the wall time
+PROFILE_ENV_VAR = 'DTB_PROFILE'
+
+_enabled = os.environ.get(PROFILE_ENV_VAR, '') not in ('', '0')
+_start_time = timer()
+_stages: Dict[str, Dict[str, float]] = OrderedDict()
+_counters: Dict[str, int] = OrderedDict()
+_values: Dict[str, object] = OrderedDict()
+_NO_STAGE = nullcontext()
+
+
+class _Stage:
+    def __init__(self, name: str):
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self) -> None:
+        self._start = timer()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        add_stage_time(self._name, timer() - self._start)
+
+
+def enable_profiling() -> None:
+    global _enabled
+    _enabled = True
+
+
+def is_profiling() -> bool:
+    return _enabled
+
+
+def reset_profile() -> None:
+    global _start_time
+    _start_time = timer()
+    _stages.clear()
+    _counters.clear()
+    _values.clear()
+
+
+def profile_stage(name: str) -> ContextManager:
+    return _Stage(name) if _enabled else _NO_STAGE
+
+
+def add_stage_time(name: str, seconds: float, calls: int = 1) -> None:
+    if _enabled:
+        stage = _stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+
+
+def count_event(name: str, amount: int = 1) -> None:
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_profile_value(name: str, value: object) -> None:
+    # Anything JSON serializable, e.g. the size of the model's tables
+    if _enabled:
+        _values[name] = value
+
+
+def _get_peak_rss_bytes(children: bool = False) -> Optional[int]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux gives kilobytes, macOS bytes
+
+
+def get_profile() -> Dict:
+    from datetime import datetime, timezone
+
+    return OrderedDict([
+        ('finished_at', datetime.now(timezone.utc).isoformat()),
+        ('wall_seconds', timer() - _start_time),
+        ('peak_rss_bytes', _get_peak_rss_bytes()),
+        ('peak_child_rss_bytes', _get_peak_rss_bytes(children=True)),  # The largest worker process
+        ('stages', _stages),
+        ('counters', _counters),
+        ('values', _values)
+    ])
+
+
+def save_profile(filename: Optional[str], **extra) -> None:
+    # Appends the profile to filename as a line of ndjson, so each run adds one to compare against the last. Without
+    # a filename it's printed instead
+    import json
+
+    profile = OrderedDict(extra)
+    profile.update(get_profile())
+    line = json.dumps(profile)
+
+    if filename is None:
+        print(line)
+    else:
+        with open(filename, 'a') as fp:
+            fp.write(line + '\n')
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from namedtuples.Token import Token
+from namedtuples.Tweet import Tweet
+from utils.Profiler import count_event
+
+# Bump this whenever tokenization changes in a way the nltk version doesn't capture
+_TOKENIZER_VERSION = 1
+_LOOKUP_BATCH_SIZE = 500  # Ids per query, well under SQLite's limit on query parameters
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokenized_tweets (
+    tweet_id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+'''
+
+
+def _get_tokenizer_version() -> str:
+    import nltk
+    return f'{_TOKENIZER_VERSION}/nltk-{nltk.__version__}'
+
+
+def _hash_text(text: str, tokenizer_version: str) -> str:
+    return hashlib.sha1(f'{tokenizer_version}\0{text}'.encode('utf-8')).hexdigest()[:16]
+
+
+class TokenCache:
+    # SQLite sidecar to the tweet dump holding each tweet's tokens. Entries are keyed by tweet id and only used if the
+    # hash of the tweet's text and the tokenizer version still matches, so edited tweets and nltk upgrades get redone.
+    # Only the tweets being tokenized are ever looked up, and none are if they're all newer than anything in the cache,
+    # so an incremental train never reads the whole thing. Tokens are shared between every tweet they appear in
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._tokenizer_version = _get_tokenizer_version()
+        self._connection: Optional[sqlite3.Connection] = None  # Opened the first time it's needed
+        self._newest_tweet_id: Optional[int] = None
+        self._tokens_by_pair: Dict[Tuple[str, str], Token] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self) -> 'TokenCache':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def tokenize(self, tweets: Iterable[Tweet],
+                 preprocess: Callable[[Iterable[Tweet]], List[List[Token]]]) -> List[List[Token]]:
+        tweets = list(tweets)
+        hashes = [_hash_text(tweet.text, self._tokenizer_version) for tweet in tweets]
+        cached = self._look_up([tweet.id for tweet in tweets])
+
+        results: List[List[Token]] = []
+        misses: List[int] = []
+        for i, (tweet, text_hash) in enumerate(zip(tweets, hashes)):
+            cached_hash, cached_tokens = cached.get(tweet.id, (None, None))
+            if cached_hash == text_hash:
+                results.append(self._decode_tokens(cached_tokens))
+            else:
+                results.append([])
+                misses.append(i)
+
+        tokenized_misses = preprocess([tweets[i] for i in misses]) if len(misses) > 0 else []
+        new_entries = []
+        for i, tokens in zip(misses, tokenized_misses):
+            results[i] = tokens
+            new_entries.append((tweets[i].id, hashes[i], json.dumps(tokens)))
+
+        self.hits += len(tweets) - len(misses)
+        self.misses += len(misses)
+        count_event('token_cache_hits', len(tweets) - len(misses))
+        count_event('token_cache_misses', len(misses))
+
+        self._save(new_entries)
+        return results
+
+    def _look_up(self, tweet_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        # The cached hash and encoded tokens of whichever of the tweets are in the cache
+        if len(tweet_ids) == 0 or not os.path.exists(self._filename):
+            return {}
+
+        connection = self._connect()
+        if self._newest_tweet_id is None or min(tweet_ids) > self._newest_tweet_id:
+            return {}
+
+        cached = {}
+        for start in range(0, len(tweet_ids), _LOOKUP_BATCH_SIZE):
+            batch = tweet_ids[start:start + _LOOKUP_BATCH_SIZE]
+            rows = connection.execute('SELECT tweet_id, hash, tokens FROM tokenized_tweets WHERE tweet_id IN '
+                                      f'({", ".join("?" * len(batch))})', batch)
+            cached.update((tweet_id, (text_hash, tokens)) for tweet_id, text_hash, tokens in rows)
+        return cached
+
+    def _decode_tokens(self, encoded: str) -> List[Token]:
+        return [self._tokens_by_pair.setdefault(pair, Token(*pair)) for pair in map(tuple, json.loads(encoded))]
+
+    def _save(self, new_entries: List[Tuple[int, str, str]]) -> None:
+        if len(new_entries) == 0:
+            return
+
+        connection = self._connect()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO tokenized_tweets (tweet_id, hash, tokens) VALUES (?, ?, ?)',
+                                   new_entries)
+
+        newest_saved_id = max(tweet_id for tweet_id, _, _ in new_entries)
+        if self._newest_tweet_id is None or newest_saved_id > self._newest_tweet_id:
+            self._newest_tweet_id = newest_saved_id
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._filename)
+            self._connection.executescript(_SCHEMA)
+            self._newest_tweet_id = self._connection.execute('SELECT MAX(tweet_id) FROM tokenized_tweets').fetchone()[0]
+        return self._connection
+
+
+def clear_token_cache(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
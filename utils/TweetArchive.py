@@ -0,0 +1,143 @@
+import json
+import mmap
+import os
+from collections.abc import Sequence
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List
+
+import numpy as np
+
+from namedtuples.Tweet import Tweet
+from namedtuples.TweetColumns import TweetColumns, get_text, tweets_to_columns
+from utils.Profiler import profile_stage
+from utils.TweetValidator import find_usable_tweets
+
+# An archive is a directory with one file per column, each just the column's values back to back, plus a metadata file
+# with the number of tweets and the names the source column's values index into. Appending writes to the end of every
+# column and then replaces the metadata, so a reader never sees a half-written tweet; anything past what the metadata
+# counts is left over from an append that didn't finish, and gets overwritten by the next one
+ARCHIVE_SUFFIX = '.archive'
+_VERSION = 1
+_METADATA_FILENAME = 'metadata.json'
+_COLUMNS = {
+    'ids': np.int64,
+    'created_at': np.int64,
+    'is_retweet': np.bool_,
+    'sources': np.int32,
+    'text_offsets': np.int64,  # One longer than the others, starting with a 0
+    'text_blob': np.uint8
+}
+
+
+def is_tweet_archive(filename: str) -> bool:
+    return os.path.isdir(filename) or filename.endswith(ARCHIVE_SUFFIX)
+
+
+def _read_metadata(directory: str) -> Dict:
+    try:
+        with open(os.path.join(directory, _METADATA_FILENAME), 'r') as fp:
+            metadata = json.load(fp)
+    except FileNotFoundError:
+        return {'version': _VERSION, 'num_tweets': 0, 'num_text_bytes': 0, 'source_names': []}
+
+    if metadata['version'] != _VERSION:
+        raise ValueError(f'Unsupported tweet archive version {metadata["version"]} (expected {_VERSION})')
+    return metadata
+
+
+def _write_metadata(directory: str, metadata: Dict) -> None:
+    temp_filename = os.path.join(directory, f'{_METADATA_FILENAME}.tmp')
+    with open(temp_filename, 'w') as fp:
+        json.dump(metadata, fp)
+    os.replace(temp_filename, os.path.join(directory, _METADATA_FILENAME))
+
+
+def _get_column_lengths(metadata: Dict) -> Dict[str, int]:
+    lengths = {name: metadata['num_tweets'] for name in _COLUMNS}
+    lengths['text_offsets'] = metadata['num_tweets'] + 1 if metadata['num_tweets'] > 0 else 0
+    lengths['text_blob'] = metadata['num_text_bytes']
+    return lengths
+
+
+def _map_column(directory: str, name: str, length: int) -> np.ndarray:
+    if length == 0:
+        return np.zeros(0, dtype=_COLUMNS[name])  # Empty files can't be mapped
+
+    with open(os.path.join(directory, f'{name}.bin'), 'rb') as fp:
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(buffer, dtype=_COLUMNS[name], count=length)
+
+
+class TweetArchive(Sequence):
+    # Read-only view over an archive with its columns mapped into memory. Tweets are only built when they're asked for
+    def __init__(self, directory: str):
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f'No tweet archive at {directory}')
+
+        metadata = _read_metadata(directory)
+        lengths = _get_column_lengths(metadata)
+        columns = {name: _map_column(directory, name, lengths[name]) for name in _COLUMNS}
+        if len(columns['text_offsets']) == 0:
+            columns['text_offsets'] = np.zeros(1, dtype=np.int64)  # Only written along with the first tweet
+
+        self.columns = TweetColumns(columns['ids'], columns['created_at'], columns['is_retweet'], columns['sources'],
+                                    metadata['source_names'], columns['text_offsets'], columns['text_blob'])
+
+    def __len__(self) -> int:
+        return len(self.columns.ids)
+
+    def __getitem__(self, index: int) -> Tweet:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Tweet index out of range')
+
+        return Tweet(
+            int(self.columns.ids[index]),
+            get_text(self.columns, index),
+            self.columns.source_names[self.columns.sources[index]],
+            datetime.fromtimestamp(int(self.columns.created_at[index]), timezone.utc),
+            bool(self.columns.is_retweet[index])
+        )
+
+    def iter_tweets(self, only_usable: bool = False) -> Iterator[Tweet]:
+        # Filtering happens on the columns, so tweets that get filtered out are never built
+        if only_usable:
+            with profile_stage('filter'):
+                usable, _ = find_usable_tweets(self.columns)
+            indexes = np.flatnonzero(usable).tolist()
+        else:
+            indexes = range(len(self))
+
+        for index in indexes:
+            yield self[index]
+
+
+def append_tweets_to_archive(directory: str, tweets: Iterable[Tweet]) -> int:
+    # Returns how many tweets were appended. Creates the archive if it doesn't exist yet
+    os.makedirs(directory, exist_ok=True)
+    metadata = _read_metadata(directory)
+
+    # tweets_to_columns numbers the sources and offsets the texts as if these were the only tweets
+    new_columns = tweets_to_columns(list(tweets))
+    source_names: List[str] = metadata['source_names'] + [name for name in new_columns.source_names
+                                                          if name not in metadata['source_names']]
+    source_indexes = np.array([source_names.index(name) for name in new_columns.source_names], dtype=np.int32)
+    new_columns = new_columns._replace(sources=source_indexes[new_columns.sources],
+                                       text_offsets=new_columns.text_offsets + metadata['num_text_bytes'])
+
+    lengths = _get_column_lengths(metadata)
+    for name, dtype in _COLUMNS.items():
+        values = getattr(new_columns, name)
+        if name == 'text_offsets' and metadata['num_tweets'] > 0:
+            values = values[1:]  # The archive already has the offset the new texts start at
+
+        with open(os.path.join(directory, f'{name}.bin'), 'ab') as fp:
+            fp.truncate(lengths[name] * np.dtype(dtype).itemsize)
+            fp.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+    metadata['num_tweets'] += len(new_columns.ids)
+    metadata['num_text_bytes'] += len(new_columns.text_blob)
+    metadata['source_names'] = source_names
+    _write_metadata(directory, metadata)
+    return len(new_columns.ids)
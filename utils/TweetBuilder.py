@@ -1,89 +1,138 @@
-from typing import Iterable
+from typing import Dict, Iterable, List, Optional
 
-import nltk
+import numpy as np
 
 from namedtuples.Token import Token
 from utils.Model import Model
+from utils.Profiler import count_event, profile_stage
 
+# Curly and doubled quotes all become plain ones
+_QUOTE_REPLACEMENTS = [('“', '"'), ('”', '"'), ('``', '"'), ("''", '"'), ('‘', "'"), ('’', "'")]
+_REPLACEMENTS = [
+    (' ,', ','), (' .', '.'), (' ?', '?'), (' !', '!'), (' :', ':'), (' ;', ';'), ('... ', '...'), (' …', '…'),
+    ('. @', '.@'), ('@ ', '@'), ('- -', '--'), ('$ ', '$'), (' %', '%'), ('MS - 13', 'MS-13'),
+    ('# ', '#'), ('w /', 'w/'), (' / ', '/'), *_QUOTE_REPLACEMENTS, (" n't", "n't"), (" 't", "'t"), (" ' t", "'t"),
+    (" 's", "'s"), (" ' s", "'s"), (" 'v", "'v"), (" ' v", "'v"), (" 'm", "'m"), (" 're", "'re"), (" ' re", "'re"),
+    (" 'll", "'ll"), ("' 0", "'0"), ('https: //', 'https://'), ('http: //', 'http://'), ('& amp;', '&'),
+    (" ' ", ' " '),
+]
+# Words starting with these lose the space before them, i.e. the replacements above that just remove a space
+_NO_SPACE_BEFORE_STARTS = tuple(new for old, new in _REPLACEMENTS if old == f' {new}')
+_SENTENCE_END_POS = '.'  # What nltk's tagger gives sentence-ending punctuation
 
-def _fix_quotes(s: str) -> str:
-    first_quote_index = s.find('"')
-    second_quote_index = s.find('"', first_quote_index + 1)
+_token_lengths: Dict[str, int] = {}
 
-    # If there was only one quote
-    if second_quote_index == -1:
-        return s.replace(' " ', ' ')
-    else:
-        head = s[:second_quote_index + 2]  # Get the whitespace after it too
-        fixed_head = head.replace(' " ', ' "', 1).replace(' " ', '" ', 1)
 
-        tail = s[second_quote_index + 2:]
-        fixed_tail = _fix_quotes(tail)
+def _fix_quotes(s: str) -> str:
+    # Quotes pair up in order, and each pair loses the space inside it. A quote left over at the end is dropped.
+    # Works through the pairs in a loop rather than recursing on the rest of the string, so there's no limit on how many
+    # quotes a tweet can have
+    fixed_parts = []
+    start = 0
+    while True:
+        first_quote_index = s.find('"', start)
+        second_quote_index = s.find('"', first_quote_index + 1) if first_quote_index != -1 else -1
 
-        return f'{fixed_head}{fixed_tail}'
+        # If there was only one quote
+        if second_quote_index == -1:
+            fixed_parts.append(s[start:].replace(' " ', ' '))
+            return ''.join(fixed_parts)
 
+        head = s[start:second_quote_index + 2]  # Get the whitespace after it too
+        fixed_parts.append(head.replace(' " ', ' "', 1).replace(' " ', '" ', 1))
+        start = second_quote_index + 2
 
-def _fix_parenthesis(s: str) -> str:
-    first_opener_index = s.find('(')
-    first_closer_index = s.find(')')
 
-    if first_opener_index == -1:
-        return s.replace(')', ' ')
-    elif first_closer_index == -1:
-        return s.replace('(', ' ')
-    else:
-        up_to_first_opener = s[:first_opener_index].strip()
-        between_parenthesis = s[first_opener_index + 1:first_closer_index].strip()
-        after_first_closer = s[first_closer_index + 1:].strip()
-
-        return f'{up_to_first_opener} ({_fix_parenthesis(between_parenthesis)}) {_fix_parenthesis(after_first_closer)}'
+def _fix_parenthesis(s: str) -> str:
+    # Each opening parenthesis pairs with the first closing one after it, with one space outside and none inside. Other
+    # parentheses are dropped. Loops over the pairs like _fix_quotes
+    fixed_parts = []
+    start = 0
+    while True:
+        first_opener_index = s.find('(', start)
+        first_closer_index = s.find(')', start)
+
+        if first_opener_index == -1 or first_closer_index == -1:
+            rest = s[start:] if start == 0 else s[start:].strip()
+            fixed_parts.append(rest.replace(')' if first_opener_index == -1 else '(', ' '))
+            return ''.join(fixed_parts)
+        elif first_closer_index < first_opener_index:  # Nothing for it to close
+            fixed_parts.append(f'{s[start:first_closer_index]} ')
+            start = first_closer_index + 1
+        else:
+            up_to_first_opener = s[start:first_opener_index].strip()
+            between_parenthesis = s[first_opener_index + 1:first_closer_index].strip().replace('(', ' ')
+            fixed_parts.append(f'{up_to_first_opener} ({between_parenthesis}) ')
+            start = first_closer_index + 1
 
 
 def _join_tokens(tokens: Iterable[Token]) -> str:
     # This function has just been hacked together through trial and error. Language is hard and weird
-    output = ' '.join(token.word for token in tokens)
-
-    replacements = [
-        (' ,', ','), (' .', '.'), (' ?', '?'), (' !', '!'), (' :', ':'), (' ;', ';'), ('... ', '...'), (' …', '…'),
-        ('. @', '.@'), ('@ ', '@'), ('- -', '--'), ('$ ', '$'), (' %', '%'), ('MS - 13', 'MS-13'),
-        ('# ', '#'), ('w /', 'w/'), (' / ', '/'), ('“', '"'), ('”', '"'), ('``', '"'), ("''", '"'), ('‘', "'"),
-        ('’', "'"), (" n't", "n't"), (" 't", "'t"), (" ' t", "'t"), (" 's", "'s"), (" ' s", "'s"), (" 'v", "'v"),
-        (" ' v", "'v"), (" 'm", "'m"), (" 're", "'re"), (" ' re", "'re"), (" 'll", "'ll"), ("' 0", "'0"),
-        ('https: //', 'https://'), ('http: //', 'http://'), ('& amp;', '&'), (" ' ", ' " '),
-    ]
-    for replacement_pair in replacements:  # Order does matter
-        output = output.replace(*replacement_pair)
-
-    output = _fix_quotes(output)
-    output = _fix_parenthesis(output)
-    output = output.replace('   ', ' ')  # The above methods sometimes introduce extra spaces
-    output = output.replace('  ', ' ')
-
-    return output.strip()
-
-
-def _prune_tweet(tweet: str, max_length: int) -> str:
-    sentences = nltk.tokenize.sent_tokenize(tweet)
-
-    result = ''
-    for sentence in sentences:
-        result_after_appending = f'{result} {sentence}'
-        if len(result_after_appending) > max_length:
-            break
-        else:
-            result = result_after_appending
+    with profile_stage('join'):
+        output = ' '.join(token.word for token in tokens)
+
+        for replacement_pair in _REPLACEMENTS:  # Order does matter
+            output = output.replace(*replacement_pair)
+
+        output = _fix_quotes(output)
+        output = _fix_parenthesis(output)
+        output = output.replace('   ', ' ')  # The above methods sometimes introduce extra spaces
+        output = output.replace('  ', ' ')
 
-    return result.strip()
+        return output.strip()
+
+
+def _token_length(token: Token) -> int:
+    # How much a token adds to the detokenized text, counting the space before it. Only the words _join_tokens has
+    # special cases for can come out shorter than this
+    length = _token_lengths.get(token.word)
+    if length is None:
+        normalized = token.word
+        for quote_replacement in _QUOTE_REPLACEMENTS:
+            normalized = normalized.replace(*quote_replacement)
+        length = len(normalized) + (0 if normalized.startswith(_NO_SPACE_BEFORE_STARTS) else 1)
+        _token_lengths[token.word] = length
+    return length
+
+
+def _fit_sentences(tokens: List[Token], max_length: int) -> str:
+    # The longest run of complete sentences at the start of tokens that fits in max_length. A chain that ended on its
+    # own before running out of room counts as a complete sentence too
+    sentence_ends = [i + 1 for i, token in enumerate(tokens) if token.pos == _SENTENCE_END_POS]
+    if sum(_token_length(token) for token in tokens) <= max_length and len(tokens) not in sentence_ends[-1:]:
+        sentence_ends.append(len(tokens))
+
+    for sentence_end in reversed(sentence_ends):
+        tweet = _join_tokens(tokens[:sentence_end])
+        if len(tweet) <= max_length:
+            return tweet
+
+    return ''
 
 
 def create_tweet(model: Model, max_length: int) -> str:
     tweet = ''
 
-    # Keep trying in case the entire thing gets pruned
+    # Keep trying in case there isn't a complete sentence that fits
     while len(tweet) < 5:  # 5 is arbitrary
-        tokens_to_generate = max_length // 3  # 3 is also somewhat arbitrary
-        tokens = model.generate_tokens(tokens_to_generate)
-        too_long_tweet = _join_tokens(tokens)
-        tweet = _prune_tweet(too_long_tweet, max_length)
+        # Every token adds at least one character, so max_length runs out before the token limit does
+        tokens = model.generate_tokens(max_length + 1, _token_length, max_length)
+        with profile_stage('fit_sentences'):
+            tweet = _fit_sentences(tokens, max_length)
+        count_event('discarded_chains', int(len(tweet) < 5))
 
     return tweet
+
+
+def create_tweets(model: Model, max_length: int, k: int, rng: Optional[np.random.Generator] = None) -> List[str]:
+    # Same as k calls to create_tweet, but generates the tokens for all of them in batches
+    tweets = []
+    while len(tweets) < k:
+        token_lists = model.generate_batch(k - len(tweets), max_length + 1, rng, _token_length, max_length)
+        with profile_stage('fit_sentences'):
+            fitted_tweets = [_fit_sentences(tokens, max_length) for tokens in token_lists]
+        usable_tweets = [tweet for tweet in fitted_tweets if len(tweet) >= 5]  # Ones with nothing that fit are redone
+        count_event('discarded_chains', len(fitted_tweets) - len(usable_tweets))
+        tweets.extend(usable_tweets)
+
+    return tweets
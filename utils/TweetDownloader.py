@@ -1,66 +1,195 @@
+import codecs
+import datetime
 import itertools
-from typing import List
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
 
-import ndjson
 import requests
+from requests.adapters import HTTPAdapter
 
-from namedtuples.Tweet import Tweet, tweet_json_decode_hook, encode_tweet_for_json
+from namedtuples.Tweet import Tweet, tweet_json_decode_hook
+from utils.TweetDump import read_last_tweet, append_tweets, write_tweets
 
+_ARCHIVE_URL = 'http://trumptwitterarchive.com/data/realdonaldtrump/{year}.json'
+_FIRST_YEAR = 2009
+_MAX_WORKERS = 8
+_CHUNK_SIZE = 64 * 1024
 
-def _flatten(super_list: List[List]) -> List:
-    return list(itertools.chain(*super_list))
+_Validators = Dict[str, str]  # The ETag and Last-Modified headers the archive sent for a year
 
 
-def _get_tweets_by_year(year: int) -> List[Tweet]:
-    url = f'http://trumptwitterarchive.com/data/realdonaldtrump/{year}.json'
-    response = requests.get(url)
+class _YearResult(NamedTuple):
+    year: int
+    tweets: Optional[List[Tweet]]  # None if the year hasn't changed since its validators were saved
+    validators: _Validators
 
+    @property
+    def exists(self) -> bool:
+        # A year that hasn't changed must have existed when its validators were saved
+        return self.tweets is None or len(self.tweets) > 0
+
+
+def _iter_json_array(chunks: Iterable[str]) -> Iterator[Dict]:
+    # Yields the objects in a JSON array as their text arrives, so the raw response is never held in memory all at once
+    decoder = json.JSONDecoder(object_hook=tweet_json_decode_hook)
+    buffer = ''
+    position = 0
+    started = False
+
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+
+            if position == len(buffer):
+                break
+            elif not started:
+                if buffer[position] != '[':
+                    raise ValueError(f'Expected a JSON array, got {buffer[position:position + 20]!r}')
+                started = True
+                position += 1
+            elif buffer[position] == ']':
+                return
+            else:
+                try:
+                    item, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if chunk is None:
+                        raise
+                    break  # The object isn't all here yet
+
+                yield item
+
+    raise ValueError('Response ended before the JSON array did')
+
+
+def _is_homepage(first_chunk: str) -> bool:
     # The website redirects you to the homepage instead of giving 404s
-    if response.text.startswith('<!DOCTYPE html>'):
-        return []
-    else:
-        tweets = response.json(object_hook=tweet_json_decode_hook)
-        return list(sorted(tweets, key=lambda tw: tw.id))
+    return first_chunk.lstrip().startswith('<')
+
+
+def _get_tweets_by_year(session: requests.Session, year: int, validators: Optional[_Validators]) -> _YearResult:
+    headers = {}
+    if validators is not None:
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    with session.get(_ARCHIVE_URL.format(year=year), headers=headers, stream=True) as response:
+        if response.status_code == 304 and validators is not None:
+            return _YearResult(year, None, validators)
+        response.raise_for_status()
+
+        chunks = codecs.iterdecode(response.iter_content(_CHUNK_SIZE), 'utf-8')
+        first_chunk = next(chunks, '')
+        if _is_homepage(first_chunk):
+            return _YearResult(year, [], {})
+
+        tweets = list(_iter_json_array(itertools.chain([first_chunk], chunks)))
+        new_validators = {}
+        if 'ETag' in response.headers:
+            new_validators['etag'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            new_validators['last_modified'] = response.headers['Last-Modified']
+        return _YearResult(year, tweets, new_validators)
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_MAX_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_years_from(start_year: int, validators_by_year: Dict[int, _Validators]) -> List[_YearResult]:
+    # 'from' is inclusive. Stops at the first year that doesn't exist, like the archive's list of years does. The years
+    # the archive had last time (or without any validators, every year up to now) plus the one after are fetched at
+    # once, and any after those one at a time
+    results = []
+    with _new_session() as session, ThreadPoolExecutor(_MAX_WORKERS) as executor:
+        def get_year(year: int) -> _YearResult:
+            return _get_tweets_by_year(session, year, validators_by_year.get(year))
+
+        last_concurrent_year = max(max(validators_by_year, default=datetime.datetime.now().year - 1) + 1, start_year)
+        years = itertools.chain(executor.map(get_year, range(start_year, last_concurrent_year + 1)),
+                                map(get_year, itertools.count(last_concurrent_year + 1)))
+        for result in years:
+            if not result.exists:
+                break
+            results.append(result)
+
+    return results
+
+
+def _load_validators(filename: Optional[str], newest_tweet: Optional[Tweet]) -> Dict[int, _Validators]:
+    # Validators are only good for the dump they were saved with. If the dump's newest tweet has changed since (say
+    # it was restored from a backup), a year the archive says hasn't changed could still have tweets the dump is missing
+    if filename is None or newest_tweet is None:
+        return {}
 
+    try:
+        with open(filename, 'r') as fp:
+            saved = json.load(fp)
+    except FileNotFoundError:
+        return {}
 
-def _get_all_tweets_after_year(start_year: int):
-    # 'after' is inclusive
-    all_tweets = []
+    if saved['newest_tweet_id'] != newest_tweet.id:
+        return {}
+    return {int(year): validators for year, validators in saved['years'].items()}
 
-    for year in itertools.count(start_year):
-        tweets = _get_tweets_by_year(year)
-        if len(tweets) > 0:
-            all_tweets.extend(tweets)
-        else:
-            break
 
-    return list(sorted(all_tweets, key=lambda tw: tw.id))
+def _save_validators(filename: Optional[str], newest_tweet_id: Optional[int],
+                     validators_by_year: Dict[int, _Validators]) -> None:
+    if filename is None:
+        return
 
+    temp_filename = f'{filename}.tmp'
+    with open(temp_filename, 'w') as fp:
+        json.dump({
+            'newest_tweet_id': newest_tweet_id,
+            'years': {str(year): validators for year, validators in sorted(validators_by_year.items())}
+        }, fp, indent=2)
+    os.replace(temp_filename, filename)
 
-def _get_all_tweets() -> List[Tweet]:
-    return _get_all_tweets_after_year(2009)
 
+def full_dump(output_file: str, validators_file: Optional[str] = None) -> None:
+    # Always downloads everything, since a year that hasn't changed still needs its tweets written out
+    results = _get_years_from(_FIRST_YEAR, {})
+    tweets = sorted((tweet for result in results for tweet in result.tweets), key=lambda tw: tw.id)
+    write_tweets(output_file, tweets)
 
-def full_dump(output_file: str) -> None:
-    tweets = _get_all_tweets()
-    with open(output_file, 'w') as fp:
-        ndjson.dump((encode_tweet_for_json(tweet) for tweet in tweets), fp)
+    _save_validators(validators_file, tweets[-1].id if len(tweets) > 0 else None,
+                     {result.year: result.validators for result in results})
 
 
 # This exists so that we won't overwrite data we have in case something happens to trumptwitterarchive.com
-def add_new_tweets_to_dump(output_file: str) -> None:
+def add_new_tweets_to_dump(output_file: str, validators_file: Optional[str] = None) -> int:
+    # Returns how many tweets were added. With a validators_file, years that haven't changed since the last update cost
+    # a 304 instead of a full download
+    # The dump is sorted by id, so only its last tweet is needed to tell which downloaded tweets are new
     try:
-        with open(output_file, 'r') as fp:
-            existing_tweets = ndjson.load(fp, object_hook=tweet_json_decode_hook)
+        newest_tweet = read_last_tweet(output_file)
     except FileNotFoundError:
-        existing_tweets = []
+        newest_tweet = None
 
-    existing_tweet_ids = set(tweet.id for tweet in existing_tweets)
-    newest_tweet_year = existing_tweets[-1].created_at.year if len(existing_tweets) > 0 else 2009
+    newest_tweet_year = newest_tweet.created_at.year if newest_tweet is not None else _FIRST_YEAR
+    validators_by_year = _load_validators(validators_file, newest_tweet)
 
-    maybe_new_tweets = _get_all_tweets_after_year(newest_tweet_year)
-    new_tweets = (tweet for tweet in maybe_new_tweets if tweet.id not in existing_tweet_ids)
+    results = _get_years_from(newest_tweet_year, validators_by_year)
+    new_tweets = sorted((tweet for result in results if result.tweets is not None for tweet in result.tweets
+                         if newest_tweet is None or tweet.id > newest_tweet.id), key=lambda tw: tw.id)
+    num_added = append_tweets(output_file, new_tweets)
 
-    all_tweets = itertools.chain(existing_tweets, new_tweets)
-    with open(output_file, 'w') as fp:
-        ndjson.dump((encode_tweet_for_json(tweet) for tweet in all_tweets), fp)
+    # Saved only once the new tweets are in the dump, so a year can't be skipped before they've made it in
+    newest_tweet = new_tweets[-1] if len(new_tweets) > 0 else newest_tweet
+    validators_by_year.update((result.year, result.validators) for result in results)
+    _save_validators(validators_file, newest_tweet.id if newest_tweet is not None else None, validators_by_year)
+    return num_added
@@ -0,0 +1,116 @@
+import itertools
+import json
+import os
+import shutil
+from typing import Iterable, Iterator, Optional
+
+from namedtuples.Tweet import Tweet, tweet_json_decode_hook, encode_tweet_for_json
+from utils.Profiler import profile_stage
+from utils.TweetArchive import TweetArchive, append_tweets_to_archive, is_tweet_archive
+from utils.TweetValidator import filter_usable_tweets
+
+_TAIL_BLOCK_SIZE = 4096
+_FILTER_CHUNK_SIZE = 10000
+_COPY_CHUNK_SIZE = 100000
+
+# Everything here works on either an ndjson dump or a TweetArchive, depending on the filename
+
+
+def read_tweets(filename: str, only_usable: bool = False) -> Iterator[Tweet]:
+    # Yields the tweets a line at a time instead of loading the whole dump. Unusable ones are filtered out a chunk at a
+    # time, which is much faster than testing each one on its own
+    if is_tweet_archive(filename):
+        yield from TweetArchive(filename).iter_tweets(only_usable)
+        return
+
+    with open(filename, 'r') as fp:
+        tweets = (tweet_json_decode_hook(json.loads(line)) for line in fp if line.strip() != '')
+        if not only_usable:
+            yield from tweets
+            return
+
+        while True:
+            chunk = list(itertools.islice(tweets, _FILTER_CHUNK_SIZE))
+            if len(chunk) == 0:
+                break
+            with profile_stage('filter'):
+                usable_tweets = filter_usable_tweets(chunk)
+            yield from usable_tweets
+
+
+def read_last_tweet(filename: str) -> Optional[Tweet]:
+    if is_tweet_archive(filename):
+        archive = TweetArchive(filename)
+        return archive[-1] if len(archive) > 0 else None
+
+    # Reads backwards from the end of the file until it has the whole last line
+    with open(filename, 'rb') as fp:
+        position = fp.seek(0, os.SEEK_END)
+        tail = b''
+
+        while position > 0:
+            read_size = min(_TAIL_BLOCK_SIZE, position)
+            position -= read_size
+            fp.seek(position)
+            tail = fp.read(read_size) + tail
+
+            stripped_tail = tail.rstrip()
+            if b'\n' in stripped_tail or (position == 0 and stripped_tail != b''):
+                last_line = stripped_tail.rsplit(b'\n', 1)[-1]
+                return tweet_json_decode_hook(json.loads(last_line.decode('utf-8')))
+
+    return None
+
+
+def _ends_with_newline(filename: str) -> bool:
+    # Empty and missing files count, since nothing needs to be separated from what gets appended to them
+    try:
+        with open(filename, 'rb') as fp:
+            if fp.seek(0, os.SEEK_END) == 0:
+                return True
+
+            fp.seek(-1, os.SEEK_END)
+            return fp.read(1) == b'\n'
+    except FileNotFoundError:
+        return True
+
+
+def append_tweets(filename: str, tweets: Iterable[Tweet]) -> int:
+    # Returns how many tweets were appended
+    if is_tweet_archive(filename):
+        return append_tweets_to_archive(filename, tweets)
+
+    needs_newline = not _ends_with_newline(filename)
+
+    num_appended = 0
+    with open(filename, 'a') as fp:
+        for tweet in tweets:
+            if needs_newline:  # ndjson.dump doesn't end the file with a newline
+                fp.write('\n')
+                needs_newline = False
+
+            fp.write(json.dumps(encode_tweet_for_json(tweet)))
+            fp.write('\n')
+            num_appended += 1
+
+    return num_appended
+
+
+def write_tweets(filename: str, tweets: Iterable[Tweet]) -> int:
+    # Same as append_tweets, but replaces whatever was there
+    if is_tweet_archive(filename):
+        shutil.rmtree(filename, ignore_errors=True)
+    elif os.path.exists(filename):
+        os.remove(filename)
+    return append_tweets(filename, tweets)
+
+
+def copy_tweets(input_filename: str, output_filename: str) -> int:
+    # Converts between ndjson dumps and archives, a chunk at a time. Returns how many tweets were copied
+    tweets = read_tweets(input_filename)
+    num_copied = write_tweets(output_filename, itertools.islice(tweets, _COPY_CHUNK_SIZE))
+    while True:
+        num_appended = append_tweets(output_filename, itertools.islice(tweets, _COPY_CHUNK_SIZE))
+        if num_appended == 0:
+            return num_copied
+        num_copied += num_appended
@@ -1,56 +1,112 @@
-from datetime import datetime, timedelta
-from random import random, choices
-from typing import Set
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timezone
+from random import choices
+from typing import Callable, Iterator, List, Optional, Set, Tuple
 
-import tweepy
-from tweepy import API, Status
+from tweepy import API, Status, TweepError
 
+from utils.TwitterState import TwitterState, FOLLOWER, FRIEND
 
-def _get_liked_tweet_ids(api: API) -> Set[int]:
-    return set(tweet.id for tweet in tweepy.Cursor(api.favorites).items())
+_PAGE_SIZE = 200  # The most the timeline endpoints give per page
+_MAX_CONCURRENT_REPLIES = 4
+_MENTIONS_MAX_AGE = 24 * 60 * 60  # Older mentions don't get replies
+_USER_IDS_MAX_AGE = 24 * 60 * 60
 
 
-def _is_retweet(tweet: Status) -> bool:
-    return hasattr(tweet, 'retweeted_status')
+# Paging is done by hand rather than with tweepy.Cursor so that anything with the same methods as API works, like a
+# stand-in that doesn't talk to Twitter
+def _page_timeline(method: Callable, since_id: Optional[int]) -> Iterator[Status]:
+    max_id = None
+    while True:
+        page = method(count=_PAGE_SIZE, since_id=since_id, max_id=max_id)
+        if len(page) == 0:
+            return
 
+        yield from page
+        max_id = min(tweet.id for tweet in page) - 1
 
-def _get_mentions_tweet_ids(api: API) -> Set[int]:
-    mentions = (tweet for tweet in tweepy.Cursor(api.mentions_timeline).items() if not _is_retweet(tweet))
 
-    one_day_ago = datetime.today() - timedelta(days=1)
-    recent_mentions = (tweet for tweet in mentions if tweet.created_at > one_day_ago)
+def _page_ids(method: Callable) -> Iterator[int]:
+    cursor = -1
+    while cursor != 0:
+        ids, (_, cursor) = method(cursor=cursor)
+        yield from ids
 
-    return set(mention.id for mention in recent_mentions)
 
+def _is_retweet(tweet: Status) -> bool:
+    return hasattr(tweet, 'retweeted_status')
 
-def should_tweet_now(min_between_wakeups: float, target_avg_tweets_per_day: float) -> bool:
-    wakeups_per_day = (24 * 60) / min_between_wakeups
-    chance_to_tweet = target_avg_tweets_per_day / wakeups_per_day
-    return chance_to_tweet > random()
 
+def _get_created_at(tweet: Status) -> float:
+    return tweet.created_at.replace(tzinfo=timezone.utc).timestamp()  # tweepy gives naive UTC datetimes
 
-def post_tweet(api: API, tweet: str) -> None:
-    api.update_status(tweet)
 
+def _update_mentions(api: API, state: TwitterState, created_after: float) -> None:
+    # Only fetches mentions newer than the newest one seen last time, and stops paging once they're too old to reply to.
+    # Liked mentions are taken to have already been replied to, which is how that was tracked before there was a state
+    since_id = state.mentions_since_id
+    mentions = list(itertools.takewhile(lambda tweet: _get_created_at(tweet) > created_after,
+                                        _page_timeline(api.mentions_timeline, since_id)))
+    newest_id = max((tweet.id for tweet in mentions), default=since_id)
 
-def post_reply_tweet(api: API, tweet: str, status_id_to_reply_to: int) -> None:
-    api.create_favorite(status_id_to_reply_to)  # To prevent from replying twice. Also just kinda funny
-
-    user_to_reply_to = api.get_status(status_id_to_reply_to).author.screen_name
-    api.update_status(f'@{user_to_reply_to} {tweet}', status_id_to_reply_to, auto_populate_reply_metadata=True)
+    needs_reply = (tweet for tweet in mentions if not _is_retweet(tweet) and not tweet.favorited)
+    state.add_mentions(((tweet.id, tweet.author.screen_name, _get_created_at(tweet)) for tweet in needs_reply),
+                       newest_id)
 
 
-def get_tweet_ids_to_reply_to(api: API) -> Set[int]:
-    liked_tweet_ids = _get_liked_tweet_ids(api)
-    mentioned_tweet_ids = _get_mentions_tweet_ids(api)
-    return mentioned_tweet_ids - liked_tweet_ids
+def post_tweet(api: API, tweet: str) -> None:
+    api.update_status(tweet)
 
 
-def get_random_follower(api: API) -> str:
+def post_reply_tweet(api: API, tweet: str, status_id_to_reply_to: int, user_to_reply_to: str) -> None:
+    api.update_status(f'@{user_to_reply_to} {tweet}', status_id_to_reply_to, auto_populate_reply_metadata=True)
+    # Also just kinda funny. Done after replying, since a mention that's already favorited (e.g. by an earlier attempt)
+    # makes this fail, and the reply has been posted either way
+    try:
+        api.create_favorite(status_id_to_reply_to)
+    except TweepError:
+        pass
+
+
+def post_reply_tweets(api: API, state: TwitterState, replies: List[Tuple[str, int, str]]) -> None:
+    # replies are (tweet, id of the tweet to reply to, screen name of its author). Posted a few at a time, and marked as
+    # replied to as each one finishes. If any fail, the rest still get posted and the first error is raised afterwards
+    first_error = None
+    with ThreadPoolExecutor(_MAX_CONCURRENT_REPLIES) as executor:
+        futures = {executor.submit(post_reply_tweet, api, *reply): reply[1] for reply in replies}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                state.mark_replied(futures[future])
+            except Exception as e:
+                first_error = first_error or e
+
+    if first_error is not None:
+        raise first_error
+
+
+def get_tweets_to_reply_to(api: API, state: TwitterState) -> List[Tuple[int, str]]:
+    # Returns (tweet id, author's screen name) for recent mentions that haven't been replied to yet
+    created_after = time.time() - _MENTIONS_MAX_AGE
+    _update_mentions(api, state, created_after)
+    return state.get_unreplied_mentions(created_after)
+
+
+def _get_user_ids(state: TwitterState, relationship: str, get_ids: Callable) -> Set[int]:
+    user_ids = state.get_user_ids(relationship, _USER_IDS_MAX_AGE)
+    if user_ids is None:
+        user_ids = set(_page_ids(get_ids))
+        state.set_user_ids(relationship, user_ids)
+    return user_ids
+
+
+def get_random_follower(api: API, state: TwitterState) -> str:
     # Gets a random follower, weighted towards users we also follow
-    following_ids = set(tweepy.Cursor(api.friends_ids).items())
+    following_ids = _get_user_ids(state, FRIEND, api.friends_ids)
 
-    follower_ids = list(tweepy.Cursor(api.followers_ids).items())
+    follower_ids = list(sorted(_get_user_ids(state, FOLLOWER, api.followers_ids)))
     weights = [(3 if user_id in following_ids else 1) for user_id in follower_ids]
 
     random_follower_id = choices(follower_ids, weights=weights, k=1)[0]
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List
+
+TWEET = 'tweet'
+REPLY = 'reply'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queued_tweets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queued_tweets_kind ON queued_tweets (kind, id);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+def get_model_version(model_filename: str) -> str:
+    # Models are always written to a temp file and moved into place, so a new model always changes this
+    try:
+        stat = os.stat(model_filename)
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+    except FileNotFoundError:
+        return ''
+
+
+class TweetQueue:
+    # Tweets generated ahead of time, so that posting one doesn't need the model. The queue remembers which version of
+    # the model file its tweets came from, and throws them all away once that file changes
+    def __init__(self, filename: str, model_version: str, max_size: int):
+        self._connection = sqlite3.connect(filename, isolation_level=None)  # Transactions are managed manually
+        self._connection.executescript(_SCHEMA)
+        self._max_size = max_size
+
+        with self._transaction():
+            if self._get_metadata('model_version', '') != model_version:
+                self._clear()
+                self._set_metadata('model_version', model_version)
+
+    def __enter__(self) -> 'TweetQueue':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def pop(self, kind: str, k: int) -> List[str]:
+        # Returns up to k tweets, oldest first. Fewer than k means the queue ran out
+        with self._transaction():
+            rows = self._connection.execute('SELECT id, text FROM queued_tweets WHERE kind = ? ORDER BY id LIMIT ?',
+                                            (kind, k)).fetchall()
+            self._connection.executemany('DELETE FROM queued_tweets WHERE id = ?', ((row[0],) for row in rows))
+            self._increment_metadata(f'{kind}_served', len(rows))
+            self._increment_metadata(f'{kind}_missed', k - len(rows))
+
+        return [row[1] for row in rows]
+
+    def push(self, kind: str, tweets: Iterable[str]) -> int:
+        # Returns how many were added, which can be less than given if the queue fills up
+        with self._transaction():
+            tweets = list(tweets)[:self.num_missing(kind)]
+            now = time.time()
+            self._connection.executemany('INSERT INTO queued_tweets (kind, text, created_at) VALUES (?, ?, ?)',
+                                         ((kind, tweet, now) for tweet in tweets))
+
+        return len(tweets)
+
+    def num_missing(self, kind: str) -> int:
+        return max(self._max_size - self._count(kind), 0)
+
+    def clear(self) -> None:
+        with self._transaction():
+            self._clear()
+
+    def stats(self) -> Dict:
+        stats = {'model_version': self._get_metadata('model_version', ''), 'max_size': self._max_size}
+        for kind in (TWEET, REPLY):
+            oldest = self._connection.execute('SELECT MIN(created_at) FROM queued_tweets WHERE kind = ?',
+                                              (kind,)).fetchone()[0]
+            stats[kind] = {
+                'queued': self._count(kind),
+                'served': int(self._get_metadata(f'{kind}_served', '0')),
+                'missed': int(self._get_metadata(f'{kind}_missed', '0')),
+                'oldest_age_hours': (time.time() - oldest) / 3600 if oldest is not None else None
+            }
+        return stats
+
+    def _transaction(self) -> 'sqlite3.Connection':
+        # Takes the write lock up front, so that two wakeups running at once can't pop the same tweet
+        self._connection.execute('BEGIN IMMEDIATE')
+        return self._connection
+
+    def _count(self, kind: str) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM queued_tweets WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def _clear(self) -> None:
+        self._connection.execute('DELETE FROM queued_tweets')
+
+    def _get_metadata(self, key: str, default: str) -> str:
+        row = self._connection.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_metadata(self, key: str, value: str) -> None:
+        self._connection.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)', (key, value))
+
+    def _increment_metadata(self, key: str, amount: int) -> None:
+        self._set_metadata(key, str(int(self._get_metadata(key, '0')) + amount))
@@ -0,0 +1,16 @@
+from random import expovariate, random
+
+_MINUTES_PER_DAY = 24 * 60
+
+
+# Kept apart from TweetPoster so that deciding whether to tweet doesn't require importing tweepy
+def should_tweet_now(min_between_wakeups: float, target_avg_tweets_per_day: float) -> bool:
+    wakeups_per_day = _MINUTES_PER_DAY / min_between_wakeups
+    chance_to_tweet = target_avg_tweets_per_day / wakeups_per_day
+    return chance_to_tweet > random()
+
+
+def get_minutes_until_next_tweet(target_avg_tweets_per_day: float) -> float:
+    # Makes tweets a Poisson process: the same average rate as should_tweet_now, but at any time rather than only when
+    # a wakeup happens
+    return expovariate(target_avg_tweets_per_day / _MINUTES_PER_DAY)
@@ -1,7 +1,22 @@
 import re
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
 
 from namedtuples.Tweet import Tweet
+from namedtuples.TweetColumns import TEXT_ENCODING, TweetColumns, get_text, tweets_to_columns
+from utils.Profiler import count_event
+
+_NON_TRUMP_SOURCES = frozenset({'Twitter for Android', 'Twitter Web Client'})
+_TRUMP_IPHONE_SOURCE = 'Twitter for iPhone'
+_TRUMP_IPHONE_START = datetime(2017, 2, 1, tzinfo=timezone.utc)  # iPhone tweets before this were from his staff
+_OLDEST_USABLE = datetime(2011, 1, 1, tzinfo=timezone.utc)
+
+_QUOTE_STARTS = ('"', '“', 'Via @')
+_COMMONLY_QUOTED = ('Albert Einstein', 'Aristotle', 'Benjamin Franklin', 'Emerson')
+_QUOTE_PATTERN = re.compile(r'^[“|\"].*[”|\"]\s*[–|\-].*$')
 
 
 def is_retweet(tweet: Tweet) -> bool:
@@ -9,20 +24,18 @@ def is_retweet(tweet: Tweet) -> bool:
 
 
 def not_from_trump_device(tweet: Tweet) -> bool:
-    if tweet.source in {'Twitter for Android', 'Twitter Web Client'}:
+    if tweet.source in _NON_TRUMP_SOURCES:
         # TODO a lot of tweets from the web client shouldn't be used
         return False
-    elif tweet.source == 'Twitter for iPhone':
-        return tweet.created_at < datetime.strptime('Feb 01 2017 +0000', '%b %d %Y %z')
+    elif tweet.source == _TRUMP_IPHONE_SOURCE:
+        return tweet.created_at < _TRUMP_IPHONE_START
     else:
         return True
 
 
 def is_quote(tweet: Tweet) -> bool:
-    bad_starts = ('"', '“', 'Via @')
-    commonly_quoted = {'Albert Einstein', 'Aristotle', 'Benjamin Franklin', 'Emerson'}
-    return tweet.text.startswith(bad_starts) or any((person in tweet.text) for person in commonly_quoted) \
-        or (re.match(r'^[“|\"].*[”|\"]\s*[–|\-].*$', tweet.text) is not None)
+    return tweet.text.startswith(_QUOTE_STARTS) or any((person in tweet.text) for person in _COMMONLY_QUOTED) \
+        or (_QUOTE_PATTERN.match(tweet.text) is not None)
 
 
 def is_short_reply(tweet: Tweet) -> bool:
@@ -30,7 +43,7 @@ def is_short_reply(tweet: Tweet) -> bool:
 
 
 def too_old(tweet: Tweet) -> bool:
-    return tweet.created_at < datetime.strptime('Jan 01 2011 +0000', '%b %d %Y %z')
+    return tweet.created_at < _OLDEST_USABLE
 
 
 def is_just_link(tweet: Tweet) -> bool:
@@ -40,3 +53,115 @@ def is_just_link(tweet: Tweet) -> bool:
 def should_use_tweet(tweet: Tweet) -> bool:
     tests = (is_retweet, not_from_trump_device, is_quote, is_short_reply, too_old, is_just_link)
     return not any(test(tweet) for test in tests)
+
+
+# The same tests as above, each over a whole TweetColumns at once. Each returns a mask of the tweets it's true for.
+# Text tests work on the encoded text blob, which is safe because no UTF-8 character's encoding can show up in the
+# middle of another's
+class _Texts:
+    # What the text tests need from a TweetColumns, worked out once for all of them
+    def __init__(self, columns: TweetColumns):
+        self.columns = columns
+        self.lengths = np.diff(columns.text_offsets)
+        self.blob = columns.text_blob.tobytes()
+
+        spaces = np.flatnonzero(columns.text_blob == ord(' '))
+        self.space_counts = np.bincount(np.searchsorted(columns.text_offsets, spaces, side='right') - 1,
+                                        minlength=len(columns.ids))
+
+    def starts_with(self, prefix: str) -> np.ndarray:
+        encoded_prefix = prefix.encode(TEXT_ENCODING)
+        mask = self.lengths >= len(encoded_prefix)
+        for i, byte in enumerate(encoded_prefix):
+            candidates = np.flatnonzero(mask)
+            mask[candidates] = self.columns.text_blob[self.columns.text_offsets[candidates] + i] == byte
+        return mask
+
+    def contains(self, substring: str) -> np.ndarray:
+        encoded_substring = substring.encode(TEXT_ENCODING)
+        positions = []
+        position = self.blob.find(encoded_substring)
+        while position != -1:
+            positions.append(position)
+            position = self.blob.find(encoded_substring, position + 1)
+
+        # A match can run from the end of one text into the start of the next
+        positions = np.array(positions, dtype=np.int64)
+        indexes = np.searchsorted(self.columns.text_offsets, positions, side='right') - 1
+        indexes = indexes[positions + len(encoded_substring) <= self.columns.text_offsets[indexes + 1]]
+
+        mask = np.zeros(len(self.lengths), dtype=bool)
+        mask[indexes] = True
+        return mask
+
+
+def _is_retweet_mask(columns: TweetColumns, texts: _Texts) -> np.ndarray:
+    return columns.is_retweet
+
+
+def _not_from_trump_device_mask(columns: TweetColumns, texts: _Texts) -> np.ndarray:
+    def get_source_mask(source_names: Iterable[str]) -> np.ndarray:
+        return np.isin(columns.sources, [i for i, name in enumerate(columns.source_names) if name in source_names])
+
+    from_trump_iphone = get_source_mask({_TRUMP_IPHONE_SOURCE})
+    other_source = ~get_source_mask(_NON_TRUMP_SOURCES) & ~from_trump_iphone
+    return other_source | (from_trump_iphone & (columns.created_at < _TRUMP_IPHONE_START.timestamp()))
+
+
+def _is_quote_mask(columns: TweetColumns, texts: _Texts) -> np.ndarray:
+    mask = np.zeros(len(columns.ids), dtype=bool)
+    for start in _QUOTE_STARTS:
+        mask |= texts.starts_with(start)
+    for person in _COMMONLY_QUOTED:
+        mask |= texts.contains(person)
+
+    # Anything else the pattern matches has to start with a '|', so only those few need it
+    maybe_quotes = np.flatnonzero(~mask & texts.starts_with('|'))
+    mask[maybe_quotes] = [_QUOTE_PATTERN.match(get_text(columns, i)) is not None for i in maybe_quotes.tolist()]
+    return mask
+
+
+def _is_short_reply_mask(columns: TweetColumns, texts: _Texts) -> np.ndarray:
+    return texts.starts_with('@') & (texts.space_counts <= 4)
+
+
+def _too_old_mask(columns: TweetColumns, texts: _Texts) -> np.ndarray:
+    return columns.created_at < _OLDEST_USABLE.timestamp()
+
+
+def _is_just_link_mask(columns: TweetColumns, texts: _Texts) -> np.ndarray:
+    return (texts.space_counts == 0) & texts.starts_with('http')
+
+
+_MASKS = OrderedDict([
+    ('is_retweet', _is_retweet_mask),
+    ('not_from_trump_device', _not_from_trump_device_mask),
+    ('is_quote', _is_quote_mask),
+    ('is_short_reply', _is_short_reply_mask),
+    ('too_old', _too_old_mask),
+    ('is_just_link', _is_just_link_mask),
+])
+
+
+def find_usable_tweets(columns: TweetColumns) -> Tuple[np.ndarray, Dict[str, int]]:
+    # Returns a mask of the tweets should_use_tweet would keep, and how many tweets each test rejected. A tweet
+    # rejected by more than one test only counts towards the first, so the counts add up to the number rejected
+    texts = _Texts(columns)
+    usable = np.ones(len(columns.ids), dtype=bool)
+    rejection_counts = OrderedDict()
+    for name, get_mask in _MASKS.items():
+        rejected = get_mask(columns, texts) & usable
+        rejection_counts[name] = int(rejected.sum())
+        usable &= ~rejected
+        count_event(f'rejected_{name}', rejection_counts[name])
+
+    return usable, rejection_counts
+
+
+def filter_usable_tweets(tweets: Sequence[Tweet]) -> List[Tweet]:
+    # Same as filtering with should_use_tweet
+    if len(tweets) == 0:
+        return []
+
+    usable, _ = find_usable_tweets(tweets_to_columns(tweets))
+    return [tweets[i] for i in np.flatnonzero(usable).tolist()]
@@ -0,0 +1,95 @@
+import sqlite3
+import time
+from typing import Iterable, List, Optional, Set, Tuple
+
+FOLLOWER = 'follower'
+FRIEND = 'friend'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mentions (
+    tweet_id INTEGER PRIMARY KEY,
+    author TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    replied INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS users (
+    relationship TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (relationship, user_id)
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+class TwitterState:
+    # What the bot knows about its account between wakeups, so that each one only asks Twitter for what's new. Mentions
+    # are remembered from when they're first seen until they've been replied to or are too old to bother with, along
+    # with the newest one's id to fetch from next time. Follower and friend ids are cached for a while
+    def __init__(self, filename: str):
+        self._connection = sqlite3.connect(filename, isolation_level=None)  # Transactions are managed manually
+        self._connection.executescript(_SCHEMA)
+
+    def __enter__(self) -> 'TwitterState':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @property
+    def mentions_since_id(self) -> Optional[int]:
+        since_id = self._get_metadata('mentions_since_id')
+        return int(since_id) if since_id is not None else None
+
+    def add_mentions(self, mentions: Iterable[Tuple[int, str, float]], since_id: Optional[int]) -> None:
+        # mentions are (tweet id, author's screen name, created at) for each new mention that needs a reply. since_id
+        # is the newest mention fetched, including ones that don't need replies
+        with self._transaction():
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO mentions (tweet_id, author, created_at) VALUES (?, ?, ?)', mentions)
+            if since_id is not None:
+                self._set_metadata('mentions_since_id', str(since_id))
+
+    def get_unreplied_mentions(self, created_after: float) -> List[Tuple[int, str]]:
+        # Returns (tweet id, author's screen name) for each, oldest first. Older ones are forgotten
+        with self._transaction():
+            self._connection.execute('DELETE FROM mentions WHERE created_at <= ?', (created_after,))
+            rows = self._connection.execute('SELECT tweet_id, author FROM mentions WHERE replied = 0 ORDER BY tweet_id')
+            return rows.fetchall()
+
+    def mark_replied(self, tweet_id: int) -> None:
+        with self._transaction():
+            self._connection.execute('UPDATE mentions SET replied = 1 WHERE tweet_id = ?', (tweet_id,))
+
+    def get_user_ids(self, relationship: str, max_age: float) -> Optional[Set[int]]:
+        # Returns None if they've never been cached or were cached more than max_age seconds ago
+        cached_at = self._get_metadata(f'{relationship}_ids_cached_at')
+        if cached_at is None or time.time() - float(cached_at) > max_age:
+            return None
+
+        rows = self._connection.execute('SELECT user_id FROM users WHERE relationship = ?', (relationship,))
+        return set(row[0] for row in rows)
+
+    def set_user_ids(self, relationship: str, user_ids: Iterable[int]) -> None:
+        with self._transaction():
+            self._connection.execute('DELETE FROM users WHERE relationship = ?', (relationship,))
+            self._connection.executemany('INSERT OR IGNORE INTO users (relationship, user_id) VALUES (?, ?)',
+                                         ((relationship, user_id) for user_id in user_ids))
+            self._set_metadata(f'{relationship}_ids_cached_at', str(time.time()))
+
+    def _transaction(self) -> 'sqlite3.Connection':
+        # Takes the write lock up front, like TweetQueue does
+        self._connection.execute('BEGIN IMMEDIATE')
+        return self._connection
+
+    def _get_metadata(self, key: str) -> Optional[str]:
+        row = self._connection.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_metadata(self, key: str, value: str) -> None:
+        self._connection.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)', (key, value))